@@ -1,71 +1,135 @@
-import sqlite3
-import markdown
 import bleach
-import re
+import functools
 import os
-from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, session, flash
+import secrets
+from datetime import datetime, timedelta
+from flask import Blueprint, Flask, current_app, render_template, request, redirect, url_for, session, flash, jsonify, Response, g
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
-
-app = Flask(__name__)
-app.secret_key = 'y2k_myspace_super_secret_key'
-
-# Allowed tags and attributes for bleach (to keep markdown safe but allow styling/images)
-ALLOWED_TAGS = [
-    'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'strong', 
-    'ul', 'p', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'img', 'hr', 'span'
-]
-ALLOWED_ATTRIBUTES = {
-    'a': ['href', 'title', 'target'],
-    'img': ['src', 'alt', 'title'],
-    'span': ['class', 'style']
-}
+import db
+import counters
+import conversations
+import search
+import events
+import timeline
+import socialgraph
+import settings
+import expiry
+import uploads
+import caching
+import content
+import fragments
+import sqlstats
+import metrics
+from groupcommit import Writer, writer
+from db import get_db
+from migrations import upgrade, backfill_message_search
+from presence import PresenceTracker, tracker as presence
+from feed import fetch_profile_page, decode_cursor, fetch_comment
+
+# Key signing the session cookies when FLASK_SECRET_KEY isn't set, in debug and tests only
+DEV_SECRET_KEY = 'y2k_myspace_super_secret_key'
+
+class Routes(Blueprint):
+    """A blueprint whose endpoints keep their plain names (`url_for('index')`, not 'views.index')."""
+
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+        endpoint = endpoint or view_func.__name__
+        self.record(lambda state: state.app.add_url_rule(rule, endpoint, view_func, **options))
+
+# The routes, hooks, filters and commands below; create_app() registers them on each app it builds
+views = Routes('views', __name__, cli_group=None)
+
+def create_app(config=None):
+    """
+    Build an app and set it up. Settings come from `config`, then from FLASK_* environment
+    variables (FLASK_SECRET_KEY, FLASK_DATABASE, FLASK_WRITE_QUEUE=false...), then from each
+    module's defaults. Each app has its own pool, writer thread, caches and event broker
+    (in app.extensions), so several can live in one process, e.g. one per test database.
+    """
+    app = Flask(__name__)
+    app.config.from_prefixed_env()
+    app.config.update(config or {})
+    if not app.secret_key:
+        if app.debug or app.testing:
+            app.secret_key = DEV_SECRET_KEY
+        else:
+            # Made before the workers fork (see wsgi.py), so they all share it until the next restart
+            app.secret_key = secrets.token_hex(32)
+            app.logger.warning('FLASK_SECRET_KEY is not set: sessions end when the server restarts')
+    # Bigger request bodies get a 413 before they are read (see upload_too_large)
+    if app.config['MAX_CONTENT_LENGTH'] is None:
+        app.config['MAX_CONTENT_LENGTH'] = uploads.MAX_UPLOAD_SIZE
+
+    # Pooled per-request connections, and the schema brought up to date before serving
+    db.init_app(app)
+    sqlstats.init_app(app)
+    upgrade(app.config['DATABASE'])
+    Writer().init_app(app)
+    PresenceTracker().init_app(app)
+    events.init_app(app)
+    expiry.ExpiryWorker().init_app(app)
+    socialgraph.SocialGraph().init_app(app)
+    settings.SettingsStore().init_app(app)
+    caching.init_app(app)
+    fragments.init_app(app)
+    # The gauges are read by /metrics, in a request of the app they describe
+    metrics.init_app(app, gauges=[
+        ('users_present', 'Users seen by this process within the online/away thresholds of get_user_status.',
+         lambda: present_users()),
+        ('event_stream_subscribers', 'Open /events streams.', lambda: events.broker.subscriber_count),
+        ('expired_messages_purged_total', 'Ephemeral messages deleted by the expiry worker.',
+         lambda: expiry.worker.total_purged, 'counter'),
+        ('group_commit_queue_depth', 'Writes waiting for the writer thread.', lambda: writer.depth),
+        ('group_commit_batches_total', 'Transactions committed by the writer thread.', lambda: writer.batches, 'counter'),
+        ('group_commit_writes_total', 'Writes committed by the writer thread.', lambda: writer.committed, 'counter'),
+    ])
+    # Last, so the hooks of the modules above run before the app's own
+    app.register_blueprint(views)
+    return app
+
+# Status dots: online under ONLINE_MINUTES of inactivity, away up to AWAY_MINUTES, then offline
+ONLINE_MINUTES = 5
+AWAY_MINUTES = 60
 
 def get_db_connection():
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def parse_mentions(text):
-    """Finds @username and wraps it in a styled span."""
-    # This regex looks for @ followed by word characters
-    pattern = r'@(\w+)'
-    # Replace with a styled span
-    styled_mention = r'<span class="mention">@\1</span>'
-    return re.sub(pattern, styled_mention, text)
-
-@app.context_processor
+    """The current request's pooled connection (see db.py), shared by every caller in the request."""
+    return get_db()
+
+def profile_url(username):
+    return url_for('public_profile', username=username)
+
+def render_content(conn, raw_content):
+    """Markdown + @mentions + sanitizing, done once when the content is written (see content.py)."""
+    return content.render(conn, raw_content, profile_url)
+
+@views.app_context_processor
 def inject_unread_count():
-    if 'user_id' in session:
-        conn = get_db_connection()
-        count = conn.execute('SELECT COUNT(id) FROM messages WHERE receiver_id = ? AND is_read = 0', (session['user_id'],)).fetchone()[0]
-        conn.close()
-        return dict(unread_messages_count=count)
-    return dict(unread_messages_count=0)
+    if 'user_id' not in session:
+        return dict(unread_messages_count=0)
+    # Read once per request: every render_template runs this, including one per post fragment
+    if 'unread_messages_count' not in g:
+        g.unread_messages_count = counters.unread_total(get_db_connection(), session['user_id'])
+    return dict(unread_messages_count=g.unread_messages_count)
 
-# Update last active timestamp for logged in users
-@app.before_request
+# Record activity for logged in users (in memory, flushed to users.last_active in batches)
+@views.before_app_request
 def update_last_active():
     if 'user_id' in session:
-        conn = get_db_connection()
-        conn.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE id = ?', (session['user_id'],))
-        conn.commit()
-        conn.close()
+        presence.touch(session['user_id'])
+        presence.flush_if_stale()
 
-@app.after_request
-def add_header(response):
-    """
-    Force modern browsers to not cache pages.
-    This prevents the back/forward cache from showing ghost posts after a user deletes them
-    and is redirected back to the same page.
-    """
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, post-check=0, pre-check=0, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '-1'
-    return response
+def page_viewer():
+    """What a cacheable page depends on besides the content version (see caching.conditional)."""
+    if 'user_id' not in session:
+        return (None,)
+    return session['user_id'], counters.unread_total(get_db_connection(), session['user_id'])
+
+@views.app_template_filter('srcset')
+def srcset_filter(image_url):
+    """Responsive `srcset` for an uploaded image (empty when it has no thumbnails)."""
+    return uploads.srcset(current_app.static_folder, image_url, current_app.static_url_path)
 
-@app.template_filter('timeago')
+@views.app_template_filter('timeago')
 def timeago_filter(dt_str):
     if not dt_str:
         return ""
@@ -106,100 +170,88 @@ def timeago_filter(dt_str):
     except Exception:
         return dt_str
 
-def get_user_status(last_active_str):
-    """Determine Online/Away/Offline based on last_active timestamp string from DB"""
-    if not last_active_str:
-        return {'label': 'Déconnecté', 'color': '🔴'}
-        
-    try:
-        # SQLite stores as YYYY-MM-DD HH:MM:SS (UTC usually, but let's assume local for simplicity here)
-        last_active = datetime.strptime(last_active_str, '%Y-%m-%d %H:%M:%S')
-        now = datetime.utcnow() # match sqlite CURRENT_TIMESTAMP
+def get_user_status(last_active_str, user_id=None):
+    """
+    Determine Online/Away/Offline based on last_active timestamp string from DB.
+    When `user_id` is given, activity not yet flushed to the DB by the presence tracker wins.
+    """
+    last_active = None
+    if last_active_str:
+        try:
+            # SQLite stores as YYYY-MM-DD HH:MM:SS (UTC usually, but let's assume local for simplicity here)
+            last_active = datetime.strptime(last_active_str, '%Y-%m-%d %H:%M:%S')
+        except Exception:
+            last_active = None
+    
+    seen = presence.last_seen(user_id) if user_id is not None else None
+    if seen and (last_active is None or seen > last_active):
+        last_active = seen
         
-        diff = now - last_active
-        minutes = diff.total_seconds() / 60
+    if not last_active:
+        return {'label': 'Déconnecté', 'color': '🔴'}
         
-        if minutes < 5:
-            return {'label': 'En ligne', 'color': '🟢'}
-        elif minutes <= 60:
-            return {'label': 'En veille', 'color': '🟡'}
-        else:
-            return {'label': 'Déconnecté', 'color': '🔴'}
-    except Exception:
+    now = datetime.utcnow() # match sqlite CURRENT_TIMESTAMP
+    
+    diff = now - last_active
+    minutes = diff.total_seconds() / 60
+    
+    if minutes < ONLINE_MINUTES:
+        return {'label': 'En ligne', 'color': '🟢'}
+    elif minutes <= AWAY_MINUTES:
+        return {'label': 'En veille', 'color': '🟡'}
+    else:
         return {'label': 'Déconnecté', 'color': '🔴'}
 
-@app.route('/')
+def present_users():
+    """Online and away users, by the thresholds of get_user_status (for /metrics)."""
+    now = datetime.utcnow()
+    online = presence.online_since(now - timedelta(minutes=ONLINE_MINUTES))
+    recent = presence.online_since(now - timedelta(minutes=AWAY_MINUTES))
+    return {(('status', 'online'),): online, (('status', 'away'),): recent - online}
+
+def social_graph():
+    """The in-memory social graph (see socialgraph.py), synced with the database once per request."""
+    if 'social_graph' not in g:
+        g.social_graph = socialgraph.graph.sync(get_db_connection())
+    return g.social_graph
+
+def conversation_settings():
+    """The cached conversation settings (see settings.py), synced with the database once per request."""
+    if 'conversation_settings' not in g:
+        g.conversation_settings = settings.store.sync(get_db_connection())
+    return g.conversation_settings
+
+def social_graph_changed(conn, user_a, user_b, rebuild_timelines=True):
+    """
+    A friendship or block between two users changed: call from the write (see groupcommit.py).
+    The request then drops its synced graph with `g.pop('social_graph', None)`.
+    """
+    socialgraph.record_change(conn, user_a, user_b)
+    caching.content_changed(conn)
+    if rebuild_timelines:
+        # Only accepted friendships decide what the home feed shows
+        timeline.graph_changed(conn, user_a, user_b)
+
+def get_relationship(conn, current_user_id, target_id):
+    """
+    Relationship of the current user towards another user, as shown on profiles:
+    'blocked_by_them', 'blocked', 'friends', 'request_sent', 'request_received' or 'none'.
+    """
+    return social_graph().relationship(current_user_id, target_id)
+
+def build_timeline(user_id):
+    """A logged-in user's first feed page since their timeline was pruned (or ever) builds it."""
+    writer.run(timeline.materialize, user_id)
+
+@views.route('/')
+@caching.conditional(page_viewer)
 def index():
     conn = get_db_connection()
+    cursor = decode_cursor(request.args.get('cursor'))
+    posts_data, next_cursor = timeline.fetch_page(conn, session.get('user_id'), cursor, build=build_timeline)
     
-    if 'user_id' in session:
-        user_id = session['user_id']
-        posts_data = conn.execute('''
-            SELECT DISTINCT posts.id, posts.content, posts.post_type, posts.visibility, posts.image_url, posts.created_at, posts.author_id,
-                   users.username, users.display_name, users.profile_picture 
-            FROM posts 
-            JOIN users ON posts.author_id = users.id 
-            LEFT JOIN friends f1 ON (f1.sender_id = ? AND f1.receiver_id = posts.author_id AND f1.status = 'accepted')
-            LEFT JOIN friends f2 ON (f2.sender_id = posts.author_id AND f2.receiver_id = ? AND f2.status = 'accepted')
-            WHERE posts.visibility = 'public' 
-               OR posts.author_id = ?
-               OR (posts.visibility = 'friends' AND (f1.id IS NOT NULL OR f2.id IS NOT NULL))
-            ORDER BY posts.created_at DESC
-        ''', (user_id, user_id, user_id)).fetchall()
-    else:
-        # Get all public posts
-        posts_data = conn.execute('''
-            SELECT posts.id, posts.content, posts.post_type, posts.visibility, posts.image_url, posts.created_at, posts.author_id,
-                   users.username, users.display_name, users.profile_picture 
-            FROM posts 
-            JOIN users ON posts.author_id = users.id 
-            WHERE posts.visibility = 'public'
-            ORDER BY posts.created_at DESC
-        ''').fetchall()
-    
-    posts = []
-    # For each post, fetch its likes and comments
-    for p in posts_data:
-        post_dict = dict(p)
-        
-        # Ensure author_id is always present in post_dict even if the query didn't select it 
-        if 'author_id' not in post_dict:
-            # We must get the author id via users if it wasn't explicitly selected
-            author_row = conn.execute('SELECT id FROM users WHERE username = ?', (post_dict['username'],)).fetchone()
-            if author_row:
-                post_dict['author_id'] = author_row['id']
-        
-        # Determine if the current user liked this post
-        current_user_liked = False
-        likes_count = 0
-        likes_data = conn.execute('SELECT user_id FROM likes WHERE item_type = "post" AND item_id = ?', (p['id'],)).fetchall()
-        likes_count = len(likes_data)
-        if 'user_id' in session:
-            current_user_liked = any(l['user_id'] == session['user_id'] for l in likes_data)
-            
-        # Get comments
-        comments_data = conn.execute('''
-            SELECT comments.id, comments.content, comments.created_at, comments.author_id,
-                   users.username, users.display_name, users.profile_picture 
-            FROM comments 
-            JOIN users ON comments.author_id = users.id 
-            WHERE comments.post_id = ?
-            ORDER BY comments.created_at ASC
-        ''', (p['id'],)).fetchall()
-        
-        comments = []
-        for c in comments_data:
-            c_dict = dict(c)
-            # Fetch likes for comment
-            c_likes_data = conn.execute('SELECT user_id FROM likes WHERE item_type = "comment" AND item_id = ?', (c['id'],)).fetchall()
-            c_dict['likes'] = len(c_likes_data)
-            c_dict['current_user_liked'] = any(l['user_id'] == session.get('user_id') for l in c_likes_data) if 'user_id' in session else False
-            comments.append(c_dict)
-            
-        post_dict['likes'] = likes_count
-        post_dict['current_user_liked'] = current_user_liked
-        post_dict['comments'] = comments
-        posts.append(post_dict)
+    # Rendered posts come from the fragment cache; likes and statuses are filled in per viewer
+    posts = fragments.render_posts(conn, posts_data, '_post.html', get_user_status)
         
     # Get profile data for the sidebar/header
     # If user is logged in, show their profile, else fallback to admin
@@ -209,27 +261,29 @@ def index():
     if not profile_user:
         profile_user = conn.execute('SELECT * FROM users WHERE role = "admin" ORDER BY id ASC LIMIT 1').fetchone()
         
-    # Calculate statuses for all posts and comments
-    for post in posts:
-        # We need the author's last active to show their status circle
-        author_data = conn.execute('SELECT last_active FROM users WHERE username = ?', (post['username'],)).fetchone()
-        post['author_status'] = get_user_status(author_data['last_active'] if author_data else None)
-        
-        for comment in post['comments']:
-            c_author_data = conn.execute('SELECT last_active FROM users WHERE username = ?', (comment['username'],)).fetchone()
-            comment['author_status'] = get_user_status(c_author_data['last_active'] if c_author_data else None)
-            
     # Calculate status for the currently displayed profile
     profile_status = None
     if profile_user:
         profile_user_dict = dict(profile_user)
-        profile_status = get_user_status(profile_user_dict.get('last_active'))
+        profile_status = get_user_status(profile_user_dict.get('last_active'), profile_user_dict['id'])
         profile_user = profile_user_dict
     
-    conn.close()
-    return render_template('index.html', posts=posts, profile_user=profile_user, profile_status=profile_status)
+    return render_template('index.html', posts=posts, profile_user=profile_user, profile_status=profile_status,
+                           next_cursor=next_cursor, more_url=url_for('index', cursor=next_cursor),
+                           fragment_url=url_for('feed_fragment', cursor=next_cursor))
+
+@views.route('/feed')
+@caching.conditional(page_viewer)
+def feed_fragment():
+    """Next page of the home feed as an HTML fragment, for the infinite scroll."""
+    conn = get_db_connection()
+    cursor = decode_cursor(request.args.get('cursor'))
+    posts_data, next_cursor = timeline.fetch_page(conn, session.get('user_id'), cursor, build=build_timeline)
+    posts = fragments.render_posts(conn, posts_data, '_post.html', get_user_status)
+    html = render_template('_posts_fragment.html', posts=posts)
+    return jsonify(html=html, next_cursor=next_cursor)
 
-@app.route('/login', methods=('GET', 'POST'))
+@views.route('/login', methods=('GET', 'POST'))
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -237,7 +291,6 @@ def login():
         
         conn = get_db_connection()
         user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
 
         # Simple verification. Admin is pre-inserted with plain 'password'
         # New users will have hashed passwords, so we check both for compatibility with our dummy init
@@ -253,13 +306,19 @@ def login():
             session['user_id'] = user['id']
             session['username'] = user['username']
             session['role'] = user['role']
+            user_id = user['id']
+
+            def write(conn):
+                # Set now so the timeline the first feed page builds isn't pruned as idle
+                conn.execute('UPDATE users SET last_active = CURRENT_TIMESTAMP WHERE id = ?', (user_id,))
+            writer.run(write)
             return redirect(url_for('index'))
         else:
             flash('Identifiants incorrects.')
 
     return render_template('login.html')
 
-@app.route('/register', methods=('GET', 'POST'))
+@views.route('/register', methods=('GET', 'POST'))
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -277,30 +336,32 @@ def register():
             hashed_pw = generate_password_hash(password)
             default_pfp = 'https://i.pinimg.com/736x/9e/83/75/9e837528f01cf3f42119c5aeeed1b336.jpg' # Global default
             
-            conn.execute('''
-                INSERT INTO users (username, password, role, display_name, profile_picture) 
-                VALUES (?, ?, 'user', ?, ?)
-            ''', (username, hashed_pw, display_name, default_pfp))
-            conn.commit()
-            conn.close()
+            def write(conn):
+                conn.execute('''
+                    INSERT INTO users (username, password, role, display_name, profile_picture) 
+                    VALUES (?, ?, 'user', ?, ?)
+                ''', (username, hashed_pw, display_name, default_pfp))
+            writer.run(write)
             flash('Compte créé avec succès ! Connecte-toi 💖')
             return redirect(url_for('login'))
             
-        conn.close()
         
     return render_template('register.html')
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     if 'user_id' in session:
-        conn = get_db_connection()
-        conn.execute('UPDATE users SET last_active = NULL WHERE id = ?', (session['user_id'],))
-        conn.commit()
-        conn.close()
+        # Forget pending activity first so no flush, even one under way, brings the user back online
+        user_id = session['user_id']
+        presence.forget(user_id)
+
+        def write(conn):
+            conn.execute('UPDATE users SET last_active = NULL WHERE id = ?', (user_id,))
+        writer.run(write)
     session.clear()
     return redirect(url_for('index'))
 
-@app.route('/edit_profile', methods=('GET', 'POST'))
+@views.route('/edit_profile', methods=('GET', 'POST'))
 def edit_profile():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -324,105 +385,79 @@ def edit_profile():
         elif not new_username:
             flash('Le nom d\'utilisateur ne peut pas être vide.')
         else:
-            conn.execute('''
-                UPDATE users 
-                SET username = ?, display_name = ?, bio = ?, profile_picture = ?, music_link = ?, status_note = ?
-                WHERE id = ?
-            ''', (new_username, display_name, bio, profile_picture, music_link, status_note, session['user_id']))
-            conn.commit()
+            user_id = session['user_id']
+
+            def write(conn):
+                conn.execute('''
+                    UPDATE users 
+                    SET username = ?, display_name = ?, bio = ?, profile_picture = ?, music_link = ?, status_note = ?
+                    WHERE id = ?
+                ''', (new_username, display_name, bio, profile_picture, music_link, status_note, user_id))
+                fragments.invalidate_user(conn, user_id)
+                caching.content_changed(conn)
+            writer.run(write)
             
             # Update session in case username changed
             session['username'] = new_username
             flash('Profil mis à jour ! ✨')
             return redirect(url_for('index'))
             
-    conn.close()
     return render_template('edit_profile.html', user=user)
 
-@app.route('/user/<username>')
+@views.route('/user/<username>')
+@caching.conditional(page_viewer)
 def public_profile(username):
     conn = get_db_connection()
     target_user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
     
     if not target_user:
-        conn.close()
         flash('Utilisateur introuvable.')
         return redirect(url_for('index'))
         
     target_user_dict = dict(target_user)
-    target_user_dict['status'] = get_user_status(target_user_dict.get('last_active'))
+    target_user_dict['status'] = get_user_status(target_user_dict.get('last_active'), target_user_dict['id'])
     
     # Check relationship if user is logged in
     relationship = None
-    if 'user_id' in session:
-        current_user_id = session['user_id']
-        target_id = target_user['id']
-        
-        if current_user_id != target_id:
-            # Check if blocked
-            block = conn.execute('SELECT * FROM blocks WHERE blocker_id = ? AND blocked_id = ?', 
-                                 (current_user_id, target_id)).fetchone()
-            is_blocked_by_me = bool(block)
-            
-            # Check if I am blocked by them
-            blocked_by_them = conn.execute('SELECT * FROM blocks WHERE blocker_id = ? AND blocked_id = ?', 
-                                           (target_id, current_user_id)).fetchone()
-                                           
-            if blocked_by_them:
-                conn.close()
-                flash('Vous ne pouvez pas voir ce profil.')
-                return redirect(url_for('index'))
-                
-            # Check friendship status
-            friend_request = conn.execute('''
-                SELECT * FROM friends 
-                WHERE (sender_id = ? AND receiver_id = ?) 
-                   OR (sender_id = ? AND receiver_id = ?)
-            ''', (current_user_id, target_id, target_id, current_user_id)).fetchone()
-            
-            if friend_request:
-                if friend_request['status'] == 'accepted':
-                    relationship = 'friends'
-                elif friend_request['sender_id'] == current_user_id:
-                    relationship = 'request_sent'
-                else:
-                    relationship = 'request_received'
-            else:
-                relationship = 'none'
-                
-            if is_blocked_by_me:
-                relationship = 'blocked'
-    
-    # Fetch user's posts
-    if relationship == 'friends' or ('user_id' in session and session['user_id'] == target_user['id']):
-        # Friends or self: see public and friends posts
-        posts_data = conn.execute('''
-            SELECT posts.id, posts.content, posts.post_type, posts.visibility, posts.image_url, posts.created_at, posts.author_id,
-                   users.username, users.display_name, users.profile_picture 
-            FROM posts 
-            JOIN users ON posts.author_id = users.id 
-            WHERE users.id = ?
-              AND (posts.visibility = 'public' OR posts.visibility = 'friends')
-            ORDER BY posts.created_at DESC
-        ''', (target_user['id'],)).fetchall()
-    else:
-        # Non-friends: see only public posts
-        posts_data = conn.execute('''
-            SELECT posts.id, posts.content, posts.post_type, posts.visibility, posts.image_url, posts.created_at, posts.author_id,
-                   users.username, users.display_name, users.profile_picture 
-            FROM posts 
-            JOIN users ON posts.author_id = users.id 
-            WHERE users.id = ?
-              AND posts.visibility = 'public'
-            ORDER BY posts.created_at DESC
-        ''', (target_user['id'],)).fetchall()
-    
-    posts = [dict(p) for p in posts_data]
-    
-    conn.close()
-    return render_template('public_profile.html', user=target_user_dict, posts=posts, relationship=relationship)
-
-@app.route('/add_friend/<int:target_id>', methods=['POST'])
+    if 'user_id' in session and session['user_id'] != target_user['id']:
+        relationship = get_relationship(conn, session['user_id'], target_user['id'])
+        if relationship == 'blocked_by_them':
+            flash('Vous ne pouvez pas voir ce profil.')
+            return redirect(url_for('index'))
+    
+    # Fetch user's posts: friends or self also see friends-only posts
+    include_friends = relationship == 'friends' or session.get('user_id') == target_user['id']
+    cursor = decode_cursor(request.args.get('cursor'))
+    posts_data, next_cursor = fetch_profile_page(conn, target_user['id'], include_friends, cursor)
+    posts = fragments.render_posts(conn, posts_data, '_profile_post.html', get_user_status, with_comments=False)
+    
+    return render_template('public_profile.html', user=target_user_dict, posts=posts, relationship=relationship,
+                           next_cursor=next_cursor, more_url=url_for('public_profile', username=username, cursor=next_cursor),
+                           fragment_url=url_for('profile_feed_fragment', username=username, cursor=next_cursor))
+
+@views.route('/user/<username>/feed')
+@caching.conditional(page_viewer)
+def profile_feed_fragment(username):
+    """Next page of a profile's posts as an HTML fragment, for the infinite scroll."""
+    conn = get_db_connection()
+    target_user = conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone()
+    if not target_user:
+        return jsonify(error='Utilisateur introuvable.'), 404
+    
+    relationship = None
+    if 'user_id' in session and session['user_id'] != target_user['id']:
+        relationship = get_relationship(conn, session['user_id'], target_user['id'])
+        if relationship == 'blocked_by_them':
+            return jsonify(error='Vous ne pouvez pas voir ce profil.'), 403
+    
+    include_friends = relationship == 'friends' or session.get('user_id') == target_user['id']
+    cursor = decode_cursor(request.args.get('cursor'))
+    posts_data, next_cursor = fetch_profile_page(conn, target_user['id'], include_friends, cursor)
+    posts = fragments.render_posts(conn, posts_data, '_profile_post.html', get_user_status, with_comments=False)
+    html = render_template('_posts_fragment.html', posts=posts)
+    return jsonify(html=html, next_cursor=next_cursor)
+
+@views.route('/add_friend/<int:target_id>', methods=['POST'])
 def add_friend(target_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -433,26 +468,22 @@ def add_friend(target_id):
         
     conn = get_db_connection()
     # Check if already friends or pending
-    existing = conn.execute('''
-        SELECT * FROM friends 
-        WHERE (sender_id = ? AND receiver_id = ?) 
-           OR (sender_id = ? AND receiver_id = ?)
-    ''', (current_user_id, target_id, target_id, current_user_id)).fetchone()
-    
-    if not existing:
-        conn.execute('INSERT INTO friends (sender_id, receiver_id) VALUES (?, ?)', 
-                     (current_user_id, target_id))
-        conn.commit()
+    if not social_graph().has_friend_row(current_user_id, target_id):
+        def write(conn):
+            conn.execute('INSERT INTO friends (sender_id, receiver_id) VALUES (?, ?)', 
+                         (current_user_id, target_id))
+            social_graph_changed(conn, current_user_id, target_id, rebuild_timelines=False)
+        writer.run(write)
+        g.pop('social_graph', None)
         flash('Demande d\'ami envoyée ! 💌')
         
     target_user = conn.execute('SELECT username FROM users WHERE id = ?', (target_id,)).fetchone()
-    conn.close()
     
     if target_user:
         return redirect(url_for('public_profile', username=target_user['username']))
     return redirect(url_for('index'))
 
-@app.route('/accept_friend/<int:target_id>', methods=['POST'])
+@views.route('/accept_friend/<int:target_id>', methods=['POST'])
 def accept_friend(target_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -460,19 +491,21 @@ def accept_friend(target_id):
     current_user_id = session['user_id']
     conn = get_db_connection()
     
-    conn.execute('''
-        UPDATE friends SET status = 'accepted' 
-        WHERE sender_id = ? AND receiver_id = ?
-    ''', (target_id, current_user_id))
+    def write(conn):
+        conn.execute('''
+            UPDATE friends SET status = 'accepted' 
+            WHERE sender_id = ? AND receiver_id = ?
+        ''', (target_id, current_user_id))
+        social_graph_changed(conn, current_user_id, target_id)
     
-    conn.commit()
+    writer.run(write)
+    g.pop('social_graph', None)
     target_user = conn.execute('SELECT username FROM users WHERE id = ?', (target_id,)).fetchone()
-    conn.close()
     
     flash('Demande d\'ami acceptée ! 💖')
     return redirect(url_for('public_profile', username=target_user['username']))
 
-@app.route('/remove_friend/<int:target_id>', methods=['POST'])
+@views.route('/remove_friend/<int:target_id>', methods=['POST'])
 def remove_friend(target_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -480,48 +513,51 @@ def remove_friend(target_id):
     current_user_id = session['user_id']
     conn = get_db_connection()
     
-    conn.execute('''
-        DELETE FROM friends 
-        WHERE (sender_id = ? AND receiver_id = ?) 
-           OR (sender_id = ? AND receiver_id = ?)
-    ''', (current_user_id, target_id, target_id, current_user_id))
+    def write(conn):
+        conn.execute('''
+            DELETE FROM friends 
+            WHERE (sender_id = ? AND receiver_id = ?) 
+               OR (sender_id = ? AND receiver_id = ?)
+        ''', (current_user_id, target_id, target_id, current_user_id))
+        social_graph_changed(conn, current_user_id, target_id)
     
-    conn.commit()
+    writer.run(write)
+    g.pop('social_graph', None)
     target_user = conn.execute('SELECT username FROM users WHERE id = ?', (target_id,)).fetchone()
-    conn.close()
     
     flash('Ami(e) supprimé(e).')
     return redirect(url_for('public_profile', username=target_user['username']))
 
-@app.route('/block_user/<int:target_id>', methods=['POST'])
+@views.route('/block_user/<int:target_id>', methods=['POST'])
 def block_user(target_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
         
     current_user_id = session['user_id']
-    conn = get_db_connection()
     
-    # Remove friendship if exists
-    conn.execute('''
-        DELETE FROM friends 
-        WHERE (sender_id = ? AND receiver_id = ?) 
-           OR (sender_id = ? AND receiver_id = ?)
-    ''', (current_user_id, target_id, target_id, current_user_id))
-    
-    # Add block
-    existing_block = conn.execute('SELECT * FROM blocks WHERE blocker_id = ? AND blocked_id = ?', 
-                                  (current_user_id, target_id)).fetchone()
-    if not existing_block:
-        conn.execute('INSERT INTO blocks (blocker_id, blocked_id) VALUES (?, ?)', 
-                     (current_user_id, target_id))
+    def write(conn):
+        # Remove friendship if exists
+        conn.execute('''
+            DELETE FROM friends 
+            WHERE (sender_id = ? AND receiver_id = ?) 
+               OR (sender_id = ? AND receiver_id = ?)
+        ''', (current_user_id, target_id, target_id, current_user_id))
         
-    conn.commit()
-    conn.close()
+        # Add block
+        existing_block = conn.execute('SELECT * FROM blocks WHERE blocker_id = ? AND blocked_id = ?', 
+                                      (current_user_id, target_id)).fetchone()
+        if not existing_block:
+            conn.execute('INSERT INTO blocks (blocker_id, blocked_id) VALUES (?, ?)', 
+                         (current_user_id, target_id))
+        social_graph_changed(conn, current_user_id, target_id)
+        
+    writer.run(write)
+    g.pop('social_graph', None)
     
     flash('Utilisateur bloqué. 🛑')
     return redirect(url_for('index'))
 
-@app.route('/unblock_user/<int:target_id>', methods=['POST'])
+@views.route('/unblock_user/<int:target_id>', methods=['POST'])
 def unblock_user(target_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -529,17 +565,24 @@ def unblock_user(target_id):
     current_user_id = session['user_id']
     conn = get_db_connection()
     
-    conn.execute('DELETE FROM blocks WHERE blocker_id = ? AND blocked_id = ?', 
-                 (current_user_id, target_id))
+    def write(conn):
+        conn.execute('DELETE FROM blocks WHERE blocker_id = ? AND blocked_id = ?', 
+                     (current_user_id, target_id))
+        social_graph_changed(conn, current_user_id, target_id, rebuild_timelines=False)
     
-    conn.commit()
+    writer.run(write)
+    g.pop('social_graph', None)
     target_user = conn.execute('SELECT username FROM users WHERE id = ?', (target_id,)).fetchone()
-    conn.close()
     
     flash('Utilisateur débloqué.')
     return redirect(url_for('public_profile', username=target_user['username']))
 
-@app.route('/post/new', methods=('GET', 'POST'))
+@views.app_errorhandler(413)
+def upload_too_large(error):
+    flash(f"Image trop lourde ({current_app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)} Mo maximum).")
+    return redirect(url_for('index'))
+
+@views.route('/post/new', methods=('GET', 'POST'))
 def new_post():
     if 'user_id' not in session:
         flash('Vous devez être connecté pour poster.')
@@ -548,115 +591,197 @@ def new_post():
     if request.method == 'POST':
         raw_content = request.form.get('content', '').strip()
         visibility = request.form.get('visibility', 'public')
-        image_url = None
+        image_path = image_url = None
         
         if 'image' in request.files:
             file = request.files['image']
             if file and file.filename != '':
-                filename = secure_filename(file.filename)
-                unique_filename = f"{int(datetime.utcnow().timestamp())}_{filename}"
-                upload_folder = os.path.join(app.root_path, 'static', 'uploads')
-                os.makedirs(upload_folder, exist_ok=True)
-                file_path = os.path.join(upload_folder, unique_filename)
-                file.save(file_path)
-                image_url = url_for('static', filename='uploads/' + unique_filename)
+                # Checked, stripped of its metadata and stored once per distinct content, see uploads.py
+                saved = uploads.save(file, current_app.static_folder)
+                if not saved:
+                    flash("Format d'image non supporté (JPEG, PNG, GIF ou WebP).")
+                    return redirect(url_for('index'))
+                image_path, created = saved
+                image_url = url_for('static', filename=image_path)
+                if created:
+                    metrics.uploaded(os.path.getsize(os.path.join(current_app.static_folder, image_path)))
         
         if not raw_content and not image_url:
             flash('Le contenu ou une image est requis!')
         else:
-            clean_content = ""
-            if raw_content:
-                # Parse mentions FIRST, then Markdown
-                content_with_mentions = parse_mentions(raw_content)
-                html_content = markdown.markdown(content_with_mentions)
-                # Sanitize the HTML
-                clean_content = bleach.clean(html_content, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES)
-
-            conn = get_db_connection()
-            conn.execute('INSERT INTO posts (content, visibility, image_url, author_id) VALUES (?, ?, ?, ?)',
-                         (clean_content, visibility, image_url, session['user_id']))
-            conn.commit()
-            conn.close()
+            clean_content = render_content(get_db_connection(), raw_content)
+            author_id = session['user_id']
+
+            def write(conn):
+                post_id = conn.execute('INSERT INTO posts (content, content_raw, visibility, image_url, author_id) VALUES (?, ?, ?, ?, ?)',
+                                       (clean_content, raw_content, visibility, image_url, author_id)).lastrowid
+                timeline.fan_out(conn, post_id)
+                caching.content_changed(conn)
+            writer.run(write)
+            if image_path:
+                uploads.thumbnails.submit(current_app.static_folder, image_path)
             flash('Post publié avec succès ! ✨')
             return redirect(url_for('index'))
 
     return redirect(url_for('index'))
 
-@app.route('/comment/<int:post_id>', methods=('POST',))
+def is_admin(conn):
+    """Whether the logged in user is an admin, by their current role in the database."""
+    user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
+    return bool(user) and user['role'] == 'admin'
+
+def post_anchor(post_id):
+    """Where to go back after acting on a post: the page it was on, scrolled to the post."""
+    next_url = request.referrer or url_for('index')
+    if '#' in next_url:
+        next_url = next_url.split('#')[0]
+    return next_url + f'#post-{post_id}'
+
+# The writes behind likes and comments, shared by the form routes and their JSON
+# variants. They run on the group commit thread (see groupcommit.py).
+
+def like_write(conn, user_id, item_type, item_id):
+    """Like or unlike a post or comment. Returns (post_id, liked, like count), or None if it doesn't exist."""
+    if item_type == 'post':
+        item = conn.execute('SELECT id AS post_id, like_count FROM posts WHERE id = ?', (item_id,)).fetchone()
+    else:
+        item = conn.execute('SELECT post_id, like_count FROM comments WHERE id = ?', (item_id,)).fetchone()
+    if item is None:
+        return None
+    
+    # Check if already liked
+    existing_like = conn.execute('SELECT id FROM likes WHERE user_id = ? AND item_type = ? AND item_id = ?', 
+                                 (user_id, item_type, item_id)).fetchone()
+                                 
+    if existing_like:
+        # Unlike
+        conn.execute('DELETE FROM likes WHERE id = ?', (existing_like['id'],))
+        delta = -1
+    else:
+        # Like
+        conn.execute('INSERT INTO likes (user_id, item_type, item_id) VALUES (?, ?, ?)', 
+                     (user_id, item_type, item_id))
+        delta = +1
+    counters.like_changed(conn, item_type, item_id, delta)
+    fragments.invalidate_posts(conn, [item['post_id']])
+    caching.content_changed(conn)
+    return item['post_id'], delta > 0, max(item['like_count'] + delta, 0)
+
+def comment_count(conn, post_id):
+    return conn.execute('SELECT comment_count FROM posts WHERE id = ?', (post_id,)).fetchone()['comment_count']
+
+def comment_write(conn, post_id, author_id, clean_content, raw_content):
+    """Add a comment. Returns (comment id, the post's comment count), or None if the post doesn't exist."""
+    if conn.execute('SELECT 1 FROM posts WHERE id = ?', (post_id,)).fetchone() is None:
+        return None
+    comment_id = conn.execute('INSERT INTO comments (post_id, author_id, content, content_raw) VALUES (?, ?, ?, ?)',
+                              (post_id, author_id, clean_content, raw_content)).lastrowid
+    counters.comment_changed(conn, post_id, +1)
+    fragments.invalidate_posts(conn, [post_id])
+    caching.content_changed(conn)
+    return comment_id, comment_count(conn, post_id)
+
+def delete_comment_write(conn, comment_id):
+    """Delete a comment and its likes. Returns (post_id, the post's comment count), or None if it doesn't exist."""
+    comment = conn.execute('SELECT post_id FROM comments WHERE id = ?', (comment_id,)).fetchone()
+    if not comment:
+        return None
+    post_id = comment['post_id']
+    # Use single quotes for string literals to be strictly SQLite safe
+    conn.execute('DELETE FROM likes WHERE item_type = \'comment\' AND item_id = ?', (comment_id,))
+    conn.execute('DELETE FROM comments WHERE id = ?', (comment_id,))
+    counters.comment_changed(conn, post_id, -1)
+    fragments.invalidate_posts(conn, [post_id])
+    caching.content_changed(conn)
+    return post_id, comment_count(conn, post_id)
+
+@views.route('/comment/<int:post_id>', methods=('POST',))
 def add_comment(post_id):
     if 'user_id' not in session:
         flash('Connecte-toi pour commenter !')
         return redirect(url_for('login'))
         
-    content = request.form['content'].strip()
-    if content:
-        # Simple text for comments, maybe allow basic markdown
-        html_content = markdown.markdown(content)
-        clean_content = bleach.clean(html_content, tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES)
-
-        conn = get_db_connection()
-        conn.execute('INSERT INTO comments (post_id, author_id, content) VALUES (?, ?, ?)',
-                     (post_id, session['user_id'], clean_content))
-        conn.commit()
-        conn.close()
+    raw_content = request.form['content'].strip()
+    if raw_content:
+        clean_content = render_content(get_db_connection(), raw_content)
+        writer.run(comment_write, post_id, session['user_id'], clean_content, raw_content)
         
-    next_url = request.referrer or url_for('index')
-    if '#' in next_url:
-        next_url = next_url.split('#')[0]
-    return redirect(next_url + f'#post-{post_id}')
+    return redirect(post_anchor(post_id))
 
-@app.route('/delete_post/<int:post_id>', methods=['POST'])
+@views.route('/comment/<int:post_id>/json', methods=['POST'])
+def add_comment_json(post_id):
+    """Comment without reloading the page. Returns the rendered comment and the new count."""
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi pour commenter !'), 401
+    raw_content = request.form.get('content', '').strip()
+    if not raw_content:
+        return jsonify(error='Commentaire vide.'), 400
+    
+    conn = get_db_connection()
+    clean_content = render_content(conn, raw_content)
+    result = writer.run(comment_write, post_id, session['user_id'], clean_content, raw_content)
+    if result is None:
+        return jsonify(error='Post introuvable.'), 404
+    comment_id, count = result
+    comment = fetch_comment(conn, comment_id)
+    return jsonify(id=comment_id, post_id=post_id, comments=count,
+                   html=fragments.render_comment(conn, comment, get_user_status))
+
+@views.route('/delete_post/<int:post_id>', methods=['POST'])
 def delete_post(post_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
         
     conn = get_db_connection()
-    user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    
-    if user and user['role'] == 'admin':
-        # Use single quotes for string literals to be strictly SQLite safe
-        conn.execute('DELETE FROM likes WHERE item_type = \'post\' AND item_id = ?', (post_id,))
-        # Also clean up likes for comments on this post to avoid orphan rows
-        comments = conn.execute('SELECT id FROM comments WHERE post_id = ?', (post_id,)).fetchall()
-        for c in comments:
-            conn.execute('DELETE FROM likes WHERE item_type = \'comment\' AND item_id = ?', (c['id'],))
-        conn.execute('DELETE FROM comments WHERE post_id = ?', (post_id,))
-        conn.execute('DELETE FROM posts WHERE id = ?', (post_id,))
-        conn.commit()
+    if is_admin(conn):
+        # Needs the app's fragment cache, so here rather than in the write
+        fragments.drop_post(conn, post_id)
+
+        def write(conn):
+            # Use single quotes for string literals to be strictly SQLite safe
+            conn.execute('DELETE FROM likes WHERE item_type = \'post\' AND item_id = ?', (post_id,))
+            # Also clean up likes for comments on this post to avoid orphan rows
+            conn.execute('''
+                DELETE FROM likes WHERE item_type = 'comment'
+                AND item_id IN (SELECT id FROM comments WHERE post_id = ?)
+            ''', (post_id,))
+            conn.execute('DELETE FROM comments WHERE post_id = ?', (post_id,))
+            conn.execute('DELETE FROM posts WHERE id = ?', (post_id,))
+            timeline.remove_post(conn, post_id)
+            caching.content_changed(conn)
+        writer.run(write)
         flash('Post supprimé 🗑️')
             
-    conn.close()
     return redirect(request.referrer or url_for('index'))
 
-@app.route('/delete_comment/<int:comment_id>', methods=['POST'])
+@views.route('/delete_comment/<int:comment_id>', methods=['POST'])
 def delete_comment(comment_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
         
-    conn = get_db_connection()
-    user = conn.execute('SELECT role FROM users WHERE id = ?', (session['user_id'],)).fetchone()
-    
-    if user and user['role'] == 'admin':
-        comment = conn.execute('SELECT post_id FROM comments WHERE id = ?', (comment_id,)).fetchone()
-        if comment:
-            post_id = comment['post_id']
-            # Use single quotes for string literals to be strictly SQLite safe
-            conn.execute('DELETE FROM likes WHERE item_type = \'comment\' AND item_id = ?', (comment_id,))
-            conn.execute('DELETE FROM comments WHERE id = ?', (comment_id,))
-            conn.commit()
-            conn.close()
+    if is_admin(get_db_connection()):
+        result = writer.run(delete_comment_write, comment_id)
+        if result:
             flash('Commentaire supprimé 🗑️')
+            return redirect(post_anchor(result[0]))
             
-            # Use request.referrer but append the anchor tag
-            next_url = request.referrer or url_for('index')
-            if '#' in next_url:
-                next_url = next_url.split('#')[0]
-            return redirect(next_url + f'#post-{post_id}')
-            
-    conn.close()
     return redirect(request.referrer or url_for('index'))
 
-@app.route('/like/<item_type>/<int:item_id>', methods=('POST',))
+@views.route('/delete_comment/<int:comment_id>/json', methods=['POST'])
+def delete_comment_json(comment_id):
+    """Delete a comment (admins) without reloading the page. Returns the post's new comment count."""
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+    if not is_admin(get_db_connection()):
+        return jsonify(error='Réservé aux admins.'), 403
+    
+    result = writer.run(delete_comment_write, comment_id)
+    if result is None:
+        return jsonify(error='Commentaire introuvable.'), 404
+    post_id, count = result
+    return jsonify(id=comment_id, post_id=post_id, comments=count)
+
+@views.route('/like/<item_type>/<int:item_id>', methods=('POST',))
 def toggle_like(item_type, item_id):
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -664,37 +789,27 @@ def toggle_like(item_type, item_id):
     if item_type not in ['post', 'comment']:
         return redirect(request.referrer or url_for('index'))
         
-    conn = get_db_connection()
-    user_id = session['user_id']
-    
-    # Check if already liked
-    existing_like = conn.execute('SELECT id FROM likes WHERE user_id = ? AND item_type = ? AND item_id = ?', 
-                                 (user_id, item_type, item_id)).fetchone()
-                                 
-    if existing_like:
-        # Unlike
-        conn.execute('DELETE FROM likes WHERE id = ?', (existing_like['id'],))
-    else:
-        # Like
-        conn.execute('INSERT INTO likes (user_id, item_type, item_id) VALUES (?, ?, ?)', 
-                     (user_id, item_type, item_id))
-                     
-    conn.commit()
+    result = writer.run(like_write, session['user_id'], item_type, item_id)
+    if result is None:
+        return redirect(request.referrer or url_for('index'))
+    return redirect(post_anchor(result[0]))
+
+@views.route('/like/<item_type>/<int:item_id>/json', methods=['POST'])
+def toggle_like_json(item_type, item_id):
+    """Like or unlike without reloading the page. Returns whether it's liked now and the new count."""
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+    if item_type not in ['post', 'comment']:
+        return jsonify(error='Rien à liker ici.'), 404
     
-    next_url = request.referrer or url_for('index')
-    if '#' in next_url:
-        next_url = next_url.split('#')[0]
-        
-    if item_type == 'comment':
-        post_id = conn.execute('SELECT post_id FROM comments WHERE id = ?', (item_id,)).fetchone()['post_id']
-        conn.close()
-        return redirect(next_url + f'#post-{post_id}')
-        
-    conn.close()
-    return redirect(next_url + f'#post-{item_id}')
+    result = writer.run(like_write, session['user_id'], item_type, item_id)
+    if result is None:
+        return jsonify(error='Introuvable.'), 404
+    post_id, liked, count = result
+    return jsonify(post_id=post_id, liked=liked, likes=count)
 
-@app.route('/messages', defaults={'chat_username': None}, methods=('GET', 'POST'))
-@app.route('/messages/<chat_username>', methods=('GET', 'POST'))
+@views.route('/messages', defaults={'chat_username': None}, methods=('GET', 'POST'))
+@views.route('/messages/<chat_username>', methods=('GET', 'POST'))
 def messages(chat_username):
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -702,37 +817,17 @@ def messages(chat_username):
     conn = get_db_connection()
     user_id = session['user_id']
     
-    # Fetch friend list for the sidebar
-    friends_data = conn.execute('''
-        SELECT u.id, u.username, u.display_name, u.profile_picture, u.last_active,
-               (SELECT content FROM messages 
-                WHERE (sender_id = u.id AND receiver_id = ?) 
-                   OR (sender_id = ? AND receiver_id = u.id) 
-                ORDER BY created_at DESC LIMIT 1) as last_message,
-               (SELECT created_at FROM messages 
-                WHERE (sender_id = u.id AND receiver_id = ?) 
-                   OR (sender_id = ? AND receiver_id = u.id) 
-                ORDER BY created_at DESC LIMIT 1) as last_activity,
-               (SELECT COUNT(id) FROM messages 
-                WHERE sender_id = u.id AND receiver_id = ? AND is_read = 0) as unread_count
-        FROM users u
-        JOIN friends f ON (f.sender_id = ? AND f.receiver_id = u.id) 
-                       OR (f.sender_id = u.id AND f.receiver_id = ?)
-        WHERE f.status = 'accepted'
-    ''', (user_id, user_id, user_id, user_id, user_id, user_id, user_id)).fetchall()
-    
+    # Friend list for the sidebar, most recent conversation first
     friends = []
-    for f in friends_data:
+    for f in conversations.conversation_list(conn, user_id):
         f_dict = dict(f)
-        f_dict['status'] = get_user_status(f_dict.get('last_active'))
+        f_dict['status'] = get_user_status(f_dict.get('last_active'), f_dict['id'])
         friends.append(f_dict)
-        
-    # Sort by recent message activity (newest first)
-    friends.sort(key=lambda x: (x['last_activity'] or ''), reverse=True)
     
     active_chat_user = None
     chat_messages = []
     my_settings = {}
+    older = None
     search_query = request.args.get('q', '').strip()
     
     if chat_username:
@@ -740,31 +835,18 @@ def messages(chat_username):
         
         if active_chat_user:
             active_chat_user_dict = dict(active_chat_user)
-            active_chat_user_dict['status'] = get_user_status(active_chat_user_dict.get('last_active'))
+            active_chat_user_dict['status'] = get_user_status(active_chat_user_dict.get('last_active'), active_chat_user_dict['id'])
             
             # Verify friendship to allow chatting
-            is_friend = any(f['id'] == active_chat_user['id'] for f in friends)
+            is_friend = social_graph().are_friends(user_id, active_chat_user['id'])
             
             if not is_friend:
                 flash("Vous ne pouvez discuter qu'avec vos amis.")
                 return redirect(url_for('messages'))
                 
-            # --- V7: conversation settings ---
-            # My settings
-            my_settings = conn.execute('SELECT * FROM conversation_settings WHERE user_id = ? AND friend_id = ?', (user_id, active_chat_user['id'])).fetchone()
-            if not my_settings:
-                conn.execute('INSERT INTO conversation_settings (user_id, friend_id) VALUES (?, ?)', (user_id, active_chat_user['id']))
-                conn.commit()
-                my_settings = conn.execute('SELECT * FROM conversation_settings WHERE user_id = ? AND friend_id = ?', (user_id, active_chat_user['id'])).fetchone()
-            my_settings = dict(my_settings)
-
-            # Their settings
-            their_settings = conn.execute('SELECT * FROM conversation_settings WHERE user_id = ? AND friend_id = ?', (active_chat_user['id'], user_id)).fetchone()
-            if not their_settings:
-                conn.execute('INSERT INTO conversation_settings (user_id, friend_id) VALUES (?, ?)', (active_chat_user['id'], user_id))
-                conn.commit()
-                their_settings = conn.execute('SELECT * FROM conversation_settings WHERE user_id = ? AND friend_id = ?', (active_chat_user['id'], user_id)).fetchone()
-            their_settings = dict(their_settings)
+            # --- V7: conversation settings (defaults when never saved, nothing written here) ---
+            my_settings = conversation_settings().get(conn, user_id, active_chat_user['id'])._asdict()
+            their_settings = conversation_settings().get(conn, active_chat_user['id'], user_id)._asdict()
 
             # Resolve nickname
             if my_settings.get('nickname'):
@@ -776,49 +858,136 @@ def messages(chat_username):
             if request.method == 'POST':
                 content = request.form.get('content', '').strip()
                 if content:
-                    clean_content = bleach.clean(content)
-                    conn.execute('INSERT INTO messages (sender_id, receiver_id, content) VALUES (?, ?, ?)',
-                                 (user_id, active_chat_user['id'], clean_content))
-                    conn.commit()
+                    send_message(conn, active_chat_user, content)
                     return redirect(url_for('messages', chat_username=chat_username))
             
-            # Mark messages as read
-            conn.execute('UPDATE messages SET is_read = 1 WHERE sender_id = ? AND receiver_id = ? AND is_read = 0',
-                         (active_chat_user['id'], user_id))
-            conn.commit()
-            
-            # Fetch conversation
-            query = '''
-                SELECT m.*, u.username as sender_name, u.profile_picture as sender_pfp
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE ((m.sender_id = ? AND m.receiver_id = ?) 
-                   OR (m.sender_id = ? AND m.receiver_id = ?))
-            '''
-            params = [user_id, active_chat_user['id'], active_chat_user['id'], user_id]
-
-            if ephemeral:
-                query += " AND m.created_at >= datetime('now', '-1 day')"
+            # Mark messages as read (no write at all when nothing is waiting)
+            if writer.run(conversations.mark_read, user_id, active_chat_user['id']):
+                push_read(conn, user_id, active_chat_user['id'])
             
+            before = request.args.get('before', type=int)
             if search_query:
-                query += " AND m.content LIKE ?"
-                params.append(f'%{search_query}%')
-                
-            query += " ORDER BY m.created_at ASC"
-            
-            messages_data = conn.execute(query, params).fetchall()
-            chat_messages = [dict(m) for m in messages_data]
+                # Ranked full-text matches with highlighted snippets
+                chat_messages = search.search_messages(conn, user_id, active_chat_user['id'], search_query, ephemeral)
+            else:
+                # Latest page of the conversation ("load older" fetches the rest on demand)
+                chat_messages, older = conversations.fetch_history(conn, user_id, active_chat_user['id'], before, ephemeral)
             
-            if chat_messages and their_settings.get('show_read_receipts'):
+            if chat_messages and before is None and not search_query and their_settings.get('show_read_receipts'):
                 last_msg = chat_messages[-1]
                 if last_msg['sender_id'] == user_id and last_msg['is_read']:
                     last_msg['show_vu'] = True
             
-    conn.close()
     
-    return render_template('messages.html', friends=friends, active_chat_user=active_chat_user, messages=chat_messages, my_settings=my_settings, search_query=search_query)
+    return render_template('messages.html', friends=friends, active_chat_user=active_chat_user, messages=chat_messages, my_settings=my_settings, search_query=search_query, older=older)
+
+def send_message(conn, receiver, content):
+    """Store a message from the current user, then push it to both users' open tabs."""
+    sender = {'id': session['user_id'], 'username': session['username']}
+    clean_content = bleach.clean(content)
+
+    def write(conn):
+        message_id = conn.execute('INSERT INTO messages (sender_id, receiver_id, content) VALUES (?, ?, ?)',
+                                  (sender['id'], receiver['id'], clean_content)).lastrowid
+        conversations.message_sent(conn, sender['id'], receiver['id'], message_id)
+        return message_id
+    message_id = writer.run(write)
+    metrics.message_sent()
 
-@app.route('/messages/<chat_username>/settings', methods=['POST'])
+    message = conversations.fetch_message(conn, message_id)
+    # Each side gets the bubble rendered from its own point of view
+    for viewer, other in ((sender, receiver), (receiver, sender)):
+        html = render_template('_message.html', msg=message, viewer_id=viewer['id'], active_chat_user=other)
+        events.publish(viewer['id'], 'message', {'id': message_id, 'chat': other['username'],
+                                                 'incoming': viewer is receiver, 'html': html})
+    events.publish(receiver['id'], 'unread', {'count': counters.unread_total(conn, receiver['id'])})
+    return message
+
+def push_read(conn, reader_id, sender_id):
+    """After reader_id read sender_id's messages: update the reader's badge, show "Vu" to the sender."""
+    events.publish(reader_id, 'unread', {'count': counters.unread_total(conn, reader_id)})
+    if conversation_settings().get(conn, reader_id, sender_id).show_read_receipts:
+        events.publish(sender_id, 'read', {'chat': session['username']})
+
+def chat_partner(conn, chat_username):
+    """The friend the current user is chatting with, or None if they can't chat."""
+    other = conn.execute('SELECT id, username, display_name FROM users WHERE username = ?', (chat_username,)).fetchone()
+    if not other or get_relationship(conn, session['user_id'], other['id']) != 'friends':
+        return None
+    return dict(other)
+
+@views.route('/events')
+def event_stream():
+    """Server-Sent Events stream of the current user's live events (see events.py)."""
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+    user_id = session['user_id']
+    # Not wrapped in stream_with_context: the request, and its pooled DB connection,
+    # end before streaming starts. An open stream counts as activity for the status dot.
+    return Response(events.stream(user_id, on_idle=functools.partial(presence.touch, user_id)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@views.route('/unread')
+def unread_count():
+    """The unread messages badge, for a tab that refreshes it without reloading the page."""
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+    return jsonify(count=counters.unread_total(get_db_connection(), session['user_id']))
+
+@views.route('/messages/<chat_username>/send', methods=['POST'])
+def send_message_json(chat_username):
+    """Send a message without reloading the chat. Returns the rendered bubble."""
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+        
+    conn = get_db_connection()
+    other = chat_partner(conn, chat_username)
+    if not other:
+        return jsonify(error="Vous ne pouvez discuter qu'avec vos amis."), 403
+    content = request.form.get('content', '').strip()
+    if not content:
+        return jsonify(error='Message vide.'), 400
+    
+    message = send_message(conn, other, content)
+    return jsonify(id=message['id'], html=render_template('_message.html', msg=message, active_chat_user=other))
+
+@views.route('/messages/<chat_username>/read', methods=['POST'])
+def mark_read_json(chat_username):
+    """Called by an open chat when a message arrives over the event stream."""
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+        
+    conn = get_db_connection()
+    other = chat_partner(conn, chat_username)
+    if not other:
+        return jsonify(error="Vous ne pouvez discuter qu'avec vos amis."), 403
+    
+    read = writer.run(conversations.mark_read, session['user_id'], other['id'])
+    if read:
+        push_read(conn, session['user_id'], other['id'])
+    return jsonify(read=read)
+
+@views.route('/messages/<chat_username>/history')
+def message_history(chat_username):
+    """Older messages of a conversation as an HTML fragment, for the "load older" button."""
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+        
+    conn = get_db_connection()
+    user_id = session['user_id']
+    other = chat_partner(conn, chat_username)
+    if not other:
+        return jsonify(error="Vous ne pouvez discuter qu'avec vos amis."), 403
+    
+    ephemeral = conversation_settings().ephemeral(conn, user_id, other['id'])
+    chat_messages, older = conversations.fetch_history(conn, user_id, other['id'], request.args.get('before', type=int),
+                                                       ephemeral)
+    
+    html = render_template('_messages_fragment.html', messages=chat_messages, active_chat_user=other)
+    return jsonify(html=html, older=older)
+
+@views.route('/messages/<chat_username>/settings', methods=['POST'])
 def update_conversation_settings(chat_username):
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -827,30 +996,72 @@ def update_conversation_settings(chat_username):
     user_id = session['user_id']
     friend = conn.execute('SELECT id FROM users WHERE username = ?', (chat_username,)).fetchone()
     if not friend:
-        conn.close()
         return redirect(url_for('messages'))
         
     nickname = request.form.get('nickname', '').strip()
     show_read_receipts = 1 if request.form.get('show_read_receipts') else 0
     ephemeral_mode = 1 if request.form.get('ephemeral_mode') else 0
     
-    settings = conn.execute('SELECT id FROM conversation_settings WHERE user_id = ? AND friend_id = ?', (user_id, friend['id'])).fetchone()
-    if settings:
-        conn.execute('''
-            UPDATE conversation_settings
-            SET nickname = ?, show_read_receipts = ?, ephemeral_mode = ?
-            WHERE id = ?
-        ''', (nickname if nickname else None, show_read_receipts, ephemeral_mode, settings['id']))
-    else:
-        conn.execute('''
-            INSERT INTO conversation_settings (user_id, friend_id, nickname, show_read_receipts, ephemeral_mode)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (user_id, friend['id'], nickname if nickname else None, show_read_receipts, ephemeral_mode))
-        
-    conn.commit()
-    conn.close()
+    writer.run(settings.save, user_id, friend['id'], nickname, show_read_receipts, ephemeral_mode)
+    settings.store.forget(user_id, friend['id'])
     flash('Paramètres de discussion mis à jour !')
     return redirect(url_for('messages', chat_username=chat_username))
 
+@views.cli.command('rebuild-counters')
+def rebuild_counters_command():
+    """Recompute the denormalized like/comment/unread counters and conversation summaries."""
+    conn = get_db_connection()
+    repaired = counters.rebuild_counters(conn) + conversations.rebuild_conversations(conn)
+    conn.commit()
+    print(f"Counters rebuilt ({repaired} drifted rows repaired).")
+
+@views.cli.command('backfill-search')
+def backfill_search_command():
+    """Rebuild the full-text message search index from the messages table."""
+    conn = get_db_connection()
+    indexed = backfill_message_search(conn)
+    conn.commit()
+    print(f"Search index rebuilt ({indexed} messages indexed).")
+
+@views.cli.command('purge-expired')
+def purge_expired_command():
+    """Delete the expired messages of ephemeral conversations (same job as the background worker)."""
+    purged = expiry.worker.run_once()
+    print(f"Expired messages purged ({purged} deleted).")
+
+@views.cli.command('import-uploads')
+def import_uploads_command():
+    """Move images uploaded before content-addressed storage into it and make their thumbnails."""
+    conn = get_db_connection()
+    updated = uploads.import_legacy(conn, current_app.static_folder, current_app.static_url_path)
+    fragments.invalidate_all(conn)
+    caching.content_changed(conn)
+    conn.commit()
+    print(f"Uploads imported ({updated} posts updated, thumbnails are being made).")
+    uploads.thumbnails.shutdown()
+
+@views.cli.command('rebuild-timelines')
+def rebuild_timelines_command():
+    """Drop the timelines of inactive users and rebuild the others from the posts table."""
+    conn = get_db_connection()
+    pruned = timeline.prune_inactive(conn)
+    users = [row['user_id'] for row in conn.execute('SELECT user_id FROM timeline_state')]
+    for user_id in users:
+        timeline.rebuild(conn, user_id)
+    conn.commit()
+    print(f"Timelines rebuilt ({len(users)} rebuilt, {pruned} inactive dropped).")
+
+@views.cli.command('rerender-content')
+def rerender_content_command():
+    """Re-render stored posts and comments from their Markdown source (after changing the rules)."""
+    conn = get_db_connection()
+    # url_for needs a request context to build the profile links
+    with current_app.test_request_context():
+        changed = content.rerender_all(conn, profile_url)
+    fragments.invalidate_all(conn)
+    caching.content_changed(conn)
+    conn.commit()
+    print(f"Content re-rendered ({changed} posts and comments changed).")
+
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app({'DEBUG': True}).run()
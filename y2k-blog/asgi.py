@@ -0,0 +1,403 @@
+import asyncio
+import contextlib
+import functools
+import io
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import flash, jsonify, redirect, request, session, url_for
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+
+import conversations
+import events
+import settings
+import sqlstats
+import warmup
+from app import create_app
+from db import PRAGMAS
+from groupcommit import writer
+from presence import tracker as presence
+
+# ASGI serving mode: `uvicorn asgi:application` (or any ASGI server).
+#
+# The messaging endpoints a chat tab keeps open or keeps calling run as
+# coroutines: the /events stream, the unread badge, "mark as read" and the
+# conversation settings. They read through aiosqlite, whose few connections
+# each run their queries on one thread, and hand their writes to the group
+# commit thread (see groupcommit.py) without blocking. An idle tab then costs a
+# coroutine instead of a worker thread. Every other route goes to the Flask app
+# on a bounded thread pool, so it works the same in both modes.
+#
+# The coroutines run in a request context of the Flask app, with all its hooks:
+# before_request (presence, metrics timer, SQL stats, expiry worker),
+# after_request (session cookie, Cache-Control, Server-Timing, metrics) and
+# teardown. The hooks are synchronous and run on the event loop, so they must
+# stay quick. The views use flask.request, session, flash, url_for... as usual.
+#
+# Needs the aiosqlite package and an ASGI server (uvicorn, hypercorn...).
+
+try:
+    import aiosqlite
+except ImportError:
+    aiosqlite = None
+
+# aiosqlite connections, each with its own thread
+ASYNC_POOL_SIZE = 4
+# Threads running the Flask routes
+WSGI_THREADS = 32
+
+ASYNC_VIEWS = {}
+
+
+def async_view(endpoint):
+    """Serve the Flask endpoint `endpoint` with this coroutine in the ASGI mode: `view(server, **arguments)`."""
+    def register(view):
+        ASYNC_VIEWS[endpoint] = view
+        return view
+    return register
+
+
+class AsyncPool:
+    """aiosqlite connections shared by the coroutines of one event loop, opened on demand."""
+
+    def __init__(self, path, size=ASYNC_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.opened = 0
+        self._all = []
+        self._idle = None
+
+    async def acquire(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+        if self._idle.empty() and self.opened < self.size:
+            self.opened += 1
+            try:
+                conn = await aiosqlite.connect(self.path, timeout=5)
+                conn.row_factory = sqlite3.Row
+                for pragma in PRAGMAS:
+                    await conn.execute(pragma)
+            except Exception:
+                self.opened -= 1
+                raise
+            self._all.append(conn)
+            return conn
+        return await self._idle.get()
+
+    def release(self, conn):
+        self._idle.put_nowait(conn)
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        conn = await self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    async def fetchone(self, sql, parameters=()):
+        async with self.connection() as conn:
+            start = time.perf_counter()
+            async with conn.execute(sql, parameters) as cursor:
+                row = await cursor.fetchone()
+        # aiosqlite runs it on a thread of its own: report it to the request's stats from here
+        stats = sqlstats.current()
+        if stats is not None:
+            record = stats.executed(sql, parameters, time.perf_counter() - start)
+            if record is not None:
+                stats.fetched(record, int(row is not None), 0.0)
+        return row
+
+    async def close(self):
+        for conn in self._all:
+            await conn.close()
+        self._all, self._idle, self.opened = [], None, 0
+
+
+class Stream:
+    """A streamed response: `body` is an async iterator of str."""
+
+    def __init__(self, body, mimetype, headers=()):
+        self.body = body
+        self.mimetype = mimetype
+        self.headers = list(headers)
+
+
+class Application:
+    """The ASGI application: the views of ASYNC_VIEWS as coroutines, everything else through the Flask app."""
+
+    def __init__(self, flask_app):
+        if aiosqlite is None:
+            raise RuntimeError('The ASGI mode needs the aiosqlite package (pip install aiosqlite)')
+        self.app = flask_app
+        self.db = AsyncPool(flask_app.config['DATABASE'], flask_app.config.setdefault('ASYNC_POOL_SIZE', ASYNC_POOL_SIZE))
+        self.executor = ThreadPoolExecutor(flask_app.config.setdefault('WSGI_THREADS', WSGI_THREADS),
+                                           thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        try:
+            body = await read_body(scope, receive, self.app.config['MAX_CONTENT_LENGTH'])
+        except RequestEntityTooLarge as error:
+            # Answered by the app's 413 handler, with what was read so far thrown away
+            with self.app.request_context(build_environ(scope, io.BytesIO())):
+                response = self.app.finalize_request(self.app.handle_user_exception(error))
+            return await send_response(response, send)
+        environ = build_environ(scope, body)
+        adapter = self.app.url_map.bind_to_environ(environ)
+        try:
+            endpoint, arguments = adapter.match()
+        except HTTPException:
+            endpoint, arguments = None, {}
+        view = ASYNC_VIEWS.get(endpoint)
+        if view is None:
+            return await self.call_flask(environ, send)
+
+        stream = None
+        error = None
+        # What Flask.wsgi_app and full_dispatch_request do, with the view awaited
+        ctx = self.app.request_context(environ)
+        ctx.push()
+        try:
+            try:
+                rv = self.app.preprocess_request()
+                if rv is None:
+                    rv = await view(self, **arguments)
+            except Exception as e:
+                rv = self.app.handle_user_exception(e)
+            if isinstance(rv, Stream):
+                # The after_request hooks see (and add to) the headers; the body is sent afterwards
+                stream, rv = rv, self.app.response_class(mimetype=rv.mimetype, headers=rv.headers)
+            response = self.app.finalize_request(rv)
+        except Exception as e:
+            # Not handled by the app: logged, got_request_exception sent, and a 500 for the client
+            error = e
+            stream = None
+            response = self.app.handle_exception(e)
+        finally:
+            ctx.pop(error)
+        if stream is None:
+            await send_response(response, send)
+        else:
+            await self.send_stream(stream, response, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.db.close()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def call_flask(self, environ, send):
+        """Run the Flask app for this request on the thread pool."""
+        def run():
+            started = {}
+
+            def start_response(status, headers, exc_info=None):
+                started['status'] = int(status.split(' ', 1)[0])
+                started['headers'] = headers
+
+            result = self.app(environ, start_response)
+            try:
+                # Only the event stream streams, and it's an async view here
+                content = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            return started['status'], started['headers'], content
+
+        status, headers, content = await asyncio.get_running_loop().run_in_executor(self.executor, run)
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(k.lower().encode('latin1'), v.encode('latin1')) for k, v in headers]})
+        await send({'type': 'http.response.body', 'body': content})
+
+    async def send_stream(self, stream, response, receive, send):
+        """Send `response`'s status and headers, then the body of `stream` until the client goes away."""
+        await send({'type': 'http.response.start', 'status': response.status_code,
+                    'headers': [(k.lower().encode('latin1'), v.encode('latin1'))
+                                for k, v in response.headers.to_wsgi_list()]})
+
+        async def pump():
+            async for chunk in stream.body:
+                await send({'type': 'http.response.body', 'body': chunk.encode(), 'more_body': True})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        tasks = [asyncio.ensure_future(pump()), asyncio.ensure_future(disconnected())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Unsubscribes the stream (its `finally`), if the cancelled pump didn't already
+            await stream.body.aclose()
+
+    # Helpers of the async views
+
+    async def chat_partner(self, user_id, chat_username):
+        """app.chat_partner: the friend the user is chatting with, or None if they can't chat."""
+        other = await self.db.fetchone('SELECT id, username, display_name FROM users WHERE username = ?',
+                                       (chat_username,))
+        if other is None:
+            return None
+        # Blocking removes the friendship, so an accepted row is enough
+        friends = await self.db.fetchone('''
+            SELECT 1 FROM friends
+            WHERE status = 'accepted' AND ((sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?))
+        ''', (user_id, other['id'], other['id'], user_id))
+        return dict(other) if friends else None
+
+    async def conversation_settings(self, user_id, friend_id):
+        """settings.store.get, reading through aiosqlite."""
+        row = await self.db.fetchone(settings.VERSION_SQL, (settings.VERSION_KEY,))
+        store = settings.store.at_version(row[0] if row else 0)
+        cached = store.cached(user_id, friend_id)
+        if cached is not None:
+            return cached
+        version = store.version
+        row = await self.db.fetchone(settings.SETTINGS_SQL, (user_id, friend_id))
+        return store.remember((user_id, friend_id), row, version)
+
+    async def unread_total(self, user_id):
+        row = await self.db.fetchone('SELECT unread_count FROM users WHERE id = ?', (user_id,))
+        return row['unread_count'] if row else 0
+
+
+async def write(func, *args):
+    """Run `func(conn, *args)` in the next group commit, without blocking the event loop."""
+    return await asyncio.wrap_future(writer.submit(func, *args))
+
+
+@async_view('event_stream')
+async def event_stream(server):
+    """Server-Sent Events stream of the current user's live events (see events.py)."""
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+    user_id = session['user_id']
+    return Stream(events.stream_async(user_id, on_idle=functools.partial(presence.touch, user_id)), 'text/event-stream',
+                  headers=[('Cache-Control', 'no-cache'), ('X-Accel-Buffering', 'no')])
+
+
+@async_view('unread_count')
+async def unread_count(server):
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+    return jsonify(count=await server.unread_total(session['user_id']))
+
+
+@async_view('mark_read_json')
+async def mark_read_json(server, chat_username):
+    if 'user_id' not in session:
+        return jsonify(error='Connecte-toi !'), 401
+    user_id = session['user_id']
+    other = await server.chat_partner(user_id, chat_username)
+    if not other:
+        return jsonify(error="Vous ne pouvez discuter qu'avec vos amis."), 403
+
+    read = await write(conversations.mark_read, user_id, other['id'])
+    if read:
+        # app.push_read
+        events.publish(user_id, 'unread', {'count': await server.unread_total(user_id)})
+        if (await server.conversation_settings(user_id, other['id'])).show_read_receipts:
+            events.publish(other['id'], 'read', {'chat': session['username']})
+    return jsonify(read=read)
+
+
+@async_view('update_conversation_settings')
+async def update_conversation_settings(server, chat_username):
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    user_id = session['user_id']
+    friend = await server.db.fetchone('SELECT id FROM users WHERE username = ?', (chat_username,))
+    if not friend:
+        return redirect(url_for('messages'))
+
+    await write(settings.save, user_id, friend['id'], request.form.get('nickname', '').strip(),
+                bool(request.form.get('show_read_receipts')), bool(request.form.get('ephemeral_mode')))
+    settings.store.forget(user_id, friend['id'])
+    flash('Paramètres de discussion mis à jour !')
+    return redirect(url_for('messages', chat_username=chat_username))
+
+
+async def read_body(scope, receive, limit=None):
+    """
+    The request body, as a file for `wsgi.input`. Raises RequestEntityTooLarge as soon as it
+    is known to be over `limit` bytes (by its Content-Length, or as it arrives), without
+    reading the rest.
+    """
+    if limit is not None:
+        for name, value in scope['headers']:
+            if name == b'content-length' and value.isdigit() and int(value) > limit:
+                raise RequestEntityTooLarge()
+    body = io.BytesIO()
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        body.write(message.get('body', b''))
+        if limit is not None and body.tell() > limit:
+            raise RequestEntityTooLarge()
+        if not message.get('more_body'):
+            break
+    body.seek(0)
+    return body
+
+
+def build_environ(scope, body):
+    """The WSGI environ of an ASGI HTTP request (PEP 3333 strings: latin-1 decoded bytes); `body` is a file."""
+    server = scope.get('server') or ('localhost', 80)
+    length = body.seek(0, io.SEEK_END)
+    body.seek(0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin1'),
+        'PATH_INFO': scope['path'].encode().decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('latin1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'CONTENT_LENGTH': str(length),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name, value = name.decode('latin1'), value.decode('latin1')
+        if name == 'content-length':
+            continue
+        key = 'CONTENT_TYPE' if name == 'content-type' else 'HTTP_' + name.upper().replace('-', '_')
+        # HTTP/2 clients may split Cookie into several headers; they join with '; ' (RFC 9113 8.2.3)
+        separator = '; ' if name == 'cookie' else ','
+        environ[key] = f'{environ[key]}{separator}{value}' if key in environ else value
+    return environ
+
+
+async def send_response(response, send):
+    await send({'type': 'http.response.start', 'status': response.status_code,
+                'headers': [(k.lower().encode('latin1'), v.encode('latin1'))
+                            for k, v in response.headers.to_wsgi_list()]})
+    await send({'type': 'http.response.body', 'body': response.get_data()})
+
+
+# Set up from the environment like wsgi.py, and warmed before the first request
+flask_app = create_app()
+warmup.preload(flask_app)
+application = Application(flask_app)
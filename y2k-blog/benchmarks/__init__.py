@@ -0,0 +1,10 @@
+"""
+Benchmarks for the hot paths of the app. Run them from y2k-blog/:
+
+- `python -m benchmarks.dataset`: fill a new database with a synthetic dataset
+- `python -m benchmarks.routes`: route latency (p50/p95/p99, queries per request), sequential or concurrent
+- `python -m benchmarks.report`: compare two JSON results
+- `python -m benchmarks.render`: content rendering microbenchmark
+- `python -m benchmarks.connections`: concurrent connection capacity, sync server against the ASGI mode
+- `python -m benchmarks.startup`: worker startup and first requests, with and without preloading
+"""
@@ -0,0 +1,209 @@
+"""
+Concurrent connection capacity: the sync server against the ASGI mode (see asgi.py).
+
+Starts the app as a real server on a copy of a generated dataset (see dataset.py),
+opens `--connections` idle /events streams as logged-in users (one per open
+chat tab), then, while they are held, times probe requests: the unread badge
+and the home page. Also reports the server's threads and memory.
+
+    python -m benchmarks.connections --mode sync --connections 1000
+    python -m benchmarks.connections --mode asgi --connections 1000
+
+`sync` is the threaded Werkzeug server of `python app.py` (a thread per
+connection); `asgi` is uvicorn serving asgi:application (needs the uvicorn and
+aiosqlite packages).
+"""
+import argparse
+import http.client
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import dataset, report
+from benchmarks.routes import summarize
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = {
+    'sync': [sys.executable, '-c', 'import app; app.create_app().run(host="127.0.0.1", port={port}, threaded=True)'],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1', '--port', '{port}',
+             '--log-level', 'warning', '--timeout-keep-alive', '60'],
+}
+# Logged-in users the streams are spread over
+SESSIONS = 50
+PROBES = 50
+# Seconds to wait for a stream's first event (`retry:`) before counting it as refused
+OPEN_TIMEOUT = 10
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_stats(pid):
+    """Threads and resident memory (MB) of a process, from /proc (Linux only)."""
+    stats = {}
+    try:
+        with open(f'/proc/{pid}/status') as file:
+            for line in file:
+                key, _, value = line.partition(':')
+                if key == 'Threads':
+                    stats['threads'] = int(value)
+                elif key == 'VmRSS':
+                    stats['rss_mb'] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        pass
+    return stats
+
+
+class Server:
+    """The app served by `mode` in its own process, on a private copy of the dataset."""
+
+    def __init__(self, mode, database):
+        self.workdir = tempfile.mkdtemp(prefix='y2k-conn-')
+        shutil.copyfile(database, os.path.join(self.workdir, 'database.db'))
+        self.port = free_port()
+        command = [part.format(port=self.port) for part in SERVERS[mode]]
+        env = dict(os.environ, PYTHONPATH=HERE + os.pathsep + os.environ.get('PYTHONPATH', ''))
+        self.process = subprocess.Popen(command, cwd=self.workdir, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                return
+            except OSError:
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.1)
+        self.stop()
+        raise RuntimeError(f'The {mode} server did not start (is its package installed?)')
+
+    def request(self, method, path, cookie=None, body=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+        headers = {'Cookie': cookie} if cookie else {}
+        if body is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            response.read()
+            return response
+        finally:
+            conn.close()
+
+    def login(self, username):
+        response = self.request('POST', '/login', body=f'username={username}&password={dataset.PASSWORD}')
+        return response.getheader('Set-Cookie').split(';', 1)[0]
+
+    def open_stream(self, cookie):
+        """An /events stream that has received its first event, or None."""
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=OPEN_TIMEOUT)
+        try:
+            sock.sendall(f'GET /events HTTP/1.1\r\nHost: localhost\r\nCookie: {cookie}\r\n'
+                         f'Accept: text/event-stream\r\n\r\n'.encode())
+            received = b''
+            while b'retry:' not in received:
+                chunk = sock.recv(4096)
+                if not chunk:
+                    raise OSError('closed')
+                received += chunk
+            return sock
+        except OSError:
+            sock.close()
+            return None
+
+    def stop(self):
+        self.process.terminate()
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def probe(server, path, cookie, count=PROBES):
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = server.request('GET', path, cookie)
+        samples.append((time.perf_counter() - start, 0, response.status < 400))
+    return summarize(samples)
+
+
+def run(mode, database, connections):
+    server = Server(mode, database)
+    streams = []
+    try:
+        conn = sqlite3.connect(database)
+        usernames = [row[0] for row in conn.execute(
+            "SELECT username FROM users WHERE role = 'user' ORDER BY id LIMIT ?", (SESSIONS,))]
+        conn.close()
+        cookies = [server.login(username) for username in usernames]
+        idle = {'probes': {'/unread': probe(server, '/unread', cookies[0]), '/': probe(server, '/', cookies[0])},
+                **process_stats(server.process.pid)}
+
+        start = time.perf_counter()
+        refused = 0
+        for i in range(connections):
+            stream = server.open_stream(cookies[i % len(cookies)])
+            if stream is None:
+                refused += 1
+            else:
+                streams.append(stream)
+        opened = time.perf_counter() - start
+
+        loaded = {'probes': {'/unread': probe(server, '/unread', cookies[0]), '/': probe(server, '/', cookies[0])},
+                  **process_stats(server.process.pid)}
+        return {'mode': mode, 'connections': connections, 'open': len(streams), 'refused': refused,
+                'open_seconds': round(opened, 2), 'idle': idle, 'loaded': loaded}
+    finally:
+        for stream in streams:
+            stream.close()
+        server.stop()
+
+
+def print_result(result):
+    print(f"{result['mode']}: {result['open']}/{result['connections']} streams open "
+          f"({result['refused']} refused) in {result['open_seconds']} s")
+    for phase in ('idle', 'loaded'):
+        stats = result[phase]
+        print(f"  {phase:<7} {stats.get('threads', '?')} threads, {stats.get('rss_mb', '?')} MB")
+        for path, probes in stats['probes'].items():
+            print('    ' + report.format_row(f'GET {path}', probes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Concurrent connection capacity, sync server against ASGI mode.')
+    parser.add_argument('--mode', choices=sorted(SERVERS) + ['both'], default='both')
+    parser.add_argument('--connections', type=int, default=1000, help='idle /events streams to hold')
+    parser.add_argument('--database', help='copy of this database instead of a generated one')
+    parser.add_argument('--users', type=int, default=500, help='size of the generated dataset')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    database = args.database
+    sizes = {'database': os.path.abspath(database)} if database else {'users': args.users, 'seed': args.seed}
+    if not database:
+        database = os.path.join(tempfile.mkdtemp(prefix='y2k-conn-'), 'database.db')
+        sizes.update(dataset.generate(database, users=args.users, seed=args.seed))
+
+    results = []
+    for mode in (['sync', 'asgi'] if args.mode == 'both' else [args.mode]):
+        result = run(mode, database, args.connections)
+        print_result(result)
+        results.append(result)
+    if args.output:
+        report.save(args.output, {'meta': report.metadata('connections', sizes), 'runs': results})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
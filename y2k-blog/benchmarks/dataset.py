@@ -0,0 +1,210 @@
+"""
+Deterministic synthetic dataset for the benchmarks.
+
+Fills a fresh database with users, a friend graph where a few users have many
+friends and most have a handful (preferential attachment), pending requests and
+blocks, posts, comments, likes, direct messages and conversation settings. The
+same seed and sizes always give the same rows, so runs on different commits
+compare like with like:
+
+    python -m benchmarks.dataset [database.db] [--users 500] [--seed 1]
+
+Every user's password is `pw` (stored in clear like the default admin's, which
+login accepts, so generating thousands of users stays fast).
+"""
+import argparse
+import html
+import os
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+import conversations
+import counters
+from migrations import upgrade
+
+PASSWORD = 'pw'
+# Window the generated activity is spread over, ending now
+DAYS = 60
+
+WORDS = ('trop', 'mignon', 'paillettes', 'tamagotchi', 'walkman', 'britney', 'msn', 'skyblog', 'blog', 'lol',
+         'mdr', 'coucou', 'bisous', 'soirée', 'cd', 'gloss', 'kawaii', 'chat', 'playlist', 'nokia', 'myspace',
+         'rose', 'étoile', 'licorne', 'dodo', 'école', 'week-end', 'musique', 'photo', 'demain', 'ce', 'soir', 'avec',
+         'toi', 'moi', 'nous', 'super', 'grave', 'trop', 'bien', 'fun', 'cute', 'xoxo', '<3', ':3', '^^')
+POST_TYPES = ('message', 'message', 'message', 'photo', 'video', 'story')
+
+
+def sentence(rng, low=4, high=20):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def paragraph(text):
+    """What content.render makes of plain text, without the cost of running it."""
+    return f'<p>{html.escape(text, quote=False)}</p>'
+
+
+class Generator:
+    """Builds the rows with one seeded RNG; sizes are averages per user."""
+
+    def __init__(self, users=500, seed=1, friends=8, posts=6, comments=2, likes=4, chats=3, messages=20):
+        self.rng = random.Random(seed)
+        self.users = users
+        self.friends = friends
+        self.posts = posts
+        self.comments = comments
+        self.likes = likes
+        self.chats = chats
+        self.messages = messages
+        self.now = datetime.utcnow().replace(microsecond=0)
+
+    def timestamp(self, max_age=DAYS * 86400, min_age=0):
+        age = self.rng.randint(min_age, max_age)
+        return (self.now - timedelta(seconds=age)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def generate(self, conn):
+        user_ids = self.make_users(conn)
+        friends = self.make_graph(conn, user_ids)
+        post_ids = self.make_posts(conn, user_ids, friends)
+        self.make_messages(conn, friends)
+        # Denormalized tables, from the rows just written
+        counters.rebuild_counters(conn)
+        conversations.rebuild_conversations(conn)
+        return {'users': len(user_ids), 'posts': len(post_ids)}
+
+    def make_users(self, conn):
+        rows = []
+        for i in range(self.users):
+            rows.append((f'user{i}', PASSWORD, f'User {i} ✨', sentence(self.rng, 5, 30),
+                         f'https://example.com/avatars/{i % 50}.jpg', sentence(self.rng, 1, 4),
+                         self.timestamp(3 * 86400)))
+        conn.executemany('''
+            INSERT INTO users (username, password, display_name, bio, profile_picture, status_note, last_active)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        return [row[0] for row in conn.execute("SELECT id FROM users WHERE username LIKE 'user%' ORDER BY id")]
+
+    def make_graph(self, conn, user_ids):
+        """Preferential attachment: each new user befriends existing users picked by degree."""
+        friends = {user_id: set() for user_id in user_ids}
+        endpoints = []  # each user once per friendship, so picking from it favours popular users
+        accepted, pending = [], []
+        for index, user_id in enumerate(user_ids):
+            wanted = min(index, self.rng.randint(1, self.friends))
+            targets = set()
+            while len(targets) < wanted:
+                targets.add(self.rng.choice(endpoints) if endpoints and self.rng.random() < 0.8
+                            else user_ids[self.rng.randrange(index)])
+            for other in targets:
+                sender, receiver = (user_id, other) if self.rng.random() < 0.5 else (other, user_id)
+                if self.rng.random() < 0.9:
+                    accepted.append((sender, receiver, 'accepted', self.timestamp()))
+                    friends[user_id].add(other)
+                    friends[other].add(user_id)
+                    endpoints += [user_id, other]
+                else:
+                    pending.append((sender, receiver, 'pending', self.timestamp()))
+        conn.executemany('INSERT INTO friends (sender_id, receiver_id, status, created_at) VALUES (?, ?, ?, ?)',
+                         accepted + pending)
+
+        # About 1% of users block a stranger
+        blocks = set()
+        for user_id in self.rng.sample(user_ids, max(1, len(user_ids) // 100)):
+            other = self.rng.choice(user_ids)
+            if other != user_id and other not in friends[user_id]:
+                blocks.add((user_id, other))
+        conn.executemany('INSERT INTO blocks (blocker_id, blocked_id) VALUES (?, ?)', sorted(blocks))
+        return friends
+
+    def make_posts(self, conn, user_ids, friends):
+        posts = []
+        for user_id in user_ids:
+            # Few prolific authors, many occasional ones
+            for _ in range(min(int(self.rng.paretovariate(1.5) * self.posts / 3), self.posts * 20)):
+                text = sentence(self.rng, 3, 60)
+                posts.append((user_id, text, self.rng.choice(POST_TYPES),
+                              'friends' if self.rng.random() < 0.3 else 'public', self.timestamp()))
+        conn.executemany('''
+            INSERT INTO posts (author_id, content_raw, content, post_type, visibility, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(a, raw, paragraph(raw), kind, visibility, at) for a, raw, kind, visibility, at in posts])
+        post_rows = conn.execute('SELECT id, author_id, created_at FROM posts ORDER BY id').fetchall()
+
+        comments, likes = [], []
+        for post_id, author_id, created_at in post_rows:
+            audience = sorted(friends[author_id]) or user_ids
+            for _ in range(self.rng.randint(0, 2 * self.comments)):
+                text = sentence(self.rng, 2, 20)
+                comments.append((post_id, self.rng.choice(audience), text, paragraph(text), created_at))
+            for liker in set(self.rng.choice(audience) for _ in range(self.rng.randint(0, 2 * self.likes))):
+                likes.append((liker, 'post', post_id))
+        conn.executemany('''
+            INSERT INTO comments (post_id, author_id, content_raw, content, created_at)
+            VALUES (?, ?, ?, ?, datetime(?, '+1 hour'))
+        ''', comments)
+        for comment_id, post_id in conn.execute('SELECT id, post_id FROM comments ORDER BY id').fetchall():
+            if self.rng.random() < 0.3:
+                likes.append((self.rng.choice(user_ids), 'comment', comment_id))
+        conn.executemany('INSERT OR IGNORE INTO likes (user_id, item_type, item_id) VALUES (?, ?, ?)', likes)
+        return [row[0] for row in post_rows]
+
+    def make_messages(self, conn, friends):
+        pairs = set()
+        for user_id, their_friends in friends.items():
+            for other in self.rng.sample(sorted(their_friends), min(len(their_friends), self.chats)):
+                pairs.add(conversations.pair(user_id, other))
+        messages, settings = [], []
+        for user_a, user_b in sorted(pairs):
+            count = self.rng.randint(1, 2 * self.messages)
+            ages = sorted((self.rng.randint(0, DAYS * 86400) for _ in range(count)), reverse=True)
+            for position, age in enumerate(ages):
+                sender, receiver = (user_a, user_b) if self.rng.random() < 0.5 else (user_b, user_a)
+                at = (self.now - timedelta(seconds=age)).strftime('%Y-%m-%d %H:%M:%S')
+                # The last few of a conversation are often still unread
+                is_read = int(position < count - 3 or self.rng.random() < 0.5)
+                messages.append((sender, receiver, html.escape(sentence(self.rng, 1, 25), quote=False), is_read, at))
+            for user_id, friend_id in ((user_a, user_b), (user_b, user_a)):
+                if self.rng.random() < 0.2:
+                    settings.append((user_id, friend_id, f'Chouchou {friend_id}' if self.rng.random() < 0.5 else None,
+                                     int(self.rng.random() < 0.9), int(self.rng.random() < 0.1)))
+        conn.executemany('INSERT INTO messages (sender_id, receiver_id, content, is_read, created_at) VALUES (?, ?, ?, ?, ?)',
+                         messages)
+        conn.executemany('''
+            INSERT INTO conversation_settings (user_id, friend_id, nickname, show_read_receipts, ephemeral_mode)
+            VALUES (?, ?, ?, ?, ?)
+        ''', settings)
+
+
+def generate(db_path='database.db', **sizes):
+    """Create `db_path` (which must not exist yet) with a synthetic dataset. Returns what was made."""
+    if os.path.exists(db_path):
+        raise FileExistsError(f'{db_path} already exists; the generator only fills a new database')
+    upgrade(db_path)
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("""
+            INSERT INTO users (username, password, role, display_name) VALUES ('admin', 'password', 'admin', 'Admin')
+        """)
+        made = Generator(**sizes).generate(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return made
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('database', nargs='?', default='database.db')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--force', action='store_true', help='replace an existing database')
+    args = parser.parse_args(argv)
+    if args.force:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(args.database + suffix):
+                os.remove(args.database + suffix)
+    made = generate(args.database, users=args.users, seed=args.seed)
+    print(f"{args.database}: {made['users']} users, {made['posts']} posts (seed {args.seed}).")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Microbenchmark of the content render pipeline.
+
+Compares the old per-request rendering (a fresh Markdown parser and a bleach
+call with the rules rebuilt every time, mentions as bare spans) with content.py
+(reused Markdown/Cleaner per thread, mentions resolved in one lookup per batch):
+
+    python -m benchmarks.render [iterations]
+"""
+import re
+import sqlite3
+import sys
+import time
+
+import bleach
+import markdown
+
+import content
+
+SAMPLES = [
+    'Trop **mignon** ce petit chat @alice ! :3',
+    '# Ma journée\n\nJ\'ai écouté *Britney* toute la journée avec @bob et @carole.\n\n- cd\n- walkman\n- tamagotchi',
+    'Regardez mon nouveau site : [clique ici](http://example.com) <script>alert(1)</script>',
+    '> citation de @inconnu\n\nmdr `code` et encore du texte, du texte, du texte...',
+]
+
+
+def legacy_render(raw):
+    with_mentions = re.sub(r'@(\w+)', r'<span class="mention">@\1</span>', raw)
+    return bleach.clean(markdown.markdown(with_mentions),
+                        tags=content.ALLOWED_TAGS, attributes=content.ALLOWED_ATTRIBUTES)
+
+
+def memory_db():
+    conn = sqlite3.connect(':memory:')
+    conn.row_factory = sqlite3.Row
+    conn.execute('CREATE TABLE users (id INTEGER PRIMARY KEY, username TEXT UNIQUE)')
+    conn.executemany('INSERT INTO users (username) VALUES (?)', [('alice',), ('bob',), ('carole',)])
+    return conn
+
+
+def timed(label, func, count):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed * 1000:8.1f} ms  {elapsed / count * 1e6:8.1f} µs/render")
+    return elapsed
+
+
+def main(iterations=500):
+    conn = memory_db()
+    profile_url = '/user/{}'.format
+    raws = SAMPLES * iterations
+    count = len(raws)
+    print(f"{count} renders")
+    before = timed('legacy (per request)', lambda: [legacy_render(raw) for raw in raws], count)
+    after = timed('content.render', lambda: [content.render(conn, raw, profile_url) for raw in raws], count)
+    timed('content.render_many', lambda: content.render_many(conn, raws, profile_url), count)
+    print(f"speedup (render): x{before / after:.2f}")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,92 @@
+"""
+JSON results of the benchmarks, and their comparison across runs.
+
+A result file holds `meta` (commit, versions, dataset, mode) and `routes`, the
+stats of each route. `compare` flags a route as regressed when its p95 grew by
+more than the threshold (and by more than NOISE_MS, so sub-millisecond jitter
+doesn't count) or when it runs more SQL statements per request (at least
+QUERY_SLACK more on average, as the concurrent mode mixes users at random):
+
+    python -m benchmarks.report before.json after.json
+"""
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+
+# Relative p95 slowdown that counts as a regression
+THRESHOLD = 0.10
+NOISE_MS = 0.5
+QUERY_SLACK = 0.5
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(mode, dataset):
+    return {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'mode': mode,
+        'dataset': dataset,
+    }
+
+
+def save(path, results):
+    with open(path, 'w') as file:
+        json.dump(results, file, indent=2, ensure_ascii=False)
+    print(f"Results written to {path}")
+
+
+def load(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def format_row(name, stats):
+    errors = f"  {stats['errors']} errors" if stats['errors'] else ''
+    return (f"{name:<40} n={stats['count']:<5} p50 {stats['p50_ms']:7.2f}  p95 {stats['p95_ms']:7.2f}  "
+            f"p99 {stats['p99_ms']:7.2f} ms  {stats['queries']:5.1f} queries{errors}")
+
+
+def compare(baseline, current, threshold=THRESHOLD):
+    """Print route by route changes. Returns the names of the routes that regressed."""
+    before_meta, after_meta = baseline.get('meta', {}), current.get('meta', {})
+    print(f"\n{before_meta.get('commit') or '?'} -> {after_meta.get('commit') or '?'}")
+    if before_meta.get('dataset') != after_meta.get('dataset') or before_meta.get('mode') != after_meta.get('mode'):
+        print('Warning: the runs used different datasets or modes.')
+
+    regressions = []
+    for name, after in current.get('routes', {}).items():
+        before = baseline.get('routes', {}).get(name)
+        if not before:
+            print(f"{name:<40} (new)")
+            continue
+        change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] if before['p95_ms'] else 0.0
+        slower = change > threshold and after['p95_ms'] - before['p95_ms'] > NOISE_MS
+        more_queries = after['queries'] - before['queries'] >= QUERY_SLACK
+        flag = '  REGRESSION' if slower or more_queries else ''
+        print(f"{name:<40} p95 {before['p95_ms']:7.2f} -> {after['p95_ms']:7.2f} ms ({change:+.0%})  "
+              f"queries {before['queries']:.1f} -> {after['queries']:.1f}{flag}")
+        if flag:
+            regressions.append(name)
+    if 'throughput_rps' in baseline and 'throughput_rps' in current:
+        print(f"throughput {baseline['throughput_rps']} -> {current['throughput_rps']} req/s")
+    print(f"{len(regressions)} regression(s).")
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python -m benchmarks.report BASELINE.json CURRENT.json')
+    sys.exit(1 if compare(load(sys.argv[1]), load(sys.argv[2])) else 0)
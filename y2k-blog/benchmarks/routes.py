@@ -0,0 +1,290 @@
+"""
+Route latency benchmark, through Flask's test client (no network, no server).
+
+Runs against a copy of a generated dataset (see dataset.py), so the POST routes
+never touch the original. Two modes:
+
+- sequential (default): each route in turn, `--requests` times after a warm-up,
+  cycling over logged-in users. Reports p50/p95/p99 latency and SQL statements
+  per request.
+- concurrent (`--concurrency N`): N virtual users in threads, each logged in as
+  someone else and picking routes at random by weight for `--duration` seconds,
+  locust-style. Also reports throughput and errors.
+
+Results can be written as JSON and compared with an earlier run (see report.py):
+
+    python -m benchmarks.routes --users 500 --output before.json
+    python -m benchmarks.routes --users 500 --compare before.json
+"""
+import argparse
+import math
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from flask import g
+
+from benchmarks import dataset, report
+
+# Logged-in users the sequential mode cycles over
+SESSIONS = 20
+WARMUP = 10
+
+
+class Route:
+    """One benchmarked request. `build(rng, subject)` returns (url, form data or None)."""
+
+    def __init__(self, name, method, build, weight):
+        self.name = name
+        self.method = method
+        self.build = build
+        self.weight = weight
+
+
+ROUTES = [
+    Route('GET /', 'GET', lambda rng, s: ('/', None), 40),
+    Route('GET /user/<username>', 'GET', lambda rng, s: (f'/user/{rng.choice(s.usernames)}', None), 20),
+    Route('GET /messages/<chat_username>', 'GET', lambda rng, s: (f'/messages/{rng.choice(s.friends)}', None), 15),
+    Route('GET /messages/<chat_username>?q=', 'GET',
+          lambda rng, s: (f'/messages/{rng.choice(s.friends)}?q={rng.choice(dataset.WORDS[:30])}', None), 5),
+    Route('POST /like/post/<id>', 'POST', lambda rng, s: (f'/like/post/{rng.choice(s.post_ids)}', {}), 10),
+    Route('POST /comment/<post_id>', 'POST',
+          lambda rng, s: (f'/comment/{rng.choice(s.post_ids)}', {'content': dataset.sentence(rng, 2, 12)}), 4),
+    Route('POST /post/new', 'POST', lambda rng, s: ('/post/new', {'content': dataset.sentence(rng), 'visibility':
+                                                                   rng.choice(('public', 'friends'))}), 2),
+    Route('POST /messages/<chat_username>/send', 'POST',
+          lambda rng, s: (f'/messages/{rng.choice(s.friends)}/send', {'content': dataset.sentence(rng, 1, 10)}), 4),
+]
+
+
+class Subject:
+    """A logged-in test client and what its user can act on."""
+
+    def __init__(self, app, conn, user, usernames, post_ids):
+        self.client = app.test_client()
+        self.client.post('/login', data={'username': user['username'], 'password': dataset.PASSWORD})
+        self.usernames = usernames
+        self.post_ids = post_ids
+        self.friends = [row[0] for row in conn.execute('''
+            SELECT username FROM users WHERE id IN (
+                SELECT receiver_id FROM friends WHERE sender_id = :id AND status = 'accepted'
+                UNION SELECT sender_id FROM friends WHERE receiver_id = :id AND status = 'accepted')
+            ORDER BY id
+        ''', {'id': user['id']})]
+
+
+class QueryCounter:
+    """
+    Counts the SQL statements each thread's requests run, via sqlite3's trace
+    callback: on the request's connection, and on the writer's for the writes
+    the request hands to groupcommit.py (not the BEGIN/COMMIT they share).
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def install(self, app, get_db):
+        @app.before_request
+        def trace_statements():
+            get_db().set_trace_callback(self._tally())
+
+        @app.teardown_appcontext
+        def untrace_statements(exception=None):
+            if 'db' in g:
+                g.db.set_trace_callback(None)
+
+        writer = app.extensions['group_commit']
+        submit = writer.submit
+
+        def counted_submit(func, *args):
+            # Runs on the writer thread, so the caller's tally is taken now
+            tally = self._tally()
+
+            def counted(conn, *args):
+                conn.set_trace_callback(tally)
+                try:
+                    return func(conn, *args)
+                finally:
+                    conn.set_trace_callback(None)
+            return submit(counted, *args)
+        writer.submit = counted_submit
+
+    def _tally(self):
+        if not hasattr(self._local, 'tally'):
+            self._local.tally = Tally()
+        return self._local.tally
+
+    def reset(self):
+        self._tally().count = 0
+
+    @property
+    def count(self):
+        return self._tally().count
+
+
+class Tally:
+    """A statement counter, usable as a trace callback from any thread."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, sql):
+        self.count += 1
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(pct / 100 * len(sorted_values)) - 1)]
+
+
+def summarize(samples):
+    """samples: list of (seconds, queries, ok) -> stats in milliseconds."""
+    latencies = sorted(seconds * 1000 for seconds, _, _ in samples)
+    return {
+        'count': len(samples),
+        'errors': sum(1 for _, _, ok in samples if not ok),
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'queries': round(sum(q for _, q, _ in samples) / len(samples), 2) if samples else 0.0,
+    }
+
+
+class Bench:
+    """The app loaded on a private copy of the dataset, with logged-in subjects."""
+
+    def __init__(self, database=None, users=500, seed=1):
+        self.workdir = tempfile.mkdtemp(prefix='y2k-bench-')
+        target = os.path.join(self.workdir, 'database.db')
+        if database:
+            shutil.copyfile(database, target)
+            self.dataset = {'database': os.path.abspath(database)}
+        else:
+            self.dataset = {'users': users, 'seed': seed, **dataset.generate(target, users=users, seed=seed)}
+
+        # app.py opens `database.db` relative to the working directory
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        os.chdir(self.workdir)
+        import app as app_module
+        import db
+        self.app = app_module.create_app({'TESTING': True})
+        self.queries = QueryCounter()
+        self.queries.install(self.app, db.get_db)
+
+        conn = sqlite3.connect(target)
+        conn.row_factory = sqlite3.Row
+        self.usernames = [row[0] for row in conn.execute("SELECT username FROM users WHERE role = 'user' ORDER BY id")]
+        self.post_ids = [row[0] for row in conn.execute("SELECT id FROM posts WHERE visibility = 'public' ORDER BY id")]
+        # Users with friends, most connected first, so every route has something to act on
+        self._candidates = conn.execute('''
+            SELECT users.id, users.username FROM users
+            JOIN (SELECT sender_id AS id FROM friends WHERE status = 'accepted'
+                  UNION ALL SELECT receiver_id FROM friends WHERE status = 'accepted') AS f ON f.id = users.id
+            GROUP BY users.id ORDER BY COUNT(*) DESC, users.id
+        ''').fetchall()
+        self._conn = conn
+
+    def subjects(self, count):
+        return [Subject(self.app, self._conn, user, self.usernames, self.post_ids)
+                for user in self._candidates[:count]]
+
+    def request(self, subject, route, rng):
+        url, data = route.build(rng, subject)
+        self.queries.reset()
+        start = time.perf_counter()
+        try:
+            if route.method == 'GET':
+                response = subject.client.get(url)
+            else:
+                response = subject.client.post(url, data=data)
+            ok = response.status_code < 500
+        except Exception:
+            ok = False
+        return time.perf_counter() - start, self.queries.count, ok
+
+    def sequential(self, requests=200, seed=1):
+        rng = random.Random(seed)
+        subjects = self.subjects(SESSIONS)
+        results = {}
+        for route in ROUTES:
+            for i in range(WARMUP):
+                self.request(subjects[i % len(subjects)], route, rng)
+            samples = [self.request(subjects[i % len(subjects)], route, rng) for i in range(requests)]
+            results[route.name] = summarize(samples)
+            print(report.format_row(route.name, results[route.name]), flush=True)
+        return {'routes': results}
+
+    def concurrent(self, concurrency=8, duration=10.0, think=0.0, seed=1):
+        subjects = self.subjects(concurrency)
+        samples = {route.name: [] for route in ROUTES}
+        lock = threading.Lock()
+        deadline = time.perf_counter() + duration
+
+        def virtual_user(index, subject):
+            rng = random.Random(seed * 1000 + index)
+            while time.perf_counter() < deadline:
+                route = rng.choices(ROUTES, weights=[r.weight for r in ROUTES])[0]
+                sample = self.request(subject, route, rng)
+                with lock:
+                    samples[route.name].append(sample)
+                if think:
+                    time.sleep(rng.uniform(0, 2 * think))
+
+        threads = [threading.Thread(target=virtual_user, args=(i, s)) for i, s in enumerate(subjects)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results = {name: summarize(route_samples) for name, route_samples in samples.items() if route_samples}
+        for name, stats in results.items():
+            print(report.format_row(name, stats))
+        total = sum(stats['count'] for stats in results.values())
+        print(f"{total} requests in {elapsed:.1f} s with {len(subjects)} users: {total / elapsed:.1f} req/s")
+        return {'routes': results, 'throughput_rps': round(total / elapsed, 2), 'concurrency': len(subjects)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Route latency benchmark.')
+    parser.add_argument('--database', help='copy of this database instead of a generated one')
+    parser.add_argument('--users', type=int, default=500, help='size of the generated dataset')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--requests', type=int, default=200, help='per route, in sequential mode')
+    parser.add_argument('--concurrency', type=int, default=0, help='virtual users (concurrent mode)')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds, in concurrent mode')
+    parser.add_argument('--think', type=float, default=0.0, help='mean pause between requests, in seconds')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=report.THRESHOLD,
+                        help='relative slowdown counted as a regression (default %(default)s)')
+    args = parser.parse_args(argv)
+
+    bench = Bench(args.database, args.users, args.seed)
+    if args.concurrency:
+        mode = 'concurrent'
+        results = bench.concurrent(args.concurrency, args.duration, args.think, args.seed)
+    else:
+        mode = 'sequential'
+        results = bench.sequential(args.requests, args.seed)
+    results = {'meta': report.metadata(mode, bench.dataset), **results}
+
+    if args.output:
+        report.save(args.output, results)
+    if args.compare:
+        regressions = report.compare(report.load(args.compare), results, args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
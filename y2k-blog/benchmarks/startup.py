@@ -0,0 +1,182 @@
+"""
+Startup benchmark: how long a fresh worker takes to serve its first requests,
+with and without the preload phase of wsgi.py (see warmup.py).
+
+Each run is a new Python process, like a deploy. It imports the app, sets it up
+(create_app), optionally preloads it, then forks a worker the way a preforking
+server does. The worker times a first round of requests and then the same
+round again, warm, and reports its private memory: what it didn't share with
+the master. Medians over `--runs` runs:
+
+    python -m benchmarks.startup --users 500 --runs 5
+
+Linux only (fork, /proc).
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import dataset, report
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODES = ('lazy', 'preload')
+
+
+def first_round(user, friend):
+    """(name, method, url, form data) of a worker's first requests, as a visitor who logs in."""
+    return [
+        ('GET /login', 'GET', '/login', None),
+        ('POST /login', 'POST', '/login', {'username': user, 'password': dataset.PASSWORD}),
+        ('GET /', 'GET', '/', None),
+        ('GET /user/<username>', 'GET', f'/user/{friend}', None),
+        ('GET /messages/<chat_username>', 'GET', f'/messages/{friend}', None),
+    ]
+
+
+def memory():
+    """Private and proportional memory (MB) of this process, from /proc."""
+    stats = {}
+    with open('/proc/self/smaps_rollup') as file:
+        for line in file:
+            key, _, value = line.partition(':')
+            if key in ('Pss', 'Private_Clean', 'Private_Dirty'):
+                stats[key] = int(value.split()[0]) / 1024
+    return {'private_mb': round(stats['Private_Clean'] + stats['Private_Dirty'], 1), 'pss_mb': round(stats['Pss'], 1)}
+
+
+def worker(app, preloaded, requests):
+    """What the forked worker measures."""
+    if preloaded:
+        import warmup
+        warmup.after_fork(app)
+    client = app.test_client()
+    rounds = []
+    for _ in range(2):
+        timings = {}
+        for name, method, url, data in requests:
+            start = time.perf_counter()
+            response = client.open(url, method=method, data=data)
+            timings[name] = round((time.perf_counter() - start) * 1000, 2)
+            if response.status_code >= 400:
+                raise RuntimeError(f'{name}: {response.status_code}')
+        rounds.append(timings)
+    return {'first_ms': rounds[0], 'warm_ms': rounds[1], **memory()}
+
+
+def child(mode, user, friend):
+    """One run, in a fresh process: prints its timings as JSON."""
+    sys.path.insert(0, HERE)
+    start = time.perf_counter()
+    import app as app_module
+    result = {'import_s': time.perf_counter() - start}
+    start = time.perf_counter()
+    app = app_module.create_app()
+    result['setup_s'] = time.perf_counter() - start
+    if mode == 'preload':
+        import warmup
+        start = time.perf_counter()
+        warmup.preload(app)
+        result['preload_s'] = time.perf_counter() - start
+
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        with os.fdopen(write, 'w') as pipe:
+            json.dump(worker(app, mode == 'preload', first_round(user, friend)), pipe)
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as pipe:
+        result.update(json.load(pipe))
+    os.waitpid(pid, 0)
+    print(json.dumps(result))
+
+
+def run(mode, database, user, friend):
+    workdir = tempfile.mkdtemp(prefix='y2k-startup-')
+    try:
+        shutil.copyfile(database, os.path.join(workdir, 'database.db'))
+        env = dict(os.environ, FLASK_SECRET_KEY='benchmark', FLASK_DATABASE=os.path.join(workdir, 'database.db'),
+                   FLASK_PURGE_INTERVAL='0')
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.startup', '--child', mode, user, friend],
+                                cwd=HERE, env=env, capture_output=True, text=True, check=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def median(runs, *keys):
+    values = []
+    for run_ in runs:
+        value = run_
+        for key in keys:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is not None:
+            values.append(value)
+    return round(statistics.median(values), 3) if values else None
+
+
+def summarize(runs):
+    names = list(runs[0]['first_ms'])
+    summary = {key: median(runs, key) for key in ('import_s', 'setup_s', 'preload_s', 'private_mb', 'pss_mb')}
+    summary['first_ms'] = {name: median(runs, 'first_ms', name) for name in names}
+    summary['warm_ms'] = {name: median(runs, 'warm_ms', name) for name in names}
+    summary['first_round_ms'] = round(sum(summary['first_ms'].values()), 2)
+    return summary
+
+
+def print_summary(mode, summary):
+    preload = f", preload {summary['preload_s']:.3f} s" if summary['preload_s'] is not None else ''
+    print(f"{mode}: import {summary['import_s']:.3f} s, create_app {summary['setup_s']:.3f} s{preload}; "
+          f"worker: first round {summary['first_round_ms']:.1f} ms, {summary['private_mb']} MB private, "
+          f"{summary['pss_mb']} MB PSS")
+    for name, first in summary['first_ms'].items():
+        print(f"    {name:<36} first {first:8.2f} ms   warm {summary['warm_ms'][name]:7.2f} ms")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['--child']:
+        return child(*argv[1:])
+
+    parser = argparse.ArgumentParser(description='Startup benchmark, with and without preloading.')
+    parser.add_argument('--database', help='copy of this database instead of a generated one')
+    parser.add_argument('--users', type=int, default=500, help='size of the generated dataset')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    database = args.database
+    sizes = {'database': os.path.abspath(database)} if database else {'users': args.users, 'seed': args.seed}
+    if not database:
+        database = os.path.join(tempfile.mkdtemp(prefix='y2k-startup-'), 'database.db')
+        sizes.update(dataset.generate(database, users=args.users, seed=args.seed))
+    conn = sqlite3.connect(database)
+    user, friend = conn.execute('''
+        SELECT sender.username, receiver.username FROM friends
+        JOIN users AS sender ON sender.id = friends.sender_id
+        JOIN users AS receiver ON receiver.id = friends.receiver_id
+        WHERE friends.status = 'accepted' ORDER BY friends.id LIMIT 1
+    ''').fetchone()
+    conn.close()
+
+    results = {}
+    for mode in MODES:
+        runs = [run(mode, database, user, friend) for _ in range(args.runs)]
+        results[mode] = summarize(runs)
+        print_summary(mode, results[mode])
+    if args.output:
+        report.save(args.output, {'meta': report.metadata('startup', sizes), 'modes': results})
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import time
+from datetime import datetime, timezone
+from functools import wraps
+
+from flask import current_app, g, make_response, request, session
+
+from db import get_db
+from uploads import STORED_RE
+
+# HTTP caching policy.
+#
+# - Static files get a content fingerprint in their URL (`style.css?v=1a2b3c4d`)
+#   and stored uploads have their hash in their name: both are cached for a year.
+# - Feed and profile pages carry a weak ETag built from the `content_version`
+#   counter in `meta` (bumped by every write that changes what they show), the
+#   viewer and the minute; a revalidation that matches gets a 304 before the view runs.
+# - Every other dynamic response stays `no-store`.
+
+CONTENT_VERSION_KEY = 'content_version'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'private, no-cache'
+NO_STORE = 'no-store, no-cache, must-revalidate, max-age=0'
+
+_fingerprints = {}  # filename -> (mtime, fingerprint)
+
+
+def content_changed(conn):
+    """Call in any transaction that changes what feed or profile pages show."""
+    # Milliseconds since the epoch (at least +1), so the version doubles as Last-Modified
+    conn.execute('UPDATE meta SET value = MAX(value + 1, ?) WHERE key = ?',
+                 (int(time.time() * 1000), CONTENT_VERSION_KEY))
+
+
+def content_version(conn):
+    row = conn.execute('SELECT value FROM meta WHERE key = ?', (CONTENT_VERSION_KEY,)).fetchone()
+    return row[0] if row else 0
+
+
+def fingerprint(static_folder, filename):
+    """Short hash of a static file's content, recomputed only when its mtime changes."""
+    path = os.path.join(static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    cached = _fingerprints.get(filename)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as file:
+        digest = hashlib.sha256(file.read()).hexdigest()[:8]
+    _fingerprints[filename] = (mtime, digest)
+    return digest
+
+
+def build_id(app):
+    """Changes when templates do, so a deploy never revalidates an old page."""
+    latest = 0
+    for root, _, files in os.walk(os.path.join(app.root_path, app.template_folder)):
+        for name in files:
+            latest = max(latest, os.stat(os.path.join(root, name)).st_mtime)
+    return hashlib.sha256(repr(latest).encode()).hexdigest()[:8]
+
+
+def init_app(app):
+    app.extensions['caching_build_id'] = build_id(app)
+
+    @app.url_defaults
+    def add_fingerprint(endpoint, values):
+        # Uploads are never fingerprinted: their URL is stored in the database
+        if endpoint == 'static' and 'v' not in values and not values.get('filename', '').startswith('uploads/'):
+            version = fingerprint(app.static_folder, values['filename'])
+            if version:
+                values['v'] = version
+
+    @app.after_request
+    def cache_headers(response):
+        if request.endpoint == 'static':
+            filename = (request.view_args or {}).get('filename', '')
+            if STORED_RE.match(filename) or 'v' in request.args:
+                response.headers['Cache-Control'] = IMMUTABLE
+            else:
+                response.headers['Cache-Control'] = 'no-cache'
+        elif 'ETag' not in response.headers:
+            response.headers['Cache-Control'] = NO_STORE
+            response.headers['Pragma'] = 'no-cache'
+            response.headers['Expires'] = '-1'
+        return response
+
+
+def conditional(viewer_parts):
+    """
+    Decorator for pages that can be revalidated. `viewer_parts()` returns whatever
+    else the page depends on for the current viewer (id, unread badge...).
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # A pending flash message is rendered once: that page can't be cached
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(*args, **kwargs)
+
+            version = content_version(get_db())
+            # The minute is part of the tag: status dots and "il y a 5 min" age with time
+            parts = (current_app.extensions['caching_build_id'], request.full_path, version, int(time.time() // 60),
+                     *viewer_parts())
+            etag = hashlib.sha1(repr(parts).encode()).hexdigest()[:16]
+            last_modified = datetime.fromtimestamp(version / 1000, tz=timezone.utc) if version else None
+            g.page_etag = etag
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200 or '_flashes' in session:
+                    return response
+            response.set_etag(etag, weak=True)
+            if last_modified:
+                response.last_modified = last_modified
+            response.headers['Cache-Control'] = REVALIDATE
+            return response
+        return wrapper
+    return decorator
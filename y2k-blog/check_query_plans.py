@@ -0,0 +1,152 @@
+"""
+EXPLAIN QUERY PLAN check for every SQL statement the routes run.
+
+Drives the app with Flask's test client against a small throwaway database,
+records each statement through sqlite3's trace callback, then asks SQLite how it
+would execute it. Fails if any statement does a full table scan on one of the
+tables that grow with usage (statements marked as a full load of a cache, see
+socialgraph.py, read whole tables on purpose and are skipped). Part of the test
+suite (tests/test_query_plans.py); to see the statements it flags:
+
+    python check_query_plans.py
+"""
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+
+# Tables that grow with usage; `users` is only ever looked up by key or scanned for a page of results
+LARGE_TABLES = {'posts', 'comments', 'likes', 'messages', 'friends', 'blocks', 'conversation_settings', 'timeline'}
+
+SCAN_RE = re.compile(r'^SCAN (\w+)(?! USING (?:COVERING )?INDEX)')
+ALIAS_RE = re.compile(r'\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(?!ON\b|WHERE\b|JOIN\b|LEFT\b|SET\b|ORDER\b|GROUP\b|VALUES\b)(\w+))?', re.I)
+
+
+def seed(conn):
+    conn.executescript('''
+        INSERT INTO users (username, password, role, display_name) VALUES ('admin', 'password', 'admin', 'Admin');
+        INSERT INTO users (username, password, display_name) VALUES ('alice', 'pw', 'Alice');
+        INSERT INTO users (username, password, display_name) VALUES ('bob', 'pw', 'Bob');
+        INSERT INTO friends (sender_id, receiver_id, status) VALUES (2, 3, 'accepted');
+        INSERT INTO posts (content, visibility, author_id) VALUES ('<p>hello</p>', 'public', 2);
+        INSERT INTO posts (content, visibility, author_id) VALUES ('<p>friends</p>', 'friends', 3);
+        INSERT INTO comments (post_id, author_id, content) VALUES (1, 3, '<p>hi</p>');
+        INSERT INTO likes (user_id, item_type, item_id) VALUES (3, 'post', 1);
+        INSERT INTO messages (sender_id, receiver_id, content) VALUES (3, 2, 'coucou');
+    ''')
+    conn.commit()
+
+
+def exercise(client):
+    """Hit every route the way a logged-in user and a visitor would."""
+    client.get('/')
+    client.get('/feed')
+    client.get('/user/bob')
+    client.get('/user/bob/feed')
+    client.post('/login', data={'username': 'alice', 'password': 'pw'})
+    client.get('/')
+    client.get('/feed')
+    client.get('/user/bob')
+    client.get('/user/bob/feed')
+    client.post('/like/post/1')
+    client.post('/like/post/1')
+    client.post('/like/comment/1')
+    client.post('/comment/1', data={'content': 'so cute'})
+    client.post('/like/post/1/json')
+    client.post('/like/comment/1/json')
+    client.post('/comment/1/json', data={'content': 'so so cute'})
+    client.post('/post/new', data={'content': 'new post', 'visibility': 'friends'})
+    client.get('/messages')
+    client.get('/messages/bob')
+    client.get('/messages/bob?q=cou')
+    client.get('/messages/bob/history?before=2')
+    client.post('/messages/bob', data={'content': 'salut'})
+    client.post('/messages/bob/send', data={'content': 'ça va ?'})
+    client.post('/messages/bob/read')
+    client.post('/messages/bob/settings', data={'nickname': 'Bobby', 'ephemeral_mode': '1'})
+    client.get('/messages/bob')
+    client.get('/unread')
+    # Only the request: the stream itself waits for events without querying
+    client.get('/events').close()
+    client.post('/add_friend/1')
+    client.post('/block_user/1')
+    client.post('/unblock_user/1')
+    client.post('/remove_friend/3')
+    client.get('/edit_profile')
+    client.post('/edit_profile', data={'username': 'alice', 'display_name': 'Alice', 'bio': 'hi', 'profile_picture': '',
+                                       'music_link': '', 'status_note': ''})
+    client.get('/logout')
+    client.post('/login', data={'username': 'admin', 'password': 'password'})
+    client.post('/accept_friend/2')
+    client.post('/delete_comment/1')
+    client.post('/delete_comment/3/json')
+    client.post('/delete_post/1')
+
+
+def full_scans(conn, sql):
+    """Large tables that `sql` reads with a full scan."""
+    aliases = {}
+    for table, alias in ALIAS_RE.findall(sql):
+        aliases[table.lower()] = table.lower()
+        if alias:
+            aliases[alias.lower()] = table.lower()
+    scans = []
+    for row in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+        match = SCAN_RE.match(row[3])
+        if match:
+            table = aliases.get(match.group(1).lower(), match.group(1).lower())
+            if table in LARGE_TABLES:
+                scans.append(row[3])
+    return scans
+
+
+def check(database):
+    """
+    Seed a new database at `database` and exercise the app on it.
+    Returns the distinct statements run and {statement: its full scans}.
+    """
+    import app as app_module
+    import migrations
+    from socialgraph import FULL_LOAD
+    migrations.upgrade(database)
+    conn = sqlite3.connect(database)
+    seed(conn)
+
+    app = app_module.create_app({'TESTING': True, 'DATABASE': database})
+    # Every connection of the app, the requests' and the group commit thread's (see groupcommit.py)
+    statements = []
+    pool = app.extensions['sqlite_pool']
+    connect = pool.connect
+
+    def traced_connect():
+        traced = connect()
+        traced.set_trace_callback(statements.append)
+        return traced
+
+    pool.connect = traced_connect
+    exercise(app.test_client())
+
+    statements = list(dict.fromkeys(statements))
+    failures = {}
+    for sql in statements:
+        if not re.match(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b', sql, re.I) or FULL_LOAD in sql:
+            continue
+        scans = full_scans(conn, sql)
+        if scans:
+            failures[' '.join(sql.split())] = scans
+    conn.close()
+    return statements, failures
+
+
+def main():
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    statements, failures = check(os.path.join(tempfile.mkdtemp(), 'database.db'))
+    for sql, scans in failures.items():
+        print(f"FULL SCAN ({', '.join(scans)}):\n    {sql}\n")
+    print(f"Checked {len(statements)} statements, {len(failures)} with full scans on large tables.")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+import json
+import re
+import threading
+
+import bleach
+import markdown
+
+# Render-once pipeline for user-written content (posts and comments):
+# raw Markdown -> resolved @mentions -> HTML -> sanitized HTML.
+# The raw source is stored next to the rendered HTML, so everything can be
+# re-rendered in bulk (`flask --app app rerender-content`) when the rules change.
+
+# Allowed tags and attributes for bleach (to keep markdown safe but allow styling/images)
+ALLOWED_TAGS = [
+    'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 'li', 'ol', 'strong',
+    'ul', 'p', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'img', 'hr', 'span'
+]
+ALLOWED_ATTRIBUTES = {
+    'a': ['href', 'title', 'target', 'class'],
+    'img': ['src', 'alt', 'title'],
+    'span': ['class', 'style']
+}
+
+# @ followed by word characters, not preceded by one (so emails are left alone)
+MENTION_RE = re.compile(r'(?<!\w)@(\w+)')
+
+# Markdown and Cleaner instances are reusable but not thread-safe: one of each per thread
+_local = threading.local()
+
+
+def _markdown():
+    if not hasattr(_local, 'markdown'):
+        _local.markdown = markdown.Markdown()
+    return _local.markdown
+
+
+def _cleaner():
+    if not hasattr(_local, 'cleaner'):
+        _local.cleaner = bleach.sanitizer.Cleaner(tags=ALLOWED_TAGS, attributes=ALLOWED_ATTRIBUTES)
+    return _local.cleaner
+
+
+def mentioned_usernames(texts):
+    return {name for text in texts for name in MENTION_RE.findall(text or '')}
+
+
+def existing_usernames(conn, usernames):
+    """The subset of `usernames` that belong to real accounts, in one query."""
+    if not usernames:
+        return set()
+    rows = conn.execute('SELECT username FROM users WHERE username IN (SELECT value FROM json_each(?))',
+                        (json.dumps(sorted(usernames)),))
+    return {row['username'] for row in rows}
+
+
+def link_mentions(text, known, profile_url):
+    """Known @users become links to their profile, the others keep the plain mention style."""
+    def replace(match):
+        username = match.group(1)
+        if username in known:
+            return f'<a class="mention" href="{profile_url(username)}">@{username}</a>'
+        return f'<span class="mention">@{username}</span>'
+    return MENTION_RE.sub(replace, text)
+
+
+def render_html(raw, known, profile_url):
+    """Render one piece of content, given the already-resolved set of known usernames."""
+    if not raw:
+        return ''
+    md = _markdown()
+    try:
+        html = md.convert(link_mentions(raw, known, profile_url))
+    finally:
+        md.reset()
+    return _cleaner().clean(html)
+
+
+def render(conn, raw, profile_url):
+    """Render one piece of content, resolving its mentions with a single lookup."""
+    known = existing_usernames(conn, mentioned_usernames([raw]))
+    return render_html(raw, known, profile_url)
+
+
+def render_many(conn, raws, profile_url):
+    """Render a batch, resolving every mention of the whole batch in one lookup."""
+    known = existing_usernames(conn, mentioned_usernames(raws))
+    return [render_html(raw, known, profile_url) for raw in raws]
+
+
+def rerender_all(conn, profile_url, batch_size=500):
+    """
+    Re-render every post and comment that has its raw source stored.
+    Returns the number of rows whose HTML changed.
+    """
+    changed = 0
+    for table in ('posts', 'comments'):
+        last_id = 0
+        while True:
+            rows = conn.execute(f'''
+                SELECT id, content, content_raw FROM {table}
+                WHERE id > ? AND content_raw IS NOT NULL
+                ORDER BY id LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            if not rows:
+                break
+            rendered = render_many(conn, [row['content_raw'] for row in rows], profile_url)
+            updates = [(html, row['id']) for row, html in zip(rows, rendered) if html != row['content']]
+            conn.executemany(f'UPDATE {table} SET content = ? WHERE id = ?', updates)
+            changed += len(updates)
+            last_id = rows[-1]['id']
+    return changed
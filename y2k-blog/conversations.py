@@ -0,0 +1,159 @@
+import counters
+
+# Messages shown when opening a conversation, and per "load older" page
+MESSAGES_PAGE_SIZE = 50
+
+# Conversation summaries: one `conversations` row per pair of users who have
+# exchanged messages, keyed by the unordered pair (user_a < user_b). It holds the
+# last message and per-side unread counts, so the /messages sidebar is a single
+# indexed query instead of three correlated subqueries per friend.
+
+
+def pair(user_id, other_id):
+    return (user_id, other_id) if user_id < other_id else (other_id, user_id)
+
+
+def unread_column(user_id, other_id):
+    """Column holding the number of messages waiting for `user_id` in this pair."""
+    return 'unread_a' if user_id < other_id else 'unread_b'
+
+
+def message_sent(conn, sender_id, receiver_id, message_id):
+    """Record a new message: it becomes the pair's last message and is unread for the receiver."""
+    user_a, user_b = pair(sender_id, receiver_id)
+    column = unread_column(receiver_id, sender_id)
+    conn.execute(f'''
+        INSERT INTO conversations (user_a, user_b, last_message_id, last_activity, {column})
+        SELECT ?, ?, id, created_at, 1 FROM messages WHERE id = ?
+        ON CONFLICT (user_a, user_b) DO UPDATE SET
+            last_message_id = excluded.last_message_id,
+            last_activity = excluded.last_activity,
+            {column} = {column} + 1
+    ''', (user_a, user_b, message_id))
+    counters.message_sent(conn, sender_id, receiver_id)
+
+
+def mark_read(conn, reader_id, sender_id):
+    """Mark everything sender_id sent to reader_id as read. Returns how many messages changed."""
+    user_a, user_b = pair(reader_id, sender_id)
+    column = unread_column(reader_id, sender_id)
+    unread = conn.execute(f'SELECT {column} FROM conversations WHERE user_a = ? AND user_b = ?',
+                          (user_a, user_b)).fetchone()
+    if not unread or not unread[0]:
+        # Nothing waiting: no write at all
+        return 0
+    read = conn.execute('UPDATE messages SET is_read = 1 WHERE sender_id = ? AND receiver_id = ? AND is_read = 0',
+                        (sender_id, reader_id)).rowcount
+    conn.execute(f'UPDATE conversations SET {column} = 0 WHERE user_a = ? AND user_b = ?', (user_a, user_b))
+    counters.messages_read(conn, reader_id, read)
+    return read
+
+
+def conversation_list(conn, user_id):
+    """
+    The user's friends with their conversation summary, most recent conversation first
+    (friends never written to come last).
+    """
+    return conn.execute('''
+        SELECT u.id, u.username, u.display_name, u.profile_picture, u.last_active,
+               m.content AS last_message, c.last_activity,
+               COALESCE(CASE WHEN c.user_a = :me THEN c.unread_a ELSE c.unread_b END, 0) AS unread_count
+        FROM (SELECT receiver_id AS friend_id FROM friends WHERE sender_id = :me AND status = 'accepted'
+              UNION
+              SELECT sender_id FROM friends WHERE receiver_id = :me AND status = 'accepted') fr
+        JOIN users u ON u.id = fr.friend_id
+        LEFT JOIN conversations c ON c.user_a = MIN(:me, fr.friend_id) AND c.user_b = MAX(:me, fr.friend_id)
+        LEFT JOIN messages m ON m.id = c.last_message_id
+        ORDER BY c.last_activity IS NULL, c.last_activity DESC, c.last_message_id DESC
+    ''', {'me': user_id}).fetchall()
+
+
+def refresh(conn, user_a, user_b):
+    """Recompute one pair's summary from its messages (after deletions)."""
+    user_a, user_b = pair(user_a, user_b)
+    last = conn.execute('''
+        SELECT id, created_at FROM messages
+        WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
+        ORDER BY created_at DESC, id DESC LIMIT 1
+    ''', (user_a, user_b, user_b, user_a)).fetchone()
+    if not last:
+        conn.execute('DELETE FROM conversations WHERE user_a = ? AND user_b = ?', (user_a, user_b))
+        return
+    conn.execute('''
+        UPDATE conversations SET last_message_id = ?, last_activity = ?,
+            unread_a = (SELECT COUNT(*) FROM messages WHERE sender_id = ? AND receiver_id = ? AND is_read = 0),
+            unread_b = (SELECT COUNT(*) FROM messages WHERE sender_id = ? AND receiver_id = ? AND is_read = 0)
+        WHERE user_a = ? AND user_b = ?
+    ''', (last['id'], last['created_at'], user_b, user_a, user_a, user_b, user_a, user_b))
+
+
+def rebuild_conversations(conn):
+    """Recompute every summary from `messages`. Returns the number of rows that had drifted."""
+    actual = '''
+        SELECT user_a, user_b, MAX(id), MAX(created_at),
+               SUM(receiver_id = user_a AND is_read = 0), SUM(receiver_id = user_b AND is_read = 0)
+        FROM (SELECT id, created_at, receiver_id, is_read,
+                     MIN(sender_id, receiver_id) AS user_a, MAX(sender_id, receiver_id) AS user_b
+              FROM messages)
+        GROUP BY user_a, user_b
+    '''
+    stored = 'SELECT user_a, user_b, last_message_id, last_activity, unread_a, unread_b FROM conversations'
+    drifted = conn.execute(f'''
+        SELECT (SELECT COUNT(*) FROM ({actual} EXCEPT {stored})) + (SELECT COUNT(*) FROM ({stored} EXCEPT {actual}))
+    ''').fetchone()[0]
+    conn.execute('DELETE FROM conversations')
+    conn.execute(f'''
+        INSERT INTO conversations (user_a, user_b, last_message_id, last_activity, unread_a, unread_b) {actual}
+    ''')
+    return drifted
+
+
+def fetch_history(conn, user_id, other_id, before=None, ephemeral=False, limit=MESSAGES_PAGE_SIZE):
+    """
+    The latest `limit` messages between two users, oldest first, optionally only those
+    older than message id `before` (none if that message is gone). Returns (messages, older)
+    where `older` is the id to pass as `before` for the previous page, or None at the start
+    of the history.
+
+    Each direction is read newest-first from the (sender_id, receiver_id, created_at)
+    index and stops after `limit` rows, so the cost doesn't grow with the history.
+    """
+    filters = ''
+    params = []
+    if before is not None:
+        anchor = conn.execute('SELECT created_at, id FROM messages WHERE id = ?', (before,)).fetchone()
+        if anchor is None:
+            # Purged since the page was loaded (see expiry.py): so is everything older
+            return [], None
+        filters += ' AND (m.created_at, m.id) < (?, ?)'
+        params += [anchor['created_at'], anchor['id']]
+    if ephemeral:
+        filters += " AND m.created_at >= datetime('now', '-1 day')"
+
+    direction = f'''
+        SELECT * FROM (
+            SELECT m.* FROM messages m
+            WHERE m.sender_id = ? AND m.receiver_id = ?{filters}
+            ORDER BY m.created_at DESC, m.id DESC LIMIT ?
+        )
+    '''
+    rows = conn.execute(f'''
+        SELECT h.*, u.username as sender_name, u.profile_picture as sender_pfp
+        FROM ({direction} UNION ALL {direction}) h
+        JOIN users u ON h.sender_id = u.id
+        ORDER BY h.created_at DESC, h.id DESC
+        LIMIT ?
+    ''', [user_id, other_id, *params, limit + 1, other_id, user_id, *params, limit + 1, limit + 1]).fetchall()
+
+    older = rows[limit - 1]['id'] if len(rows) > limit else None
+    return [dict(m) for m in reversed(rows[:limit])], older
+
+
+def fetch_message(conn, message_id):
+    """One message with its sender's name and picture, as fetch_history returns them."""
+    row = conn.execute('''
+        SELECT m.*, u.username as sender_name, u.profile_picture as sender_pfp
+        FROM messages m JOIN users u ON m.sender_id = u.id
+        WHERE m.id = ?
+    ''', (message_id,)).fetchone()
+    return dict(row) if row else None
@@ -0,0 +1,48 @@
+# Denormalized counters, kept in sync by the routes inside the same transaction as
+# the write they describe, so reads are a column lookup instead of a COUNT over rows:
+#   posts.like_count, posts.comment_count, comments.like_count,
+#   users.unread_count (nav badge); per-conversation unread counts live in
+#   `conversations` (see conversations.py).
+# `flask --app app rebuild-counters` recomputes everything if they ever drift.
+
+
+def like_changed(conn, item_type, item_id, delta):
+    table = 'posts' if item_type == 'post' else 'comments'
+    conn.execute(f'UPDATE {table} SET like_count = MAX(like_count + ?, 0) WHERE id = ?', (delta, item_id))
+
+
+def comment_changed(conn, post_id, delta):
+    conn.execute('UPDATE posts SET comment_count = MAX(comment_count + ?, 0) WHERE id = ?', (delta, post_id))
+
+
+def message_sent(conn, sender_id, receiver_id):
+    conn.execute('UPDATE users SET unread_count = unread_count + 1 WHERE id = ?', (receiver_id,))
+
+
+def messages_read(conn, reader_id, read):
+    """`read` messages were just marked as read by reader_id."""
+    if read <= 0:
+        return
+    conn.execute('UPDATE users SET unread_count = MAX(unread_count - ?, 0) WHERE id = ?', (read, reader_id))
+
+
+def unread_total(conn, user_id):
+    row = conn.execute('SELECT unread_count FROM users WHERE id = ?', (user_id,)).fetchone()
+    return row['unread_count'] if row else 0
+
+
+def rebuild_counters(conn):
+    """
+    Recompute every counter from the source tables.
+    Returns the number of rows whose counter had drifted (and were repaired).
+    """
+    repaired = 0
+    for table, column, source in (
+        ('posts', 'like_count', "SELECT COUNT(*) FROM likes WHERE item_type = 'post' AND item_id = posts.id"),
+        ('posts', 'comment_count', 'SELECT COUNT(*) FROM comments WHERE post_id = posts.id'),
+        ('comments', 'like_count', "SELECT COUNT(*) FROM likes WHERE item_type = 'comment' AND item_id = comments.id"),
+        ('users', 'unread_count', 'SELECT COUNT(*) FROM messages WHERE receiver_id = users.id AND is_read = 0'),
+    ):
+        repaired += conn.execute(
+            f'UPDATE {table} SET {column} = ({source}) WHERE {column} IS NOT ({source})').rowcount
+    return repaired
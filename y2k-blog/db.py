@@ -0,0 +1,117 @@
+import os
+import queue
+import sqlite3
+import threading
+
+from flask import current_app, g
+
+# Per-connection tuning, applied once when a pooled connection is opened
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',         # readers don't block on a writer (and vice versa)
+    'PRAGMA synchronous = NORMAL',       # safe with WAL, fsync only at checkpoints
+    'PRAGMA busy_timeout = 5000',        # wait for the write lock instead of failing at once
+    'PRAGMA cache_size = -16000',        # 16 MB page cache per connection
+    'PRAGMA mmap_size = 134217728',      # 128 MB of the file memory-mapped
+    'PRAGMA temp_store = MEMORY',
+)
+
+# Size of sqlite3's per-connection LRU cache of prepared statements
+STATEMENT_CACHE_SIZE = 256
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of tuned SQLite connections.
+
+    Connections are opened lazily up to `max_size` and handed out most-recently-used
+    first, so a handful of warm connections serve most requests. The pool notices
+    when it has been inherited by a forked worker and starts over, since SQLite
+    connections must never cross a fork.
+    """
+
+    def __init__(self, path, max_size=8, timeout=10, factory=sqlite3.Connection):
+        self.path = path
+        self.factory = factory  # connection class, e.g. sqlstats.InstrumentedConnection
+        self.max_size = max_size
+        self.timeout = timeout
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE, factory=self.factory)
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        if self._pid != os.getpid():
+            self._reset()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._opened < self.max_size
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        # Pool exhausted: wait for another request to give a connection back
+        return self._idle.get(timeout=self.timeout)
+
+    def release(self, conn):
+        if self._pid != os.getpid():
+            return
+        if conn.in_transaction:
+            # The request bailed out before committing: don't leak its writes or locks
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._opened = 0
+
+    @property
+    def opened(self):
+        return self._opened
+
+    @property
+    def in_use(self):
+        return self._opened - self._idle.qsize()
+
+
+def init_app(app):
+    app.config.setdefault('DATABASE', 'database.db')
+    app.config.setdefault('DB_POOL_SIZE', 8)
+    app.extensions['sqlite_pool'] = ConnectionPool(app.config['DATABASE'], app.config['DB_POOL_SIZE'])
+    app.teardown_appcontext(release_db)
+
+
+def get_db():
+    """The request's connection, taken from the pool on first use and returned at teardown."""
+    if 'db' not in g:
+        g.db = current_app.extensions['sqlite_pool'].acquire()
+    return g.db
+
+
+def release_db(exception=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        current_app.extensions['sqlite_pool'].release(conn)
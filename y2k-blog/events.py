@@ -0,0 +1,334 @@
+import abc
+import asyncio
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+from werkzeug.utils import import_string
+
+# Live events pushed to the browser over Server-Sent Events (the /events stream):
+# new messages, read receipts ("Vu") and unread badge updates. Every user has a
+# channel; the routes publish to it after committing, the open tabs subscribe to it.
+
+# Events a slow client can fall behind by before it starts losing them
+QUEUE_SIZE = 100
+# Seconds between keep-alive comments on an idle stream (also how fast a closed tab is noticed)
+HEARTBEAT = 15
+# SQLiteBroker: seconds between two reads of `event_log`, and how long its rows are kept
+POLL_INTERVAL = 0.1
+EVENT_RETENTION = 60
+
+logger = logging.getLogger(__name__)
+
+
+class Broker(abc.ABC):
+    """
+    Publish/subscribe interface behind the event stream.
+
+    The default LocalBroker only reaches subscribers inside the same process.
+    With several workers, use one backed by something they share through
+    EVENT_BROKER: SQLiteBroker (the database), or Redis pub/sub, Postgres
+    LISTEN/NOTIFY...
+    """
+
+    # Whether subscribe_async is implemented; if not, the ASGI stream waits on
+    # subscribe() from a thread
+    supports_async = False
+
+    def init_app(self, app):
+        """Called by events.init_app with the app the broker serves. Optional."""
+
+    @abc.abstractmethod
+    def publish(self, channel, event, data):
+        """Deliver (event, data) to the subscribers of `channel`."""
+
+    @abc.abstractmethod
+    def subscribe(self, channel):
+        """A Subscription: `get(timeout)` returns (event, data) or None, `close()` unsubscribes."""
+
+    def subscribe_async(self, channel, loop):
+        """Like subscribe(), but `get` is a coroutine of `loop` (see asgi.py). Needs `supports_async`."""
+        raise NotImplementedError(f'{type(self).__name__} has no async subscriptions')
+
+    @abc.abstractmethod
+    def unsubscribe(self, subscription):
+        """Stop delivering to `subscription` (its `close()`)."""
+
+
+class Subscription:
+    def __init__(self, broker, channel):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+
+    def get(self, timeout=HEARTBEAT):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            # The tab stopped reading; drop rather than block the publisher
+            pass
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class AsyncSubscription(Subscription):
+    """Subscription read by a coroutine: publishers, on any thread, hand events over to its event loop."""
+
+    def __init__(self, broker, channel, loop):
+        self.broker = broker
+        self.channel = channel
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    async def get(self, timeout=HEARTBEAT):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def put(self, item):
+        try:
+            self.loop.call_soon_threadsafe(self._put, item)
+        except RuntimeError:
+            # The loop is closed: the stream is gone
+            pass
+
+    def _put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            pass
+
+
+class LocalBroker(Broker):
+    """In-process pub/sub: one bounded queue per open stream."""
+
+    supports_async = True
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # channel -> set of Subscription
+
+    def publish(self, channel, event, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put((event, data))
+
+    def subscribe(self, channel):
+        return self._add(Subscription(self, channel))
+
+    def subscribe_async(self, channel, loop):
+        return self._add(AsyncSubscription(self, channel, loop))
+
+    def _add(self, subscription):
+        with self._lock:
+            self._subscribers.setdefault(subscription.channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.channel)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscribers[subscription.channel]
+
+    @property
+    def subscriber_count(self):
+        with self._lock:
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+class SQLiteBroker(Broker):
+    """
+    Pub/sub between the processes sharing the database, e.g. the gunicorn workers
+    of one host, with nothing else to run. Events go through the `event_log` table:
+    one thread per process writes what was published since its last tick in one
+    transaction, then reads the rows added by every process (a primary key range)
+    and hands them to the subscribers of this process. Events arrive within
+    POLL_INTERVAL; rows older than EVENT_RETENTION are deleted.
+    """
+
+    supports_async = True
+
+    def __init__(self, poll_interval=POLL_INTERVAL, retention=EVENT_RETENTION):
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.pool = None
+        self.local = LocalBroker()
+        self._outbox = []
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        self.pool = app.extensions['sqlite_pool']
+
+    def publish(self, channel, event, data):
+        self._ensure_thread()
+        with self._lock:
+            self._outbox.append((channel, event, json.dumps(data), time.time()))
+        self._wake.set()
+
+    def subscribe(self, channel):
+        self._ensure_thread()
+        return self.local._add(Subscription(self, channel))
+
+    def subscribe_async(self, channel, loop):
+        self._ensure_thread()
+        return self.local._add(AsyncSubscription(self, channel, loop))
+
+    def unsubscribe(self, subscription):
+        self.local.unsubscribe(subscription)
+
+    @property
+    def subscriber_count(self):
+        return self.local.subscriber_count
+
+    def _ensure_thread(self):
+        # Started on first use (and again after a fork), never at import time
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # What the parent published is the parent's to write
+                self._outbox = []
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='event-broker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        conn = self.pool.connect()
+        # Only what is published from now on
+        last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM event_log').fetchone()[0]
+        next_prune = time.monotonic() + self.retention
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                with self._lock:
+                    outbox, self._outbox = self._outbox, []
+                if outbox:
+                    with conn:
+                        conn.executemany('INSERT INTO event_log (channel, event, data, created_at) VALUES (?, ?, ?, ?)',
+                                         outbox)
+                for row_id, channel, event, data in conn.execute(
+                        'SELECT id, channel, event, data FROM event_log WHERE id > ? ORDER BY id', (last_id,)).fetchall():
+                    self.local.publish(channel, event, json.loads(data))
+                    last_id = row_id
+                if time.monotonic() > next_prune:
+                    with conn:
+                        conn.execute('DELETE FROM event_log WHERE created_at < ?', (time.time() - self.retention,))
+                    next_prune = time.monotonic() + self.retention
+            except sqlite3.Error:
+                # Live events are best effort: the tabs catch up on their next page load
+                logger.exception('Event broker tick failed')
+
+
+# The current app's broker (see init_app)
+broker = LocalProxy(lambda: current_app.extensions['events'])
+
+
+def resolve_broker(value):
+    """
+    EVENT_BROKER as given in the config: a Broker, a Broker class, or the import
+    path of either ('events.SQLiteBroker', e.g. from FLASK_EVENT_BROKER).
+    """
+    if isinstance(value, str):
+        value = import_string(value)
+    if isinstance(value, type) and issubclass(value, Broker):
+        value = value()
+    if not isinstance(value, Broker):
+        raise TypeError(f'EVENT_BROKER must be a Broker, a Broker class or an import path of one, not {value!r}')
+    return value
+
+
+def init_app(app):
+    value = app.config.get('EVENT_BROKER')
+    broker = LocalBroker() if value is None else resolve_broker(value)
+    broker.init_app(app)
+    app.extensions['events'] = broker
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+def publish(user_id, event, data):
+    broker.publish(user_channel(user_id), event, data)
+
+
+def subscribe(user_id):
+    return broker.subscribe(user_channel(user_id))
+
+
+def format_sse(event, data):
+    return f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+
+def stream(user_id, on_idle=None):
+    """The text/event-stream body for one user; unsubscribes when the client goes away."""
+    # The body is read once the request, and its app context, are over: take the broker now
+    return _stream(current_app.extensions['events'], user_id, on_idle)
+
+
+def _stream(broker, user_id, on_idle):
+    # Subscribed on the first read, so a response that is never sent can't leak a subscriber
+    subscription = broker.subscribe(user_channel(user_id))
+    try:
+        # Tell EventSource how long to wait before reconnecting
+        yield 'retry: 3000\n\n'
+        while True:
+            item = subscription.get()
+            if item is None:
+                if on_idle is not None:
+                    on_idle()
+                yield ': keep-alive\n\n'
+            else:
+                yield format_sse(*item)
+    finally:
+        subscription.close()
+
+
+def stream_async(user_id, on_idle=None):
+    """stream() for the ASGI mode (see asgi.py): waiting for events holds no thread."""
+    return _stream_async(current_app.extensions['events'], user_id, on_idle)
+
+
+async def _stream_async(broker, user_id, on_idle):
+    if broker.supports_async:
+        subscription = broker.subscribe_async(user_channel(user_id), asyncio.get_running_loop())
+        get = subscription.get
+    else:
+        # A broker without async subscriptions is waited on from the default executor
+        subscription = broker.subscribe(user_channel(user_id))
+        get = lambda: asyncio.to_thread(subscription.get)
+    try:
+        yield 'retry: 3000\n\n'
+        while True:
+            item = await get()
+            if item is None:
+                if on_idle is not None:
+                    on_idle()
+                yield ': keep-alive\n\n'
+            else:
+                yield format_sse(*item)
+    finally:
+        subscription.close()
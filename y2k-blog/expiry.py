@@ -0,0 +1,146 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+import conversations
+import counters
+import timeline
+
+# Ephemeral conversations: messages older than a day are deleted for good, by a
+# background thread (or `flask --app app purge-expired` from cron) rather than
+# only hidden at read time. Each batch is a write of the group commit writer
+# (see groupcommit.py): conversation summaries and unread counters are fixed up
+# in the same transaction, and the FTS triggers drop them from search.
+#
+# The same worker drops the materialized timelines of inactive users (see
+# timeline.py), which logging in used to do.
+
+# Matches the read-time filter in conversations.fetch_history and search.search_messages
+EXPIRES_AFTER = '-1 day'
+# Messages deleted per transaction, so the write lock is only held briefly
+BATCH_SIZE = 500
+# Seconds between two runs of the background worker (0 disables it)
+PURGE_INTERVAL = 300
+
+logger = logging.getLogger(__name__)
+
+
+def ephemeral_pairs(conn):
+    """Pairs (user_a < user_b) where either side turned ephemeral mode on."""
+    rows = conn.execute('SELECT user_id, friend_id FROM conversation_settings WHERE ephemeral_mode = 1')
+    return sorted({conversations.pair(row[0], row[1]) for row in rows})
+
+
+def purge_pair(conn, user_a, user_b, batch_size=BATCH_SIZE):
+    """
+    Delete up to `batch_size` expired messages of one conversation, oldest first.
+    Each direction is a range on the (sender_id, receiver_id, created_at) index.
+    Returns how many were deleted. A write for Writer.run: the writer commits.
+    """
+    expired = []
+    for sender_id, receiver_id in ((user_a, user_b), (user_b, user_a)):
+        expired += conn.execute('''
+            SELECT id, receiver_id, is_read FROM messages
+            WHERE sender_id = ? AND receiver_id = ? AND created_at < datetime('now', ?)
+            ORDER BY created_at LIMIT ?
+        ''', (sender_id, receiver_id, EXPIRES_AFTER, batch_size - len(expired))).fetchall()
+        if len(expired) >= batch_size:
+            break
+    if not expired:
+        return 0
+
+    conn.execute('DELETE FROM messages WHERE id IN (SELECT value FROM json_each(?))',
+                 (json.dumps([row[0] for row in expired]),))
+    # Unread messages that disappear no longer count towards their receiver's badge
+    for receiver_id in (user_a, user_b):
+        counters.messages_read(conn, receiver_id, sum(1 for row in expired if row[1] == receiver_id and not row[2]))
+    conversations.refresh(conn, user_a, user_b)
+    return len(expired)
+
+
+class ExpiryWorker:
+    """
+    Purges the ephemeral conversations and prunes idle timelines every
+    PURGE_INTERVAL seconds, through the writer.
+    """
+
+    def __init__(self, interval=PURGE_INTERVAL, batch_size=BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pool = None
+        self.writer = None
+        self.last_purged = 0
+        self.total_purged = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        self.pool = app.extensions['sqlite_pool']
+        self.writer = app.extensions['group_commit']
+        self.interval = app.config.setdefault('PURGE_INTERVAL', self.interval)
+        app.extensions['expiry'] = self
+        app.before_request(self._ensure_thread)
+        return self
+
+    def run_once(self):
+        """Purge every ephemeral conversation, one group commit per batch. Returns the number deleted."""
+        conn = self.pool.acquire()
+        try:
+            pairs = ephemeral_pairs(conn)
+        finally:
+            self.pool.release(conn)
+        purged = 0
+        for user_a, user_b in pairs:
+            while True:
+                deleted = self.writer.run(purge_pair, user_a, user_b, self.batch_size)
+                purged += deleted
+                if deleted < self.batch_size:
+                    break
+        self.last_purged = purged
+        self.total_purged += purged
+        if purged:
+            logger.info('Purged %d expired ephemeral messages', purged)
+        return purged
+
+    def prune_timelines(self):
+        """Drop the timelines of users inactive for timeline.INACTIVE_DAYS. Returns how many."""
+        pruned = self.writer.run(timeline.prune_inactive)
+        if pruned:
+            logger.info('Pruned %d inactive timelines', pruned)
+        return pruned
+
+    def _ensure_thread(self):
+        # Started on the first request (and again after a fork), never at import time
+        if not self.interval:
+            return
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='expiry-worker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                # Whatever was committed stays purged; the next run picks up the rest
+                logger.exception('Ephemeral message purge failed')
+            try:
+                self.prune_timelines()
+            except Exception:
+                logger.exception('Timeline pruning failed')
+            time.sleep(self.interval)
+
+
+# The current app's worker (see create_app in app.py)
+worker = LocalProxy(lambda: current_app.extensions['expiry'])
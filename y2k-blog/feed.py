@@ -0,0 +1,170 @@
+import base64
+import json
+
+
+def _id_list(ids):
+    """Encode a list of ids as a single JSON parameter for `json_each(?)`.
+    One bound parameter keeps the SQL identical whatever the page size,
+    and sidesteps SQLite's limit on the number of host parameters."""
+    return json.dumps(sorted(set(ids)))
+
+
+def _liked_by(conn, item_type, item_ids, viewer_id):
+    """Ids among `item_ids` that the viewer has liked (served by the likes UNIQUE index)."""
+    if viewer_id is None or not item_ids:
+        return set()
+    rows = conn.execute('''
+        SELECT item_id FROM likes
+        WHERE user_id = ? AND item_type = ? AND item_id IN (SELECT value FROM json_each(?))
+    ''', (viewer_id, item_type, _id_list(item_ids))).fetchall()
+    return {r['item_id'] for r in rows}
+
+
+COMMENT_COLUMNS = '''
+    comments.id, comments.post_id, comments.content, comments.created_at, comments.author_id, comments.like_count,
+    users.username, users.display_name, users.profile_picture
+'''
+
+
+def fetch_comment(conn, comment_id):
+    """One comment as hydrate_posts attaches them to posts (without the viewer's like), or None."""
+    row = conn.execute(f'''
+        SELECT {COMMENT_COLUMNS}
+        FROM comments
+        JOIN users ON comments.author_id = users.id
+        WHERE comments.id = ?
+    ''', (comment_id,)).fetchone()
+    if row is None:
+        return None
+    comment = dict(row)
+    comment['likes'] = comment['like_count']
+    return comment
+
+
+def hydrate_posts(conn, posts_data, viewer_id, get_status):
+    """
+    Attach the viewer's likes, comments and author statuses to a page of posts.
+
+    Like counts come from the denormalized `like_count` columns; everything else is
+    loaded with a fixed number of set-based queries (one per kind of data, never one
+    per post or per comment), then assembled into the same structure the feed
+    template has always received.
+    """
+    posts = [dict(p) for p in posts_data]
+    if not posts:
+        return posts
+
+    post_ids = [p['id'] for p in posts]
+    post_liked = _liked_by(conn, 'post', post_ids, viewer_id)
+
+    comments_data = conn.execute(f'''
+        SELECT {COMMENT_COLUMNS}
+        FROM comments
+        JOIN users ON comments.author_id = users.id
+        WHERE comments.post_id IN (SELECT value FROM json_each(?))
+        ORDER BY comments.post_id, comments.created_at ASC, comments.id ASC
+    ''', (_id_list(post_ids),)).fetchall()
+    comments = [dict(c) for c in comments_data]
+    comment_liked = _liked_by(conn, 'comment', [c['id'] for c in comments], viewer_id)
+
+    # Statuses for every author on the page (post and comment authors alike)
+    author_ids = [p['author_id'] for p in posts] + [c['author_id'] for c in comments]
+    last_active = {r['id']: r['last_active'] for r in conn.execute(
+        'SELECT id, last_active FROM users WHERE id IN (SELECT value FROM json_each(?))',
+        (_id_list(author_ids),))}
+
+    comments_by_post = {}
+    for c in comments:
+        c['likes'] = c['like_count']
+        c['current_user_liked'] = c['id'] in comment_liked
+        c['author_status'] = get_status(last_active.get(c['author_id']), c['author_id'])
+        comments_by_post.setdefault(c['post_id'], []).append(c)
+
+    for p in posts:
+        p['likes'] = p['like_count']
+        p['current_user_liked'] = p['id'] in post_liked
+        p['comments'] = comments_by_post.get(p['id'], [])
+        p['author_status'] = get_status(last_active.get(p['author_id']), p['author_id'])
+
+    return posts
+
+
+FEED_PAGE_SIZE = 20
+
+POST_COLUMNS = '''
+    posts.id, posts.content, posts.post_type, posts.visibility, posts.image_url, posts.created_at, posts.author_id,
+    posts.like_count, posts.comment_count, posts.version,
+    users.username, users.display_name, users.profile_picture
+'''
+
+
+def encode_cursor(post):
+    """Opaque keyset cursor pointing just after `post` in (created_at, id) DESC order."""
+    raw = f"{post['created_at']}|{post['id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Returns (created_at, id) or None for a missing/garbled cursor (= first page)."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        created_at, post_id = raw.rsplit('|', 1)
+        return created_at, int(post_id)
+    except ValueError:
+        return None
+
+
+def _fetch_page(conn, where, params, cursor, limit):
+    """Run a keyset-paginated posts query: rows strictly after `cursor`, newest first."""
+    params = list(params)
+    if cursor:
+        where = f'({where}) AND (posts.created_at, posts.id) < (?, ?)'
+        params += list(cursor)
+    rows = conn.execute(f'''
+        SELECT {POST_COLUMNS}
+        FROM posts
+        JOIN users ON posts.author_id = users.id
+        WHERE {where}
+        ORDER BY posts.created_at DESC, posts.id DESC
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+
+    # One extra row tells us whether there is a next page without a COUNT(*)
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def visible_posts(viewer_id):
+    """WHERE clause (and its parameters) for the posts `viewer_id` may see in the home feed."""
+    if viewer_id is None:
+        return "posts.visibility = 'public'", ()
+
+    # `friends` is UNIQUE(sender_id, receiver_id), so EXISTS never duplicates a post
+    where = '''
+        posts.visibility = 'public'
+        OR posts.author_id = ?
+        OR (posts.visibility = 'friends' AND EXISTS (
+            SELECT 1 FROM friends
+            WHERE friends.status = 'accepted'
+              AND ((friends.sender_id = ? AND friends.receiver_id = posts.author_id)
+                OR (friends.sender_id = posts.author_id AND friends.receiver_id = ?))
+        ))
+    '''
+    return where, (viewer_id, viewer_id, viewer_id)
+
+
+def fetch_feed_page(conn, viewer_id, cursor=None, limit=FEED_PAGE_SIZE):
+    """One page of the home feed as seen by `viewer_id` (None for visitors), computed from `posts`."""
+    where, params = visible_posts(viewer_id)
+    return _fetch_page(conn, where, params, cursor, limit)
+
+
+def fetch_profile_page(conn, author_id, include_friends, cursor=None, limit=FEED_PAGE_SIZE):
+    """One page of a user's own posts; friends-only posts are included for friends and self."""
+    if include_friends:
+        where = "posts.author_id = ? AND posts.visibility IN ('public', 'friends')"
+    else:
+        where = "posts.author_id = ? AND posts.visibility = 'public'"
+    return _fetch_page(conn, where, (author_id,), cursor, limit)
@@ -0,0 +1,244 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+
+from flask import current_app, render_template, session
+from markupsafe import Markup, escape
+
+import uploads
+from feed import _id_list, _liked_by, hydrate_posts
+
+# Cache of rendered posts (`_post.html`, `_profile_post.html`).
+#
+# A post renders the same for every viewer of the same kind (visitor, member,
+# admin) as long as it doesn't change, so its HTML is cached under
+# (template, post id, posts.version, viewer kind). What differs per viewer or
+# with time is left as holes in the cached HTML and filled in on the way out:
+# liked hearts, status dots, "il y a 5 min", and the buttons hidden on one's own
+# posts and comments. The routes that change a post bump posts.version
+# (invalidate_posts / invalidate_user), so stale entries are never read again.
+
+# Default budget of the in-process cache, in bytes of HTML
+CACHE_BYTES = 32 * 1024 * 1024
+# Lifetime of entries in a shared (Redis) cache: old versions are never read again
+SHARED_TTL = 24 * 3600
+
+HOLE = '\x1e'
+HOLE_RE = re.compile('\x1e([CESTA])([^\x1e]*)\x1e')
+NOT_SELF_RE = re.compile('\x1eB(\\d+)\x1e(.*?)\x1e/B\x1e', re.S)
+
+
+class LRUBackend:
+    """In-process LRU cache holding at most `max_bytes` of cached values."""
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        values = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                values.append(entry[0] if entry else None)
+        return values
+
+    def set(self, key, value):
+        size = len(value.encode())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                old = self._entries.pop(key, None)
+                if old:
+                    self.size -= old[1]
+
+
+class RedisBackend:
+    """Shared cache on a Redis server (or anything speaking its client API: mget/set/delete)."""
+
+    def __init__(self, client, ttl=SHARED_TTL, prefix='fragment:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        if not keys:
+            return []
+        return [v.decode() if isinstance(v, bytes) else v
+                for v in self.client.mget([self.prefix + key for key in keys])]
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=self.ttl)
+
+    def delete(self, *keys):
+        if keys:
+            self.client.delete(*[self.prefix + key for key in keys])
+
+
+def init_app(app):
+    """
+    Pick the backend: FRAGMENT_CACHE_BACKEND (any object with get_many/set/delete),
+    a Redis server at FRAGMENT_CACHE_REDIS_URL (needs the `redis` package), or an
+    in-process LRU of FRAGMENT_CACHE_BYTES.
+    """
+    backend = app.config.get('FRAGMENT_CACHE_BACKEND')
+    if backend is None and app.config.get('FRAGMENT_CACHE_REDIS_URL'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('FRAGMENT_CACHE_REDIS_URL is set but the redis package is not installed')
+        backend = RedisBackend(redis.Redis.from_url(app.config['FRAGMENT_CACHE_REDIS_URL']))
+    if backend is None:
+        backend = LRUBackend(app.config.get('FRAGMENT_CACHE_BYTES', CACHE_BYTES))
+    app.extensions['fragment_cache'] = backend
+
+    # Holes for the templates; filled by `overlay`
+    app.jinja_env.globals.update(
+        liked_class=lambda kind, item_id: f'{HOLE}C{kind[0]}{item_id}{HOLE}',
+        liked_icon=lambda kind, item_id: f'{HOLE}E{kind[0]}{item_id}{HOLE}',
+        status_color=lambda user_id: f'{HOLE}S{user_id}{HOLE}',
+        status_label=lambda user_id: f'{HOLE}T{user_id}{HOLE}',
+        not_self=lambda user_id: Markup(f'{HOLE}B{user_id}{HOLE}'),
+        end_not_self=lambda: Markup(f'{HOLE}/B{HOLE}'),
+    )
+    app.jinja_env.filters['age'] = lambda created_at: f'{HOLE}A{created_at}{HOLE}'
+
+
+def scrub(value):
+    """Post or comment data with HOLE taken out of its text, so user content can't open holes of its own."""
+    if isinstance(value, str):
+        return value.replace(HOLE, '')
+    if isinstance(value, dict):
+        return {key: scrub(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+
+def viewer_kind():
+    if 'user_id' not in session:
+        return 'visitor'
+    return 'admin' if session.get('role') == 'admin' else 'member'
+
+
+def overlay(html, viewer_id, liked, statuses, timeago):
+    """Fill the holes of a cached post for the current viewer."""
+    html = NOT_SELF_RE.sub(lambda m: '' if int(m.group(1)) == viewer_id else m.group(2), html)
+
+    def fill(match):
+        kind, value = match.group(1), match.group(2)
+        if kind == 'C':
+            return ' liked' if value in liked else ''
+        if kind == 'E':
+            return '💖' if value in liked else '🤍'
+        if kind == 'A':
+            return str(escape(timeago(value)))
+        status = statuses.get(int(value))
+        if not status:
+            return ''
+        return str(escape(status['color'] if kind == 'S' else status['label']))
+    return HOLE_RE.sub(fill, html)
+
+
+def render_posts(conn, posts_data, template, get_status, with_comments=True):
+    """
+    Rendered HTML (Markup) of a page of posts, from the cache where possible.
+    `with_comments` posts (the feed) also get likes, comments and status dots.
+    """
+    backend = current_app.extensions['fragment_cache']
+    build = current_app.extensions.get('caching_build_id', '')
+    viewer_id = session.get('user_id')
+    kind = viewer_kind()
+    posts = [dict(p) for p in posts_data]
+    keys = [f"{build}:{template}:{p['id']}:{p['version']}:{kind}" for p in posts]
+
+    entries = {}
+    for post, key, cached in zip(posts, keys, backend.get_many(keys)):
+        if cached is not None:
+            entries[post['id']] = json.loads(cached)
+    misses = [(post, key) for post, key in zip(posts, keys) if post['id'] not in entries]
+    if misses:
+        missed_posts = [post for post, _ in misses]
+        if with_comments:
+            # Same order, with likes and comments added
+            missed_posts = hydrate_posts(conn, missed_posts, viewer_id, get_status)
+        for post, (_, key) in zip(missed_posts, misses):
+            comments = post.get('comments', [])
+            entry = [render_template(template, post=scrub(post)),
+                     [c['id'] for c in comments],
+                     [post['author_id']] + [c['author_id'] for c in comments]]
+            entries[post['id']] = entry
+            # Not while its thumbnails are still being made, or the srcset would stay missing
+            if not uploads.thumbnails_pending(current_app.static_folder, post['image_url'],
+                                              current_app.static_url_path):
+                backend.set(key, json.dumps(entry))
+
+    liked, statuses = set(), {}
+    if with_comments and posts:
+        post_ids = [p['id'] for p in posts]
+        comment_ids = [c for p in posts for c in entries[p['id']][1]]
+        liked = {f'p{i}' for i in _liked_by(conn, 'post', post_ids, viewer_id)}
+        liked |= {f'c{i}' for i in _liked_by(conn, 'comment', comment_ids, viewer_id)}
+        people = [u for p in posts for u in entries[p['id']][2]]
+        for row in conn.execute('SELECT id, last_active FROM users WHERE id IN (SELECT value FROM json_each(?))',
+                                (_id_list(people),)):
+            statuses[row['id']] = get_status(row['last_active'], row['id'])
+
+    timeago = current_app.jinja_env.filters['timeago']
+    return [Markup(overlay(entries[p['id']][0], viewer_id, liked, statuses, timeago)) for p in posts]
+
+
+def render_comment(conn, comment, get_status):
+    """One comment (see feed.fetch_comment) rendered for the current viewer, as it appears under its post."""
+    viewer_id = session.get('user_id')
+    liked = {f'c{i}' for i in _liked_by(conn, 'comment', [comment['id']], viewer_id)}
+    author = conn.execute('SELECT id, last_active FROM users WHERE id = ?', (comment['author_id'],)).fetchone()
+    statuses = {author['id']: get_status(author['last_active'], author['id'])} if author else {}
+    timeago = current_app.jinja_env.filters['timeago']
+    return Markup(overlay(render_template('_comment.html', comment=scrub(comment)), viewer_id, liked, statuses, timeago))
+
+
+def invalidate_posts(conn, post_ids):
+    """These posts (or their likes/comments) changed: their cached HTML must not be used again."""
+    conn.execute('UPDATE posts SET version = version + 1 WHERE id IN (SELECT value FROM json_each(?))',
+                 (_id_list(post_ids),))
+
+
+def invalidate_user(conn, user_id):
+    """A profile changed (name, picture): every post showing it, as author or commenter."""
+    conn.execute('''
+        UPDATE posts SET version = version + 1
+        WHERE author_id = ? OR id IN (SELECT post_id FROM comments WHERE author_id = ?)
+    ''', (user_id, user_id))
+
+
+def invalidate_all(conn):
+    conn.execute('UPDATE posts SET version = version + 1')
+
+
+def drop_post(conn, post_id):
+    """Evict a deleted post's entries right away instead of waiting for them to age out."""
+    row = conn.execute('SELECT version FROM posts WHERE id = ?', (post_id,)).fetchone()
+    if not row:
+        return
+    build = current_app.extensions.get('caching_build_id', '')
+    current_app.extensions['fragment_cache'].delete(*[
+        f"{build}:{template}:{post_id}:{row['version']}:{kind}"
+        for template in ('_post.html', '_profile_post.html') for kind in ('visitor', 'member', 'admin')])
@@ -0,0 +1,174 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app, has_app_context
+from werkzeug.local import LocalProxy
+
+from db import get_db
+
+# Single-writer group commit.
+#
+# Routes hand their writes to one thread that owns the only writing connection,
+# instead of each request taking SQLite's write lock and committing on its own.
+# The thread gathers whatever writes are waiting (for up to BATCH_WINDOW after
+# the first one) and runs them in one transaction, each inside its own
+# SAVEPOINT: a write that raises is rolled back alone and its caller gets the
+# exception, the others still commit. Callers block on a future, so a route
+# still sees its write committed before it flashes and redirects.
+#
+# A write is a function `write(conn)`: it runs on the writer's connection, outside
+# the request (no session, g or url_for), and must not commit. Background threads
+# (presence flusher, expiry worker) use the same writer as the routes.
+
+# Most writes per transaction
+BATCH_SIZE = 100
+# Seconds to wait for more writes once one has arrived
+BATCH_WINDOW = 0.002
+# Seconds a caller waits for its write to start before giving up on it
+TIMEOUT = 10
+
+logger = logging.getLogger(__name__)
+
+
+class _Write:
+    __slots__ = ('func', 'args', 'future')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.future = Future()
+
+
+class Writer:
+    """The writer thread and its queue. Started on first use, and again after a fork."""
+
+    def __init__(self, batch_size=BATCH_SIZE, window=BATCH_WINDOW):
+        self.batch_size = batch_size
+        self.window = window
+        self.enabled = True
+        self.pool = None
+        self.batches = 0
+        self.committed = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        self.pool = app.extensions['sqlite_pool']
+        # WRITE_QUEUE = False runs writes inline on the request's connection instead
+        self.enabled = app.config.setdefault('WRITE_QUEUE', True)
+        self.window = app.config.setdefault('WRITE_BATCH_WINDOW', self.window)
+        app.extensions['group_commit'] = self
+        return self
+
+    @property
+    def depth(self):
+        return self._queue.qsize()
+
+    def submit(self, func, *args):
+        """Queue `func(conn, *args)`. Returns a Future of its result, set once committed."""
+        self._ensure_thread()
+        write = _Write(func, args)
+        self._queue.put(write)
+        return write.future
+
+    def run(self, func, *args):
+        """Run `func(conn, *args)` in the next group commit and return its result (or raise its exception)."""
+        if not self.enabled:
+            return self._run_inline(func, args)
+        future = self.submit(func, *args)
+        try:
+            return future.result(TIMEOUT)
+        except TimeoutError:
+            # Still queued: cancel it so it can't commit after the caller was told it failed.
+            # Already running: it will commit or fail shortly, so wait for that instead.
+            if future.cancel():
+                raise
+            return future.result()
+
+    def _run_inline(self, func, args):
+        # On the request's connection, or a pooled one for the background threads
+        own_conn = not has_app_context()
+        conn = self.pool.acquire() if own_conn else get_db()
+        try:
+            result = func(conn, *args)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            if own_conn:
+                self.pool.release(conn)
+        return result
+
+    def _ensure_thread(self):
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            if self._pid != os.getpid():
+                # Whatever the parent had queued belongs to the parent
+                self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        conn = self.pool.connect()
+        # Autocommit mode: the transaction and savepoints are managed explicitly
+        conn.isolation_level = None
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._commit(conn, batch)
+
+    def _commit(self, conn, batch):
+        outcomes = []
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            for write in batch:
+                if not write.future.set_running_or_notify_cancel():
+                    continue
+                conn.execute('SAVEPOINT write')
+                try:
+                    result = write.func(conn, *write.args)
+                except Exception as error:
+                    conn.execute('ROLLBACK TO write')
+                    conn.execute('RELEASE write')
+                    outcomes.append((write, None, error))
+                else:
+                    conn.execute('RELEASE write')
+                    outcomes.append((write, result, None))
+            conn.execute('COMMIT')
+        except Exception as error:
+            # Nothing of this batch was committed: every caller gets the error
+            logger.exception('Group commit of %d writes failed', len(batch))
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            for write in batch:
+                if not write.future.done():
+                    write.future.set_exception(error)
+            return
+        self.batches += 1
+        self.committed += len(outcomes)
+        for write, result, error in outcomes:
+            if error is None:
+                write.future.set_result(result)
+            else:
+                write.future.set_exception(error)
+
+
+# The current app's writer (see create_app in app.py)
+writer = LocalProxy(lambda: current_app.extensions['group_commit'])
@@ -0,0 +1,47 @@
+import multiprocessing
+import os
+import tempfile
+
+import metrics
+import warmup
+
+# gunicorn settings, for `gunicorn -c gunicorn.conf.py` from y2k-blog/ (see wsgi.py).
+# Command-line flags and GUNICORN_CMD_ARGS override them.
+
+wsgi_app = 'wsgi:application'
+bind = os.environ.get('BIND', '127.0.0.1:8000')
+
+# The app is set up and warmed once in the master, then the workers are forked
+preload_app = True
+# One worker per core, up to 4: SQLite takes one writer at a time, more
+# processes would mostly wait for its lock
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+# Live events are delivered in-process by default (see events.py): with several
+# workers they go through the database, or messages would only reach the users
+# of the worker that sent them. Read by create_app, which runs after this file.
+# Same for the metrics: each worker has its own, so a scrape (answered by any of
+# them) adds up the snapshots they all keep in METRICS_DIR (see metrics.py).
+if workers > 1:
+    os.environ.setdefault('FLASK_EVENT_BROKER', 'events.SQLiteBroker')
+    os.environ.setdefault('FLASK_METRICS_DIR', tempfile.mkdtemp(prefix='y2k-metrics-'))
+# Threaded workers: each open /events stream holds a thread
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+keepalive = 5
+
+
+def on_starting(server):
+    # A METRICS_DIR of the environment may hold the totals of the last run
+    if os.environ.get('FLASK_METRICS_DIR'):
+        metrics.clear_snapshots(os.environ['FLASK_METRICS_DIR'])
+
+
+def post_fork(server, worker):
+    import wsgi
+    warmup.after_fork(wsgi.application)
+
+
+def worker_exit(server, worker):
+    # Its last requests stay counted in the totals
+    import wsgi
+    metrics.save_snapshot(wsgi.application)
@@ -0,0 +1,382 @@
+import bisect
+import hmac
+import json
+import os
+import threading
+import time
+
+from flask import Response, current_app, g, request
+from werkzeug.local import LocalProxy
+
+import sqlstats
+
+# Prometheus metrics, served in the text format at /metrics.
+#
+# Counters and histograms live in one shard per thread, so recording is a couple
+# of dict updates with no lock; a scrape adds the shards up (and folds in those
+# of finished threads). Gauges are callbacks evaluated at scrape time. Each app
+# has its own registry (app.extensions['metrics']), so two apps in one process
+# don't report each other's pools and requests.
+#
+# Worker processes (see gunicorn.conf.py) each have their own registry. With
+# METRICS_DIR set, each one saves its values there as <pid>.json every
+# SNAPSHOT_INTERVAL seconds, and a scrape adds those of the other processes to
+# its own: whichever worker answers, counters and histograms are totals of the
+# whole server, and never go down (exited workers' snapshots are kept), so
+# rate() works. Gauges of one process's state get a `pid` label instead, and
+# disappear with their process.
+
+# Request latency buckets, in seconds
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Time to take SQLite's write lock, in seconds (busy_timeout is 5 s)
+LOCK_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds between two snapshots of a process's values in METRICS_DIR
+SNAPSHOT_INTERVAL = 5
+
+
+class _Shard:
+    __slots__ = ('thread', 'counters', 'histograms')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+
+class Registry:
+    """Metric definitions plus the per-thread shards holding their values."""
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = _Shard(None)
+        self._meta = {}      # name -> (type, help, buckets)
+        self._gauges = []    # (name, help, callback, kind)
+
+    def counter(self, name, help):
+        self._meta[name] = ('counter', help, None)
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS):
+        self._meta[name] = ('histogram', help, buckets)
+
+    def gauge(self, name, help, callback, kind='gauge'):
+        """
+        Value read at scrape time: `callback()` returns a number, or a dict of label
+        tuples to numbers. `kind='counter'` for totals kept elsewhere.
+        """
+        self._gauges.append((name, help, callback, kind))
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        buckets = self._meta[name][2]
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(buckets) + 2)
+        histogram[bisect.bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+    def _collect(self):
+        with self._lock:
+            # Threads that are gone can't write anymore: fold them into one shard
+            for shard in [s for s in self._shards if not s.thread.is_alive()]:
+                _merge(self._retired, shard)
+                self._shards.remove(shard)
+            total = _Shard(None)
+            for shard in [self._retired] + self._shards:
+                _merge(total, shard)
+        return total
+
+    def values(self):
+        """This process's counters and histograms (a _Shard), and its gauges read now."""
+        gauges = {}
+        for name, help, callback, kind in self._gauges:
+            values = callback()
+            gauges[name] = values if isinstance(values, dict) else {(): values}
+        return self._collect(), gauges
+
+    def snapshot(self):
+        """values() as JSON, for the other processes (see Snapshots)."""
+        total, gauges = self.values()
+        return json.dumps({
+            'counters': [[name, labels, value] for (name, labels), value in total.counters.items()],
+            'histograms': [[name, labels, value] for (name, labels), value in total.histograms.items()],
+            'gauges': [[name, labels, value] for name, values in gauges.items() for labels, value in values.items()],
+        })
+
+    def render(self, others=None):
+        """
+        The text format. `others` are the snapshots of the other processes, as
+        (pid, alive, JSON) from Snapshots.others(), when there are several.
+        """
+        total, gauges = self.values()
+        if others is not None:
+            kinds = {name: kind for name, _, _, kind in self._gauges}
+            gauges = {name: dict(values) if kinds[name] == 'counter' else _with_pid(values, os.getpid())
+                      for name, values in gauges.items()}
+            for pid, alive, snapshot in others:
+                snapshot = json.loads(snapshot)
+                for name, labels, value in snapshot['counters']:
+                    key = (name, _key(labels))
+                    total.counters[key] = total.counters.get(key, 0) + value
+                for name, labels, value in snapshot['histograms']:
+                    key = (name, _key(labels))
+                    existing = total.histograms.get(key)
+                    total.histograms[key] = value if existing is None else [a + b for a, b in zip(existing, value)]
+                for name, labels, value in snapshot['gauges']:
+                    values = gauges.get(name)
+                    if values is None:
+                        continue
+                    if kinds[name] == 'counter':
+                        values[_key(labels)] = values.get(_key(labels), 0) + value
+                    elif alive:
+                        values.update(_with_pid({_key(labels): value}, pid))
+        lines = []
+        by_name = {}
+        for (name, labels), value in total.counters.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for (name, labels), value in total.histograms.items():
+            by_name.setdefault(name, []).append((labels, value))
+
+        for name, (kind, help, buckets) in self._meta.items():
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+            for labels, value in sorted(by_name.get(name, ()), key=lambda item: item[0]):
+                if kind == 'counter':
+                    lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{_labels(labels)} {_number(value[-1])}')
+                lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+
+        for name, help, callback, kind in self._gauges:
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}']
+            for labels, value in sorted(gauges[name].items()):
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _merge(into, shard):
+    for key, value in list(shard.counters.items()):
+        into.counters[key] = into.counters.get(key, 0) + value
+    for key, value in list(shard.histograms.items()):
+        existing = into.histograms.get(key)
+        into.histograms[key] = list(value) if existing is None else [a + b for a, b in zip(existing, value)]
+
+
+def _key(labels):
+    # JSON turned the label tuples into lists
+    return tuple(tuple(label) for label in labels)
+
+
+def _with_pid(values, pid):
+    return {labels + (('pid', str(pid)),): value for labels, value in values.items()}
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in labels)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def create_registry():
+    """A Registry with the app's counters and histograms (the gauges are added by init_app)."""
+    registry = Registry()
+    registry.counter('http_requests_total', 'Requests handled, by route, method and status.')
+    registry.histogram('http_request_duration_seconds', 'Request latency by route.')
+    registry.counter('db_queries_total', 'SQL statements run by requests, by route.')
+    registry.counter('db_time_seconds_total', 'Time requests spent in SQLite, by route.')
+    registry.histogram('sqlite_write_lock_wait_seconds',
+                       'Duration of the statements that opened a write transaction (mostly waiting for the lock).',
+                       LOCK_BUCKETS)
+    registry.counter('sqlite_busy_total', 'Statements that failed with "database is locked".')
+    registry.counter('messages_sent_total', 'Direct messages sent.')
+    registry.counter('uploads_total', 'New images stored (an upload of one already stored is not counted).')
+    registry.counter('upload_bytes_total', 'Bytes of new images stored.')
+    return registry
+
+
+# The current app's registry (see init_app)
+registry = LocalProxy(lambda: current_app.extensions['metrics'])
+
+
+class _LockObserver:
+    """Told by sqlstats.InstrumentedConnection about an app's write transactions and busy errors."""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def write_lock(self, elapsed):
+        self.registry.observe('sqlite_write_lock_wait_seconds', (), elapsed)
+
+    def busy(self):
+        self.registry.inc('sqlite_busy_total')
+
+
+def message_sent():
+    registry.inc('messages_sent_total')
+
+
+def uploaded(size):
+    registry.inc('uploads_total')
+    registry.inc('upload_bytes_total', value=size)
+
+
+class Snapshots:
+    """
+    Saves a process's metrics to METRICS_DIR every SNAPSHOT_INTERVAL seconds,
+    and reads those of the other processes for a scrape.
+    """
+
+    def __init__(self, app, directory, interval=SNAPSHOT_INTERVAL):
+        self.app = app
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def write(self):
+        # The gauges read the app's extensions
+        with self.app.app_context():
+            snapshot = self.app.extensions['metrics'].snapshot()
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        with open(path + '.part', 'w') as f:
+            f.write(snapshot)
+        # Readers see the previous snapshot or this one, never half of it
+        os.replace(path + '.part', path)
+
+    def others(self):
+        """(pid, alive, JSON) for each snapshot of another process."""
+        for name in os.listdir(self.directory):
+            stem, extension = os.path.splitext(name)
+            if extension != '.json' or not stem.isdigit() or int(stem) == os.getpid():
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    snapshot = f.read()
+            except FileNotFoundError:
+                continue
+            yield int(stem), _alive(int(stem)), snapshot
+
+    def _ensure_thread(self):
+        # Started on the first request (and again after a fork), never at import time
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='metrics-snapshots', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except Exception:
+                # E.g. the directory was removed: the next tick tries again
+                self.app.logger.warning('Could not save the metrics snapshot', exc_info=True)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear_snapshots(directory):
+    """Remove the snapshots of a previous run from `directory`, before the workers start."""
+    for name in os.listdir(directory):
+        if name.endswith(('.json', '.json.part')):
+            os.remove(os.path.join(directory, name))
+
+
+def save_snapshot(app):
+    """Save this process's metrics now, e.g. when a worker exits. Does nothing without METRICS_DIR."""
+    snapshots = app.extensions.get('metrics_snapshots')
+    if snapshots is not None:
+        snapshots.write()
+
+
+def init_app(app, gauges=()):
+    """
+    Record every request and serve /metrics. `gauges` are extra (name, help, callback[, kind]).
+    With METRICS_TOKEN set, scrapes need `Authorization: Bearer <token>`. With
+    METRICS_DIR set, they report every process that shares the directory.
+    """
+    app.config.setdefault('METRICS_TOKEN', None)
+    app.config.setdefault('METRICS_DIR', None)
+    registry = app.extensions['metrics'] = create_registry()
+    pool = app.extensions['sqlite_pool']
+
+    # The pool's connections, the writer's included, report to this app's registry
+    class ObservedConnection(pool.factory):
+        observer = _LockObserver(registry)
+    pool.factory = ObservedConnection
+
+    registry.gauge('sqlite_pool_connections', 'Pooled SQLite connections of this process.',
+                   lambda: {(('state', 'open'),): pool.opened, (('state', 'in_use'),): pool.in_use})
+    registry.gauge('sqlite_pool_size', 'Maximum pooled SQLite connections of this process.', lambda: pool.max_size)
+    for gauge in gauges:
+        registry.gauge(*gauge)
+
+    snapshots = None
+    if app.config['METRICS_DIR']:
+        os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+        snapshots = app.extensions['metrics_snapshots'] = Snapshots(app, app.config['METRICS_DIR'])
+        app.before_request(snapshots._ensure_thread)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        registry.inc('http_requests_total', (('endpoint', endpoint), ('method', request.method),
+                                             ('status', str(response.status_code))))
+        registry.observe('http_request_duration_seconds', (('endpoint', endpoint),), time.perf_counter() - start)
+        stats = sqlstats.current()
+        if stats is not None:
+            registry.inc('db_queries_total', (('endpoint', endpoint),), stats.count)
+            registry.inc('db_time_seconds_total', (('endpoint', endpoint),), stats.time)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        token = app.config['METRICS_TOKEN']
+        if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            return Response('Unauthorized\n', 401, content_type='text/plain')
+        others = None if snapshots is None else list(snapshots.others())
+        return Response(registry.render(others), content_type=CONTENT_TYPE)
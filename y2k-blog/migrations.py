@@ -0,0 +1,396 @@
+import sqlite3
+import sys
+
+# Versioned schema migrations.
+#
+# Each step is idempotent (IF NOT EXISTS / column checks), so it is safe to run
+# against databases created by the old models.py / migrate_v7.py scripts which
+# have no `schema_version` table yet: the steps simply find their work already done.
+# Steps are applied in order, each in its own transaction, and recorded in
+# `schema_version`. Never edit a released step, append a new one instead.
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        return func
+    return register
+
+
+def table_columns(conn, table):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table})')]
+
+
+def add_column(conn, table, column, decl):
+    if column not in table_columns(conn, table):
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {decl}')
+
+
+@migration(1, 'initial schema')
+def initial_schema(conn):
+    # Users table (with profile fields and status fields)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password TEXT NOT NULL,
+            role TEXT NOT NULL DEFAULT 'user',
+            display_name TEXT,
+            bio TEXT,
+            profile_picture TEXT,
+            music_link TEXT,
+            status_note TEXT,
+            last_active TIMESTAMP
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS posts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            content TEXT NOT NULL,
+            post_type TEXT DEFAULT 'message',
+            visibility TEXT DEFAULT 'public',
+            image_url TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            author_id INTEGER,
+            FOREIGN KEY (author_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS comments (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            post_id INTEGER NOT NULL,
+            author_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (post_id) REFERENCES posts (id) ON DELETE CASCADE,
+            FOREIGN KEY (author_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    # item_type can be 'post' or 'comment'
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS likes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            item_type TEXT NOT NULL,
+            item_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(user_id, item_type, item_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            is_read BOOLEAN DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (receiver_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS friends (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender_id INTEGER NOT NULL,
+            receiver_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (sender_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (receiver_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(sender_id, receiver_id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS blocks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            blocker_id INTEGER NOT NULL,
+            blocked_id INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (blocker_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (blocked_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(blocker_id, blocked_id)
+        )
+    ''')
+
+
+@migration(2, 'post types, visibility and images (V6)')
+def post_columns(conn):
+    # Databases created before V6 have the bare posts table
+    add_column(conn, 'posts', 'post_type', "TEXT DEFAULT 'message'")
+    add_column(conn, 'posts', 'visibility', "TEXT DEFAULT 'public'")
+    add_column(conn, 'posts', 'image_url', 'TEXT')
+
+
+@migration(3, 'conversation settings (V7)')
+def conversation_settings(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            friend_id INTEGER NOT NULL,
+            nickname TEXT,
+            show_read_receipts BOOLEAN DEFAULT 1,
+            ephemeral_mode BOOLEAN DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE,
+            FOREIGN KEY (friend_id) REFERENCES users (id) ON DELETE CASCADE,
+            UNIQUE(user_id, friend_id)
+        )
+    ''')
+
+
+@migration(4, 'indexes for the hot route queries')
+def route_indexes(conn):
+    # Feeds: keyset pagination in (created_at, id) order, globally, per visibility and per author
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_posts_created_at ON posts (created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_posts_visibility_created_at ON posts (visibility, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_posts_author_created_at ON posts (author_id, created_at, id)')
+    # Feed hydration: comments of a page of posts, likes counts and "did I like it" (covering)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_comments_post_created_at ON comments (post_id, created_at, id)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_likes_item ON likes (item_type, item_id, user_id)')
+    # DMs: conversation history, unread badges and per-friend unread counts
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_pair_created_at ON messages (sender_id, receiver_id, created_at)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_messages_unread ON messages (receiver_id, is_read, sender_id)')
+    # Friend lists from the receiving side (the sending side is served by the UNIQUE index)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_friends_receiver_status ON friends (receiver_id, status)')
+
+
+@migration(5, 'denormalized like, comment and unread counters')
+def denormalized_counters(conn):
+    add_column(conn, 'posts', 'like_count', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'posts', 'comment_count', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'comments', 'like_count', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'users', 'unread_count', 'INTEGER NOT NULL DEFAULT 0')
+    # Unread messages per (receiver, sender) pair, for the conversation list
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS unread_counts (
+            user_id INTEGER NOT NULL,
+            friend_id INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, friend_id)
+        ) WITHOUT ROWID
+    ''')
+    # Backfill from the source tables
+    conn.execute("UPDATE posts SET like_count = (SELECT COUNT(*) FROM likes WHERE item_type = 'post' AND item_id = posts.id)")
+    conn.execute('UPDATE posts SET comment_count = (SELECT COUNT(*) FROM comments WHERE post_id = posts.id)')
+    conn.execute("UPDATE comments SET like_count = (SELECT COUNT(*) FROM likes WHERE item_type = 'comment' AND item_id = comments.id)")
+    conn.execute('UPDATE users SET unread_count = (SELECT COUNT(*) FROM messages WHERE receiver_id = users.id AND is_read = 0)')
+    conn.execute('DELETE FROM unread_counts')
+    conn.execute('''
+        INSERT INTO unread_counts (user_id, friend_id, count)
+        SELECT receiver_id, sender_id, COUNT(*) FROM messages WHERE is_read = 0 GROUP BY receiver_id, sender_id
+    ''')
+
+
+
+@migration(6, 'conversation summaries')
+def conversations(conn):
+    # One row per pair of users (user_a < user_b) that have exchanged messages.
+    # unread_a counts messages waiting for user_a, unread_b those waiting for user_b.
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            user_a INTEGER NOT NULL,
+            user_b INTEGER NOT NULL,
+            last_message_id INTEGER,
+            last_activity TIMESTAMP,
+            unread_a INTEGER NOT NULL DEFAULT 0,
+            unread_b INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_a, user_b)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('DELETE FROM conversations')
+    conn.execute('''
+        INSERT INTO conversations (user_a, user_b, last_message_id, last_activity, unread_a, unread_b)
+        SELECT user_a, user_b, MAX(id), MAX(created_at),
+               SUM(receiver_id = user_a AND is_read = 0), SUM(receiver_id = user_b AND is_read = 0)
+        FROM (SELECT id, created_at, receiver_id, is_read,
+                     MIN(sender_id, receiver_id) AS user_a, MAX(sender_id, receiver_id) AS user_b
+              FROM messages)
+        GROUP BY user_a, user_b
+    ''')
+    # The per-pair unread counters now live in `conversations`
+    conn.execute('DROP TABLE IF EXISTS unread_counts')
+
+
+# bleach stores message text entity-escaped; the search index gets it back as typed
+UNESCAPED_CONTENT = "replace(replace(replace(replace({0}.content, '&lt;', '<'), '&gt;', '>'), '&quot;', '\"'), '&amp;', '&')"
+PAIR_TOKEN = "'p' || MIN({0}.sender_id, {0}.receiver_id) || 'x' || MAX({0}.sender_id, {0}.receiver_id)"
+
+
+@migration(7, 'full-text message search')
+def message_search(conn):
+    # `pair` is a single token per conversation ("p3x5") so scoping to the two
+    # participants happens inside the full-text index instead of after it
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            body, pair, tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, body, pair)
+            VALUES (new.id, {UNESCAPED_CONTENT.format('new')}, {PAIR_TOKEN.format('new')});
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            DELETE FROM messages_fts WHERE rowid = old.id;
+        END
+    ''')
+    conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+            UPDATE messages_fts SET body = {UNESCAPED_CONTENT.format('new')} WHERE rowid = new.id;
+        END
+    ''')
+    backfill_message_search(conn)
+
+
+def backfill_message_search(conn):
+    """(Re)build the message search index from `messages`. Returns the number of messages indexed."""
+    conn.execute('DELETE FROM messages_fts')
+    return conn.execute(f'''
+        INSERT INTO messages_fts (rowid, body, pair)
+        SELECT id, {UNESCAPED_CONTENT.format('messages')}, {PAIR_TOKEN.format('messages')} FROM messages
+    ''').rowcount
+
+
+@migration(8, 'raw markdown source for posts and comments')
+def content_source(conn):
+    # Older rows only have their rendered HTML; they stay as they are (NULL source)
+    add_column(conn, 'posts', 'content_raw', 'TEXT')
+    add_column(conn, 'comments', 'content_raw', 'TEXT')
+
+
+@migration(9, 'materialized home timelines')
+def timelines(conn):
+    # Filled on a user's first feed page and by fan-out on write (see timeline.py), so nothing to backfill
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS timeline (
+            user_id INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL,
+            post_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, created_at, post_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_timeline_post ON timeline (post_id)')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS timeline_state (
+            user_id INTEGER PRIMARY KEY,
+            size INTEGER NOT NULL DEFAULT 0,
+            capped INTEGER NOT NULL DEFAULT 0,
+            built_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE
+        )
+    ''')
+
+
+@migration(10, 'social graph change log')
+def social_graph_log(conn):
+    # Lets every process keep its in-memory social graph current (see socialgraph.py)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS graph_changes (
+            version INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_a INTEGER NOT NULL,
+            user_b INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('social_graph_version', 0)")
+
+
+@migration(11, 'ephemeral conversations index')
+def ephemeral_index(conn):
+    # The expiry worker lists ephemeral conversations without scanning every setting
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_settings_ephemeral ON conversation_settings (user_id, friend_id)
+        WHERE ephemeral_mode = 1
+    ''')
+
+
+@migration(12, 'page cache version')
+def content_version(conn):
+    # Bumped by writes that change feed or profile pages, used for their ETags (see caching.py)
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('content_version', CAST(strftime('%s', 'now') AS INTEGER) * 1000)")
+
+
+@migration(13, 'post versions')
+def post_versions(conn):
+    # Bumped whenever a post's rendered HTML changes; part of its fragment cache key (see fragments.py)
+    add_column(conn, 'posts', 'version', 'INTEGER NOT NULL DEFAULT 0')
+
+
+@migration(14, 'conversation settings version')
+def settings_version(conn):
+    # Bumped by every settings change, so each process drops its cached settings (see settings.py)
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('settings_version', 0)")
+
+
+@migration(15, 'event log')
+def event_log(conn):
+    # Live events between processes when EVENT_BROKER is events.SQLiteBroker; only the last minute is kept.
+    # AUTOINCREMENT: ids are never reused once pruned, readers track the last one they saw
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS event_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT NOT NULL,
+            event TEXT NOT NULL,
+            data TEXT NOT NULL,
+            created_at REAL NOT NULL
+        )
+    ''')
+
+
+@migration(16, 'comments by author')
+def comment_author_index(conn):
+    # A profile change finds the posts its user commented on (fragments.invalidate_user)
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_comments_author ON comments (author_id)')
+
+
+def current_version(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def upgrade(db_path='database.db', verbose=False):
+    """Apply every pending migration to `db_path`. Returns the resulting schema version."""
+    # Autocommit mode: transactions are opened explicitly so DDL is atomic too
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    try:
+        version = current_version(conn)
+        for step_version, name, func in sorted(MIGRATIONS):
+            if step_version <= version:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                func(conn)
+                conn.execute('INSERT INTO schema_version (version, name) VALUES (?, ?)', (step_version, name))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+            version = step_version
+            if verbose:
+                print(f"Applied migration {step_version}: {name}")
+        return version
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    db_path = sys.argv[1] if len(sys.argv) > 1 else 'database.db'
+    print(f"Schema is at version {upgrade(db_path, verbose=True)}.")
@@ -0,0 +1,162 @@
+import atexit
+import logging
+import os
+import threading
+import time
+import weakref
+from datetime import datetime, timedelta
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+# How often pending activity is written back to users.last_active
+FLUSH_INTERVAL = 5
+# Flush from the request thread if the background flusher has fallen this far behind
+STALE_AFTER = 30
+# Activity older than this no longer changes anyone's status, so it can be dropped from memory
+FORGET_AFTER = 3600
+
+logger = logging.getLogger(__name__)
+
+# Trackers flushed when the process exits; weak, so an app that is gone isn't kept for it
+_trackers = weakref.WeakSet()
+
+
+def write_last_active(conn, rows):
+    conn.executemany('UPDATE users SET last_active = ? WHERE id = ?', rows)
+
+
+class PresenceTracker:
+    """
+    In-memory record of when each logged-in user was last seen.
+
+    Requests only touch a dict; a background thread hands the accumulated
+    timestamps to the writer (see groupcommit.py) as one batched UPDATE of
+    `users.last_active` every few seconds.
+    Status lookups read the tracker first, so the online dots stay accurate
+    between flushes without turning every page view into a write transaction.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, stale_after=STALE_AFTER):
+        self.flush_interval = flush_interval
+        self.stale_after = stale_after
+        self.writer = None
+        self._lock = threading.Lock()
+        self._seen = {}      # user_id -> datetime (UTC, like CURRENT_TIMESTAMP)
+        self._pending = {}   # user_id -> datetime not yet written to the DB
+        self._in_flight = []  # per flush being written: the users who logged out since it started
+        self._last_flush = time.monotonic()
+        self._thread = None
+        self._pid = None
+
+    def init_app(self, app):
+        # The writer is set up first (see create_app in app.py)
+        self.writer = app.extensions['group_commit']
+        app.extensions['presence'] = self
+        _trackers.add(self)
+        return self
+
+    def touch(self, user_id):
+        now = datetime.utcnow().replace(microsecond=0)
+        with self._lock:
+            self._seen[user_id] = now
+            self._pending[user_id] = now
+        self._ensure_flusher()
+
+    def forget(self, user_id):
+        """The user logged out: drop what we know so a flush can't resurrect them."""
+        with self._lock:
+            self._seen.pop(user_id, None)
+            self._pending.pop(user_id, None)
+            # Including the flushes that already took their activity (see flush)
+            for forgotten in self._in_flight:
+                forgotten.add(user_id)
+
+    def last_seen(self, user_id):
+        return self._seen.get(user_id)
+
+    def online_since(self, cutoff):
+        """Number of users seen at or after `cutoff` (a UTC datetime)."""
+        with self._lock:
+            return sum(1 for seen in self._seen.values() if seen >= cutoff)
+
+    def flush(self):
+        """Write pending activity in one `executemany`. Returns the number of users written."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+            horizon = datetime.utcnow() - timedelta(seconds=FORGET_AFTER)
+            for user_id in [u for u, seen in self._seen.items() if seen < horizon]:
+                del self._seen[user_id]
+            if not pending or self.writer is None:
+                return 0
+            forgotten = set()
+            self._in_flight.append(forgotten)
+
+        def write(conn):
+            # Under the lock: a logout either drops its user from these rows, or
+            # comes after them and its `last_active = NULL` is written after them
+            with self._lock:
+                rows = [(seen.strftime('%Y-%m-%d %H:%M:%S'), user_id)
+                        for user_id, seen in pending.items() if user_id not in forgotten]
+                write_last_active(conn, rows)
+            return len(rows)
+
+        try:
+            return self.writer.run(write)
+        except Exception:
+            # Put the batch back unless newer activity has been recorded meanwhile
+            with self._lock:
+                for user_id, seen in pending.items():
+                    if user_id not in forgotten:
+                        self._pending.setdefault(user_id, seen)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.remove(forgotten)
+
+    def flush_if_stale(self):
+        """Fallback for when the flusher thread is not keeping up (or not running)."""
+        if self._pending and time.monotonic() - self._last_flush > self.stale_after:
+            self.flush()
+
+    def _ensure_flusher(self):
+        # Started lazily (and restarted after a fork) so no thread exists before workers fork
+        if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None and self._thread.is_alive():
+                return
+            self._pid = os.getpid()
+            # Holds the tracker only while flushing, so it goes away with its app
+            self._thread = threading.Thread(target=_flush_every, args=(weakref.ref(self), self.flush_interval),
+                                            name='presence-flusher', daemon=True)
+            self._thread.start()
+
+
+def _flush_every(ref, interval):
+    while True:
+        time.sleep(interval)
+        tracker = ref()
+        if tracker is None:
+            return
+        try:
+            tracker.flush()
+        except Exception:
+            # Keep going: the batch was re-queued and the next tick retries it
+            pass
+        del tracker
+
+
+@atexit.register
+def _flush_at_exit():
+    for tracker in list(_trackers):
+        try:
+            tracker.flush()
+        except Exception:
+            # E.g. the writer thread can no longer be started this late in the shutdown
+            logger.warning('Could not write the last activity on exit', exc_info=True)
+
+
+# The current app's tracker (see create_app in app.py)
+tracker = LocalProxy(lambda: current_app.extensions['presence'])
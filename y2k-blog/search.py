@@ -0,0 +1,84 @@
+import html
+import re
+
+# Full-text search in a conversation, backed by the `messages_fts` FTS5 table
+# (kept in sync by triggers, see migration 7). The index holds the text as the
+# user typed it, accent-insensitive, so "ete" finds "été". The tokenizer skips
+# punctuation, so a query with no word at all ("&", "?!") looks for the text
+# itself in the conversation's rows of the index instead.
+
+SEARCH_LIMIT = 50
+# Characters kept on each side of the first match, in the snippets of those queries
+SNIPPET_CONTEXT = 40
+
+# Snippet markers: control characters that can't come from a form field
+MARK_START, MARK_END = '\x02', '\x03'
+
+
+def pair_expression(user_id, other_id):
+    """FTS5 query for every message of this conversation."""
+    return f'pair : p{min(user_id, other_id)}x{max(user_id, other_id)}'
+
+
+def match_expression(search_query, user_id, other_id):
+    """FTS5 query: every word as a prefix, restricted to this conversation's pair token."""
+    words = re.findall(r'\w+', search_query)
+    if not words:
+        return None
+    terms = ' AND '.join('"{}"*'.format(word.replace('"', '')) for word in words)
+    return f'{pair_expression(user_id, other_id)} AND body : ({terms})'
+
+
+def highlight(snippet):
+    """Escape the snippet and turn the FTS markers into <mark> tags."""
+    return html.escape(snippet).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+
+
+def mark_text(body, text):
+    """A snippet of `body` around the first `text`, with the markers of snippet() around each one."""
+    first = body.find(text)
+    start, end = max(first - SNIPPET_CONTEXT, 0), first + len(text) + SNIPPET_CONTEXT
+    snippet = body[start:end].replace(text, f'{MARK_START}{text}{MARK_END}')
+    return ('…' if start else '') + snippet + ('…' if end < len(body) else '')
+
+
+def search_messages(conn, user_id, other_id, search_query, ephemeral=False, limit=SEARCH_LIMIT):
+    """
+    Best matches between two users, each with a highlighted `snippet`: most
+    relevant first, or newest first for a query of punctuation only.
+    """
+    expression = match_expression(search_query, user_id, other_id)
+    text = search_query.strip()
+    if expression is None and not text:
+        return []
+    if expression is not None:
+        snippet = f"snippet(messages_fts, 0, '{MARK_START}', '{MARK_END}', '…', 16)"
+        params = [expression]
+    else:
+        snippet = 'messages_fts.body'
+        params = [pair_expression(user_id, other_id)]
+    query = f'''
+        SELECT m.*, u.username as sender_name, u.profile_picture as sender_pfp, {snippet} AS snippet
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        JOIN users u ON m.sender_id = u.id
+        WHERE messages_fts MATCH ?
+          AND ((m.sender_id = ? AND m.receiver_id = ?) OR (m.sender_id = ? AND m.receiver_id = ?))
+    '''
+    params += [user_id, other_id, other_id, user_id]
+    if expression is None:
+        query += ' AND instr(messages_fts.body, ?) > 0'
+        params.append(text)
+    if ephemeral:
+        query += " AND m.created_at >= datetime('now', '-1 day')"
+    query += ' ORDER BY messages_fts.rank LIMIT ?' if expression is not None else ' ORDER BY m.id DESC LIMIT ?'
+    params.append(limit)
+
+    results = []
+    for row in conn.execute(query, params):
+        message = dict(row)
+        if expression is None:
+            message['snippet'] = mark_text(message['snippet'], text)
+        message['snippet'] = highlight(message['snippet'])
+        results.append(message)
+    return results
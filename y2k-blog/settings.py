@@ -0,0 +1,101 @@
+import threading
+from collections import namedtuple
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+# Per-conversation settings (`conversation_settings`): one row per (user, friend),
+# written only when the user saves the form. A missing row means the defaults.
+#
+# Each process caches the resolved settings per (user, friend). Every save bumps
+# `settings_version` in `meta` in the same transaction; a process compares it
+# with its own once per request and drops its cache when it moved, so a change
+# made by any worker is seen by all of them.
+
+Settings = namedtuple('Settings', 'nickname show_read_receipts ephemeral_mode')
+DEFAULTS = Settings(nickname=None, show_read_receipts=True, ephemeral_mode=False)
+VERSION_KEY = 'settings_version'
+# Cached pairs per process; the cache starts over when it's full
+MAX_ENTRIES = 10000
+
+VERSION_SQL = 'SELECT value FROM meta WHERE key = ?'
+SETTINGS_SQL = '''
+    SELECT nickname, show_read_receipts, ephemeral_mode FROM conversation_settings
+    WHERE user_id = ? AND friend_id = ?
+'''
+
+
+class SettingsStore:
+    """Resolved settings of (user_id, friend_id) pairs. `sync()` before reading."""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.version = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.extensions['conversation_settings'] = self
+        return self
+
+    def sync(self, conn):
+        """Drop the cache if any process saved settings since. One primary key lookup."""
+        row = conn.execute(VERSION_SQL, (VERSION_KEY,)).fetchone()
+        return self.at_version(row[0] if row else 0)
+
+    def at_version(self, version):
+        """sync() for callers that read the version themselves (the ASGI mode, see asgi.py)."""
+        if version != self.version:
+            with self._lock:
+                self._entries = {}
+                self.version = version
+        return self
+
+    def get(self, conn, user_id, friend_id):
+        """What user_id chose for their conversation with friend_id."""
+        key = (user_id, friend_id)
+        settings = self._entries.get(key)
+        if settings is None:
+            version = self.version
+            settings = self.remember(key, conn.execute(SETTINGS_SQL, key).fetchone(), version)
+        return settings
+
+    def cached(self, user_id, friend_id):
+        return self._entries.get((user_id, friend_id))
+
+    def remember(self, key, row, version):
+        """Resolve a SETTINGS_SQL row (None: defaults) and cache it, read at `version`."""
+        settings = DEFAULTS if row is None else Settings(row['nickname'], bool(row['show_read_receipts']),
+                                                         bool(row['ephemeral_mode']))
+        with self._lock:
+            # Not if the cache was dropped meanwhile: the row may predate that change
+            if version == self.version:
+                if len(self._entries) >= self.max_entries:
+                    self._entries = {}
+                self._entries[key] = settings
+        return settings
+
+    def ephemeral(self, conn, user_a, user_b):
+        """Messages between the two expire when either side turned ephemeral mode on."""
+        return self.get(conn, user_a, user_b).ephemeral_mode or self.get(conn, user_b, user_a).ephemeral_mode
+
+    def forget(self, user_id, friend_id):
+        with self._lock:
+            self._entries.pop((user_id, friend_id), None)
+
+
+def save(conn, user_id, friend_id, nickname, show_read_receipts, ephemeral_mode):
+    """Store user_id's settings for friend_id, created or replaced in one statement. Call before committing."""
+    conn.execute('''
+        INSERT INTO conversation_settings (user_id, friend_id, nickname, show_read_receipts, ephemeral_mode)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, friend_id) DO UPDATE SET
+            nickname = excluded.nickname,
+            show_read_receipts = excluded.show_read_receipts,
+            ephemeral_mode = excluded.ephemeral_mode
+    ''', (user_id, friend_id, nickname or None, int(show_read_receipts), int(ephemeral_mode)))
+    conn.execute('UPDATE meta SET value = value + 1 WHERE key = ?', (VERSION_KEY,))
+
+
+# The current app's store (see create_app in app.py)
+store = LocalProxy(lambda: current_app.extensions['conversation_settings'])
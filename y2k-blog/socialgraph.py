@@ -0,0 +1,153 @@
+import threading
+from collections import namedtuple
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+# In-memory copy of the social graph (`friends` and `blocks`) so relationship
+# checks on the hot paths are set lookups (plain frozensets of ids) instead of queries.
+#
+# Every change to the graph is logged in `graph_changes` with the pair of users it
+# concerns, and bumps `social_graph_version` in `meta`, in the same transaction.
+# A process compares its version with the database once per request and replays
+# the pairs it missed, so every worker sees the other workers' changes.
+
+# Changes kept in the log; a process further behind than this reloads everything
+CHANGE_LOG_SIZE = 1000
+VERSION_KEY = 'social_graph_version'
+# Marks the statements that read whole tables on purpose (see check_query_plans.py)
+FULL_LOAD = '/* full load */'
+
+
+# A user's edges, each a frozenset of user ids
+Adjacency = namedtuple('Adjacency', 'friends pending_out pending_in blocking blocked_by')
+FRIENDS, PENDING_OUT, PENDING_IN, BLOCKING, BLOCKED_BY = range(len(Adjacency._fields))
+NOBODY = Adjacency(*[frozenset()] * len(Adjacency._fields))
+
+
+def collect_edges(friend_rows, block_rows):
+    """{user_id: a list of sets, one per Adjacency field} of the edges in these rows."""
+    edges = {}
+
+    def add(user_id, kind, other_id):
+        edges.setdefault(user_id, [set() for _ in Adjacency._fields])[kind].add(other_id)
+
+    for sender_id, receiver_id, status in friend_rows:
+        if status == 'accepted':
+            add(sender_id, FRIENDS, receiver_id)
+            add(receiver_id, FRIENDS, sender_id)
+        else:
+            add(sender_id, PENDING_OUT, receiver_id)
+            add(receiver_id, PENDING_IN, sender_id)
+    for blocker_id, blocked_id in block_rows:
+        add(blocker_id, BLOCKING, blocked_id)
+        add(blocked_id, BLOCKED_BY, blocker_id)
+    return edges
+
+
+class SocialGraph:
+    """
+    Each user's accepted friends, pending requests both ways and blocks both ways,
+    as one immutable Adjacency per user. Keep the answers of `relationship()` in
+    line with what the `friends` and `blocks` tables say; `sync()` brings them up
+    to date.
+
+    Readers take no lock: `sync()` never changes a record in place. It replaces
+    the whole dict after a full load, or the records of the two users a change
+    concerns, each in one assignment. A reader sees a user's edges before or
+    after a change, never halfway.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self._users = {}
+
+    def init_app(self, app):
+        app.extensions['social_graph'] = self
+        return self
+
+    def sync(self, conn):
+        """Catch up with the database. One primary key lookup when nothing changed."""
+        row = conn.execute('SELECT value FROM meta WHERE key = ?', (VERSION_KEY,)).fetchone()
+        version = row[0] if row else 0
+        if version == self.version:
+            return self
+        with self._lock:
+            if version == self.version:
+                return self
+            changes = []
+            if self.version is not None:
+                changes = conn.execute('SELECT version, user_a, user_b FROM graph_changes WHERE version > ? ORDER BY version',
+                                       (self.version,)).fetchall()
+            if self.version is None or not changes or changes[0][0] != self.version + 1:
+                # First use, or the log no longer reaches back to our version
+                self._load_all(conn)
+            else:
+                for _, user_a, user_b in changes:
+                    self._refresh_pair(conn, user_a, user_b)
+            self.version = version
+        return self
+
+    def _load_all(self, conn):
+        edges = collect_edges(conn.execute(f'SELECT {FULL_LOAD} sender_id, receiver_id, status FROM friends'),
+                              conn.execute(f'SELECT {FULL_LOAD} blocker_id, blocked_id FROM blocks'))
+        self._users = {user_id: Adjacency(*map(frozenset, sets)) for user_id, sets in edges.items()}
+
+    def _refresh_pair(self, conn, a, b):
+        edges = collect_edges(conn.execute('''
+            SELECT sender_id, receiver_id, status FROM friends
+            WHERE (sender_id = ? AND receiver_id = ?) OR (sender_id = ? AND receiver_id = ?)
+        ''', (a, b, b, a)), conn.execute('''
+            SELECT blocker_id, blocked_id FROM blocks
+            WHERE (blocker_id = ? AND blocked_id = ?) OR (blocker_id = ? AND blocked_id = ?)
+        ''', (a, b, b, a)))
+        # Each side keeps its edges to everyone else; those between the two are what the rows say now
+        updated = {}
+        for x, y in ((a, b), (b, a)):
+            current = self._users.get(x, NOBODY)
+            found = edges.get(x, [()] * len(Adjacency._fields))
+            updated[x] = Adjacency(*((old - {y}) | frozenset(new) for old, new in zip(current, found)))
+        for user_id, adjacency in updated.items():
+            self._users[user_id] = adjacency
+
+    def relationship(self, a, b):
+        """
+        Relationship of user a towards user b, as shown on profiles:
+        'blocked_by_them', 'blocked', 'friends', 'request_sent', 'request_received' or 'none'.
+        """
+        edges = self._users.get(a, NOBODY)
+        if b in edges.blocked_by:
+            return 'blocked_by_them'
+        if b in edges.blocking:
+            return 'blocked'
+        if b in edges.friends:
+            return 'friends'
+        if b in edges.pending_out:
+            return 'request_sent'
+        if b in edges.pending_in:
+            return 'request_received'
+        return 'none'
+
+    def are_friends(self, a, b):
+        return b in self._users.get(a, NOBODY).friends
+
+    def has_friend_row(self, a, b):
+        """True if a `friends` row (accepted or pending, either direction) links a and b."""
+        edges = self._users.get(a, NOBODY)
+        return b in edges.friends or b in edges.pending_out or b in edges.pending_in
+
+    def friend_ids(self, a):
+        return self._users.get(a, NOBODY).friends
+
+
+def record_change(conn, user_a, user_b):
+    """Log a change between two users in the current transaction. Returns the new graph version."""
+    version = conn.execute('INSERT INTO graph_changes (user_a, user_b) VALUES (?, ?)', (user_a, user_b)).lastrowid
+    conn.execute('UPDATE meta SET value = ? WHERE key = ?', (version, VERSION_KEY))
+    conn.execute('DELETE FROM graph_changes WHERE version <= ?', (version - CHANGE_LOG_SIZE,))
+    return version
+
+
+# The current app's graph (see create_app in app.py)
+graph = LocalProxy(lambda: current_app.extensions['social_graph'])
@@ -0,0 +1,239 @@
+import contextvars
+import logging
+import random
+import re
+import sqlite3
+import time
+from logging.handlers import RotatingFileHandler
+
+from flask import render_template, request
+
+# SQL instrumentation for pooled connections (see db.py).
+#
+# Every request counts its statements and the time spent executing them, which
+# costs two clock reads per statement, and gets a `Server-Timing` header. A
+# sample of the requests (SQL_STATS_SAMPLE_RATE) is also measured in detail:
+# fetch time and rows per statement, grouped by normalized SQL. The debug panel
+# (SQL_TOOLBAR) shows that for every page. Statements slower than
+# SLOW_QUERY_MS go to a rotating log.
+
+SAMPLE_RATE = 0.01
+SLOW_QUERY_MS = 100
+SLOW_QUERY_LOG = 'slow_queries.log'
+SLOW_QUERY_LOG_BYTES = 1024 * 1024
+SLOW_QUERY_LOG_BACKUPS = 5
+# Statements listed per request in the panel and in `RequestStats.slowest`
+SLOWEST = 10
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+SPACE_RE = re.compile(r'\s+')
+
+slow_log = logging.getLogger('sqlstats.slow')
+# A context variable rather than a thread local: the async views of asgi.py share a thread
+_stats = contextvars.ContextVar('sqlstats', default=None)
+
+
+def normalize(sql):
+    """Collapse whitespace and literals, so the same statement groups together."""
+    sql = STRING_RE.sub('?', sql)
+    sql = NUMBER_RE.sub('?', sql)
+    return SPACE_RE.sub(' ', sql).strip()
+
+
+class RequestStats:
+    """What one request did with the database."""
+
+    def __init__(self, detailed, slow_ms):
+        self.detailed = detailed
+        self.slow_ms = slow_ms
+        self.count = 0
+        self.time = 0.0
+        self.rows = 0
+        self.statements = []  # detailed only: [sql, seconds, rows]
+        self.started = time.perf_counter()
+
+    def executed(self, sql, parameters, elapsed):
+        self.count += 1
+        self.time += elapsed
+        if self.detailed:
+            record = [sql, elapsed, 0]
+            self.statements.append(record)
+            return record
+        if elapsed * 1000 >= self.slow_ms:
+            log_slow(sql, parameters, elapsed)
+        return None
+
+    def fetched(self, record, rows, elapsed):
+        record[1] += elapsed
+        record[2] += rows
+        self.time += elapsed
+        self.rows += rows
+
+    def slowest(self, limit=SLOWEST):
+        """Statements grouped by normalized SQL, most time first: (sql, count, seconds, rows)."""
+        groups = {}
+        for sql, elapsed, rows in self.statements:
+            group = groups.setdefault(normalize(sql), [0, 0.0, 0])
+            group[0] += 1
+            group[1] += elapsed
+            group[2] += rows
+        ranked = sorted(groups.items(), key=lambda item: item[1][1], reverse=True)
+        return [(sql, count, elapsed, rows) for sql, (count, elapsed, rows) in ranked[:limit]]
+
+    def finish(self):
+        # Detailed statements are only complete once fetched: check them now
+        for sql, elapsed, rows in self.statements:
+            if elapsed * 1000 >= self.slow_ms:
+                log_slow(sql, None, elapsed, rows)
+
+
+def log_slow(sql, parameters, elapsed, rows=None):
+    path = request.path if request else '-'
+    slow_log.warning('%.1f ms %s%s: %s%s', elapsed * 1000, path, '' if rows is None else f' ({rows} rows)',
+                     normalize(sql), f' -- {parameters!r:.200}' if parameters else '')
+
+
+def current():
+    """Stats of the current request, or None."""
+    return _stats.get()
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """Cursor of a detailed request: times its fetches and counts the rows."""
+
+    stats = None
+    record = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.record = self.stats.executed(sql, parameters, time.perf_counter() - start)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self.stats.fetched(self.record, int(row is not None), time.perf_counter() - start)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self.stats.fetched(self.record, len(rows), time.perf_counter() - start)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self.stats.fetched(self.record, len(rows), time.perf_counter() - start)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.stats.fetched(self.record, 0, time.perf_counter() - start)
+            raise
+        self.stats.fetched(self.record, 1, time.perf_counter() - start)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """
+    Connection reporting to the current request's stats. `observer` (see metrics.py),
+    when set, is told how long opening each write transaction took and about
+    "database is locked" failures, in and out of requests.
+    """
+
+    observer = None
+
+    def execute(self, sql, parameters=()):
+        stats = _stats.get()
+        observer = self.observer
+        if stats is None and observer is None:
+            return super().execute(sql, parameters)
+        opening = not self.in_transaction
+        start = time.perf_counter()
+        try:
+            if stats is not None and stats.detailed:
+                cursor = self.cursor(InstrumentedCursor)
+                cursor.stats = stats
+                return cursor.execute(sql, parameters)
+            return super().execute(sql, parameters)
+        except sqlite3.OperationalError as error:
+            if observer is not None and 'locked' in str(error):
+                observer.busy()
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            if stats is not None and not stats.detailed:
+                stats.executed(sql, parameters, elapsed)
+            # sqlite3 opens the transaction (and takes the write lock) on the first write
+            if opening and observer is not None and self.in_transaction:
+                observer.write_lock(elapsed)
+
+    def executemany(self, sql, seq_of_parameters):
+        stats = _stats.get()
+        if stats is None:
+            return super().executemany(sql, seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            stats.executed(sql, None, time.perf_counter() - start)
+
+    def commit(self):
+        stats = _stats.get()
+        if stats is None or not self.in_transaction:
+            return super().commit()
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            stats.executed('COMMIT', None, time.perf_counter() - start)
+
+
+def init_app(app):
+    app.config.setdefault('SQL_TOOLBAR', app.debug)
+    app.config.setdefault('SQL_STATS_SAMPLE_RATE', SAMPLE_RATE)
+    app.config.setdefault('SLOW_QUERY_MS', SLOW_QUERY_MS)
+    app.config.setdefault('SLOW_QUERY_LOG', SLOW_QUERY_LOG)
+    app.extensions['sqlite_pool'].factory = InstrumentedConnection
+
+    if app.config['SLOW_QUERY_LOG'] and not slow_log.handlers:
+        handler = RotatingFileHandler(app.config['SLOW_QUERY_LOG'], maxBytes=SLOW_QUERY_LOG_BYTES,
+                                      backupCount=SLOW_QUERY_LOG_BACKUPS, delay=True)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_log.addHandler(handler)
+        slow_log.propagate = False
+
+    @app.before_request
+    def start_stats():
+        detailed = app.config['SQL_TOOLBAR'] or random.random() < app.config['SQL_STATS_SAMPLE_RATE']
+        _stats.set(RequestStats(detailed, app.config['SLOW_QUERY_MS']))
+
+    @app.after_request
+    def report_stats(response):
+        stats = current()
+        if stats is None:
+            return response
+        total = (time.perf_counter() - stats.started) * 1000
+        response.headers.add('Server-Timing', f'db;dur={stats.time * 1000:.2f};desc="{stats.count} queries"')
+        response.headers.add('Server-Timing', f'app;dur={total:.2f}')
+        if (app.config['SQL_TOOLBAR'] and response.status_code == 200 and response.mimetype == 'text/html'
+                and not response.is_streamed):
+            html = response.get_data(as_text=True)
+            if '</body>' in html:
+                panel = render_template('_sql_toolbar.html', stats=stats, total_ms=total)
+                response.set_data(html.replace('</body>', panel + '</body>', 1))
+        return response
+
+    @app.teardown_request
+    def end_stats(exception=None):
+        stats = _stats.get()
+        if stats is not None:
+            _stats.set(None)
+            stats.finish()
@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+# The modules live at the top of y2k-blog/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import migrations
+from app import create_app
+
+
+@pytest.fixture
+def database(tmp_path):
+    """A new database with the current schema."""
+    path = str(tmp_path / 'database.db')
+    migrations.upgrade(path)
+    return path
+
+
+@pytest.fixture
+def app(database):
+    # No expiry worker: nothing expires during a test
+    return create_app({'TESTING': True, 'DATABASE': database, 'PURGE_INTERVAL': 0})
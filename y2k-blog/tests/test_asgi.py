@@ -0,0 +1,132 @@
+import asyncio
+import importlib
+import io
+import sqlite3
+
+import pytest
+
+pytest.importorskip('aiosqlite')
+
+
+@pytest.fixture
+def asgi(app, database, monkeypatch):
+    # asgi.py sets up its own app from the environment when imported
+    monkeypatch.setenv('FLASK_DATABASE', database)
+    monkeypatch.setenv('FLASK_PURGE_INTERVAL', '0')
+    module = importlib.import_module('asgi')
+    return module.Application(app)
+
+
+def logged_in_cookie(app, database):
+    conn = sqlite3.connect(database)
+    conn.executemany("INSERT INTO users (username, password) VALUES (?, 'pw')", [('user1',), ('user2',)])
+    conn.execute("INSERT INTO friends (sender_id, receiver_id, status) VALUES (1, 2, 'accepted')")
+    conn.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'user1', 'password': 'pw'})
+    return f"session={client.get_cookie('session').value}"
+
+
+def call(application, method, path, cookie, body=b''):
+    """Status, headers (a dict of lists) and body of one request to the ASGI application."""
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': b'', 'http_version': '1.1',
+             'scheme': 'http', 'server': ('localhost', 80),
+             'headers': [(b'cookie', cookie.encode()), (b'content-type', b'application/x-www-form-urlencoded')]}
+    incoming = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        if incoming:
+            return incoming.pop(0)
+        # Then the client goes away (ends the event stream)
+        await asyncio.sleep(0.05)
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(application(scope, receive, send))
+    headers = {}
+    for name, value in sent[0]['headers']:
+        headers.setdefault(name.decode(), []).append(value.decode())
+    return sent[0]['status'], headers, b''.join(message.get('body', b'') for message in sent[1:])
+
+
+def test_async_views_run_the_flask_hooks(app, database, asgi):
+    cookie = logged_in_cookie(app, database)
+
+    status, headers, body = call(asgi, 'GET', '/unread', cookie)
+    assert status == 200 and body == b'{"count":0}\n'
+    # caching.cache_headers and sqlstats.report_stats, with the aiosqlite query counted
+    assert headers['cache-control'] == ['no-store, no-cache, must-revalidate, max-age=0']
+    assert any('desc="1 queries"' in value for value in headers['server-timing'])
+
+    status, headers, body = call(asgi, 'GET', '/events', cookie)
+    assert status == 200 and body.startswith(b'retry: 3000')
+    assert headers['content-type'] == ['text/event-stream; charset=utf-8']
+    assert 'server-timing' in headers
+
+    status, headers, _ = call(asgi, 'POST', '/messages/user2/settings', cookie, b'nickname=Bestie')
+    assert status == 302 and headers['location'] == ['/messages/user2']
+    # The flash is saved in the session cookie, for the next page
+    flashed = app.test_client()
+    flashed.set_cookie('session', headers['set-cookie'][0].split(';', 1)[0].split('=', 1)[1])
+    assert 'Paramètres de discussion mis à jour !' in flashed.get('/messages/user2').get_data(as_text=True)
+
+
+def test_async_views_start_the_expiry_worker(app, database, asgi):
+    worker = app.extensions['expiry']
+    worker.interval = 3600
+    call(asgi, 'GET', '/unread', logged_in_cookie(app, database))
+    assert worker._thread is not None and worker._thread.is_alive()
+
+
+def test_bodies_over_the_limit_are_not_read(app, asgi):
+    app.config['MAX_CONTENT_LENGTH'] = 1024
+    sent, received = [], []
+
+    async def receive():
+        # An endless upload, in 512-byte chunks
+        received.append(1)
+        return {'type': 'http.request', 'body': b'x' * 512, 'more_body': True}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': 'POST', 'path': '/messages/user2/read', 'query_string': b'',
+             'headers': [], 'server': ('localhost', 80)}
+    asyncio.run(asgi(scope, receive, send))
+    assert len(received) == 3
+    # The app's 413 handler: a flash message and back to the home page
+    assert sent[0]['status'] == 302
+
+    received.clear()
+    scope['headers'] = [(b'content-length', b'4096')]
+    asyncio.run(asgi(scope, receive, send))
+    assert received == []
+
+
+def test_errors_in_async_views_get_a_500(app, database, asgi, monkeypatch):
+    app.testing = False
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    logged = []
+    monkeypatch.setattr(app, 'log_exception', lambda exc_info: logged.append(exc_info[1]))
+
+    async def broken(user_id):
+        raise RuntimeError('boom')
+
+    monkeypatch.setattr(asgi, 'unread_total', broken)
+    status, _, _ = call(asgi, 'GET', '/unread', logged_in_cookie(app, database))
+    assert status == 500
+    assert [str(error) for error in logged] == ['boom']
+
+
+def test_split_cookie_headers_are_joined(asgi):
+    # Imported by the fixture, with the test database
+    from asgi import build_environ
+    scope = {'method': 'GET', 'path': '/', 'query_string': b'',
+             'headers': [(b'cookie', b'a=1'), (b'cookie', b'session=abc'), (b'accept', b'text/html'),
+                         (b'accept', b'*/*')]}
+    environ = build_environ(scope, io.BytesIO())
+    assert environ['HTTP_COOKIE'] == 'a=1; session=abc'
+    assert environ['HTTP_ACCEPT'] == 'text/html,*/*'
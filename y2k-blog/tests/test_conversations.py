@@ -0,0 +1,19 @@
+import sqlite3
+
+import conversations
+
+
+def test_history_before_a_missing_message_is_empty(database):
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    conn.executemany("INSERT INTO users (username, password) VALUES (?, 'pw')", [('user1',), ('user2',)])
+    conn.executemany("INSERT INTO messages (sender_id, receiver_id, content) VALUES (?, ?, ?)",
+                     [(1 + i % 2, 2 - i % 2, f'message {i}') for i in range(5)])
+    latest, older = conversations.fetch_history(conn, 1, 2, limit=3)
+    assert [m['content'] for m in latest] == ['message 2', 'message 3', 'message 4'] and older == 3
+
+    assert [m['content'] for m in conversations.fetch_history(conn, 1, 2, before=older, limit=3)[0]] == [
+        'message 0', 'message 1']
+    # The anchor was deleted (an ephemeral conversation purged between two pages)
+    conn.execute('DELETE FROM messages WHERE id <= ?', (older,))
+    assert conversations.fetch_history(conn, 1, 2, before=older, limit=3) == ([], None)
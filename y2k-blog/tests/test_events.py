@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+import events
+
+
+class SyncBroker(events.Broker):
+    """A broker with blocking subscriptions only, like one for a client library without asyncio."""
+
+    def __init__(self):
+        self.local = events.LocalBroker()
+
+    def publish(self, channel, event, data):
+        self.local.publish(channel, event, data)
+
+    def subscribe(self, channel):
+        return self.local.subscribe(channel)
+
+    def unsubscribe(self, subscription):
+        self.local.unsubscribe(subscription)
+
+
+def test_brokers_must_implement_the_interface():
+    class Incomplete(events.Broker):
+        def publish(self, channel, event, data):
+            pass
+
+    with pytest.raises(TypeError):
+        events.resolve_broker(Incomplete)
+    assert isinstance(events.resolve_broker('events.SQLiteBroker'), events.SQLiteBroker)
+
+
+def test_async_streams_wait_on_sync_brokers_from_a_thread():
+    broker = SyncBroker()
+
+    async def first_event():
+        stream = events._stream_async(broker, 1, None)
+        assert await anext(stream) == 'retry: 3000\n\n'
+        pending = asyncio.ensure_future(anext(stream))
+        while not broker.local.subscriber_count:
+            await asyncio.sleep(0.01)
+        broker.publish(events.user_channel(1), 'message', {'id': 7})
+        event = await pending
+        await stream.aclose()
+        return event
+
+    assert asyncio.run(first_event()) == events.format_sse('message', {'id': 7})
+    assert broker.local.subscriber_count == 0
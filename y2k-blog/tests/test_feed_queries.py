@@ -0,0 +1,79 @@
+import sqlite3
+import threading
+
+from app import create_app
+from feed import FEED_PAGE_SIZE, hydrate_posts
+
+import migrations
+
+
+def seed(database, posts, comments_per_post):
+    """Four users and `posts` public posts between them, each liked, with liked comments."""
+    migrations.upgrade(database)
+    conn = sqlite3.connect(database)
+    conn.executemany("INSERT INTO users (username, password, display_name) VALUES (?, 'pw', ?)",
+                     [(f'user{i}', f'User {i}') for i in range(1, 5)])
+    for i in range(posts):
+        post_id = conn.execute("INSERT INTO posts (content, visibility, author_id) VALUES (?, 'public', ?)",
+                               (f'<p>post {i}</p>', i % 4 + 1)).lastrowid
+        conn.execute("INSERT INTO likes (user_id, item_type, item_id) VALUES (1, 'post', ?)", (post_id,))
+        for j in range(comments_per_post):
+            comment_id = conn.execute('INSERT INTO comments (post_id, author_id, content) VALUES (?, ?, ?)',
+                                      (post_id, j % 4 + 1, f'<p>comment {j}</p>')).lastrowid
+            conn.execute("INSERT INTO likes (user_id, item_type, item_id) VALUES (?, 'comment', ?)",
+                         (j % 4 + 1, comment_id))
+    conn.commit()
+    conn.close()
+    return database
+
+
+def hydrate_statements(database):
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    posts = conn.execute('SELECT * FROM posts ORDER BY id DESC LIMIT ?', (FEED_PAGE_SIZE,)).fetchall()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    hydrated = hydrate_posts(conn, posts, 1, lambda last_active, user_id: None)
+    conn.close()
+    assert len(hydrated) == len(posts)
+    return statements
+
+
+def home_page_statements(database):
+    """Statements the request thread runs for GET / (a logged-in user, nothing cached yet)."""
+    app = create_app({'TESTING': True, 'DATABASE': database, 'PURGE_INTERVAL': 0})
+    statements = []
+    recording = threading.Event()
+    request_thread = threading.get_ident()
+    pool = app.extensions['sqlite_pool']
+    connect = pool.connect
+
+    def record(sql):
+        if recording.is_set() and threading.get_ident() == request_thread:
+            statements.append(sql)
+
+    def traced_connect():
+        conn = connect()
+        conn.set_trace_callback(record)
+        return conn
+
+    pool.connect = traced_connect
+    client = app.test_client()
+    client.post('/login', data={'username': 'user1', 'password': 'pw'})
+    recording.set()
+    response = client.get('/')
+    recording.clear()
+    assert response.status_code == 200
+    return statements
+
+
+def test_hydrate_posts_runs_the_same_queries_whatever_the_page(tmp_path):
+    small = hydrate_statements(seed(str(tmp_path / 'small.db'), posts=2, comments_per_post=1))
+    large = hydrate_statements(seed(str(tmp_path / 'large.db'), posts=FEED_PAGE_SIZE, comments_per_post=6))
+    assert len(small) == len(large)
+
+
+def test_home_page_runs_the_same_queries_whatever_the_feed(tmp_path):
+    small = home_page_statements(seed(str(tmp_path / 'small.db'), posts=2, comments_per_post=1))
+    large = home_page_statements(seed(str(tmp_path / 'large.db'), posts=FEED_PAGE_SIZE * 3, comments_per_post=6))
+    assert len(small) == len(large), '\n'.join(large)
@@ -0,0 +1,67 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+import groupcommit
+from app import create_app
+
+
+def insert_user(conn, username):
+    conn.execute("INSERT INTO users (username, password) VALUES (?, 'pw')", (username,))
+
+
+def usernames(database):
+    conn = sqlite3.connect(database)
+    try:
+        return [row[0] for row in conn.execute('SELECT username FROM users ORDER BY id')]
+    finally:
+        conn.close()
+
+
+def test_a_write_that_times_out_in_the_queue_never_commits(app, database, monkeypatch):
+    writer = app.extensions['group_commit']
+    started, release = threading.Event(), threading.Event()
+
+    def blocking(conn):
+        started.set()
+        release.wait()
+
+    monkeypatch.setattr(groupcommit, 'TIMEOUT', 0.05)
+    # Occupies the writer thread, so the next write stays queued past its timeout
+    blocker = writer.submit(blocking)
+    started.wait()
+    with pytest.raises(TimeoutError):
+        writer.run(insert_user, 'late')
+    release.set()
+    blocker.result()
+    writer.run(insert_user, 'next')
+    assert usernames(database) == ['next']
+
+
+def test_a_write_running_at_the_timeout_is_waited_for(app, database, monkeypatch):
+    writer = app.extensions['group_commit']
+
+    def slow(conn):
+        time.sleep(0.2)
+        insert_user(conn, 'slow')
+        return 'done'
+
+    monkeypatch.setattr(groupcommit, 'TIMEOUT', 0.05)
+    assert writer.run(slow) == 'done'
+    assert usernames(database) == ['slow']
+
+
+def test_background_writes_without_the_queue(database):
+    app = create_app({'TESTING': True, 'DATABASE': database, 'PURGE_INTERVAL': 0, 'WRITE_QUEUE': False})
+    with app.app_context():
+        app.extensions['group_commit'].run(insert_user, 'user1')
+    presence = app.extensions['presence']
+    presence.touch(1)
+    # From a thread of its own, like the flusher: no app context there
+    thread = threading.Thread(target=presence.flush)
+    thread.start()
+    thread.join()
+    conn = sqlite3.connect(database)
+    assert conn.execute('SELECT last_active FROM users WHERE id = 1').fetchone()[0] is not None
@@ -0,0 +1,59 @@
+import json
+import os
+import subprocess
+import sys
+
+import metrics
+import migrations
+from app import create_app
+
+
+def families(app):
+    body = app.test_client().get('/metrics').get_data(as_text=True)
+    return [line.split()[2] for line in body.splitlines() if line.startswith('# TYPE')], body
+
+
+def test_each_app_has_its_own_registry(app, tmp_path):
+    other_database = str(tmp_path / 'other.db')
+    migrations.upgrade(other_database)
+    other = create_app({'TESTING': True, 'DATABASE': other_database, 'PURGE_INTERVAL': 0})
+
+    for _ in range(3):
+        app.test_client().get('/login')
+    names, body = families(app)
+    assert len(names) == len(set(names))
+    assert 'sqlite_pool_connections' in names and 'users_present' in names
+    assert 'http_requests_total{endpoint="login",method="GET",status="200"} 3' in body
+
+    names, body = families(other)
+    assert len(names) == len(set(names))
+    assert 'endpoint="login"' not in body
+
+
+def test_a_scrape_adds_up_the_other_processes(database, tmp_path):
+    directory = tmp_path / 'metrics'
+    app = create_app({'TESTING': True, 'DATABASE': database, 'PURGE_INTERVAL': 0, 'METRICS_DIR': str(directory)})
+    process = subprocess.Popen([sys.executable, '-c', ''])
+    process.wait()
+    exited = process.pid
+    alive = os.getppid()
+    for pid in (exited, alive):
+        (directory / f'{pid}.json').write_text(json.dumps({
+            'counters': [['messages_sent_total', [], 2]],
+            'histograms': [['http_request_duration_seconds', [['endpoint', 'index']], [1] + [0] * 14]],
+            'gauges': [['group_commit_batches_total', [], 5], ['event_stream_subscribers', [], 3]],
+        }))
+    app.test_client().get('/login')
+
+    _, body = families(app)
+    assert 'messages_sent_total 4' in body
+    assert 'http_request_duration_seconds_count{endpoint="index"} 2' in body
+    assert f'event_stream_subscribers{{pid="{alive}"}} 3' in body
+    assert f'pid="{exited}"' not in body
+    assert f'event_stream_subscribers{{pid="{os.getpid()}"}} 0' in body
+    batches = [line for line in body.splitlines() if line.startswith('group_commit_batches_total')]
+    assert len(batches) == 1 and int(batches[0].split()[1]) >= 10
+
+    metrics.save_snapshot(app)
+    saved = json.loads((directory / f'{os.getpid()}.json').read_text())
+    assert ['http_requests_total', [['endpoint', 'login'], ['method', 'GET'], ['status', '200']], 1] in saved['counters']
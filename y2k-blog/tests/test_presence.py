@@ -0,0 +1,54 @@
+import gc
+import sqlite3
+import weakref
+
+from app import create_app
+
+
+def last_active(database, user_id):
+    conn = sqlite3.connect(database)
+    try:
+        return conn.execute('SELECT last_active FROM users WHERE id = ?', (user_id,)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def logout(tracker, user_id):
+    # What the logout view does
+    tracker.forget(user_id)
+    tracker.writer.run(lambda conn: conn.execute('UPDATE users SET last_active = NULL WHERE id = ?', (user_id,)))
+
+
+class LogoutFirst:
+    """A writer that lets user 1 log out between a flush taking its batch and writing it."""
+
+    def __init__(self, tracker):
+        self.tracker, self.writer = tracker, tracker.writer
+
+    def run(self, func, *args):
+        self.tracker.writer = self.writer
+        logout(self.tracker, 1)
+        return self.writer.run(func, *args)
+
+
+def test_a_flush_under_way_does_not_bring_a_logged_out_user_back(app, database):
+    tracker = app.extensions['presence']
+    tracker.writer.run(lambda conn: conn.executemany("INSERT INTO users (username, password) VALUES (?, 'pw')",
+                                                     [('user1',), ('user2',)]))
+    tracker.touch(1)
+    tracker.touch(2)
+    tracker.writer = LogoutFirst(tracker)
+    assert tracker.flush() == 1
+    assert last_active(database, 1) is None
+    assert last_active(database, 2) is not None
+    assert tracker._in_flight == []
+
+
+def test_trackers_go_away_with_their_app(database):
+    app = create_app({'TESTING': True, 'DATABASE': database, 'PURGE_INTERVAL': 0})
+    tracker = weakref.ref(app.extensions['presence'])
+    # Starts the flusher thread
+    tracker().touch(1)
+    del app
+    gc.collect()
+    assert tracker() is None
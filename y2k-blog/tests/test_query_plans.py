@@ -0,0 +1,21 @@
+import pytest
+
+import check_query_plans
+
+
+@pytest.fixture(scope='module')
+def checked(tmp_path_factory):
+    return check_query_plans.check(str(tmp_path_factory.mktemp('plans') / 'database.db'))
+
+
+def test_routes_do_not_scan_large_tables(checked):
+    statements, failures = checked
+    assert failures == {}
+
+
+def test_json_endpoints_are_exercised(checked):
+    statements, _ = checked
+    # The badge and the JSON like, comment and delete routes ran, so their statements were planned
+    assert any('SELECT unread_count FROM users' in sql for sql in statements)
+    assert any(sql.lstrip().startswith('INSERT INTO comments') for sql in statements)
+    assert any("DELETE FROM likes WHERE item_type = 'comment'" in sql for sql in statements)
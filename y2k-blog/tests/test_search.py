@@ -0,0 +1,19 @@
+import sqlite3
+
+import search
+
+
+def test_punctuation_is_found_as_typed(database):
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    conn.executemany("INSERT INTO users (username, password) VALUES (?, 'pw')", [('user1',), ('user2',), ('user3',)])
+    # Stored escaped, as the message form saves them
+    conn.executemany('INSERT INTO messages (sender_id, receiver_id, content) VALUES (?, ?, ?)',
+                     [(1, 2, 'Tom &amp; Jerry'), (2, 1, 'été ?!'), (1, 3, 'Laurel &amp; Hardy'), (2, 1, 'rien')])
+
+    found = search.search_messages(conn, 1, 2, ' & ')
+    assert [m['content'] for m in found] == ['Tom &amp; Jerry']
+    assert found[0]['snippet'] == 'Tom <mark>&amp;</mark> Jerry'
+    assert [m['content'] for m in search.search_messages(conn, 2, 1, '?!')] == ['été ?!']
+    assert [m['content'] for m in search.search_messages(conn, 1, 2, 'ete')] == ['été ?!']
+    assert search.search_messages(conn, 1, 2, '   ') == []
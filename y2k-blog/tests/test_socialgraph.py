@@ -0,0 +1,41 @@
+import sqlite3
+
+from socialgraph import SocialGraph, record_change
+
+
+def connect(database):
+    conn = sqlite3.connect(database)
+    conn.executemany("INSERT INTO users (username, password) VALUES (?, 'pw')", [(f'user{i}',) for i in range(1, 6)])
+    conn.commit()
+    return conn
+
+
+def change(conn, sql, params, a, b):
+    conn.execute(sql, params)
+    record_change(conn, a, b)
+    conn.commit()
+
+
+def test_replayed_changes_match_a_full_load(database):
+    conn = connect(database)
+    graph = SocialGraph().sync(conn)
+    change(conn, 'INSERT INTO friends (sender_id, receiver_id) VALUES (1, 2)', (), 1, 2)
+    change(conn, "INSERT INTO friends (sender_id, receiver_id, status) VALUES (1, 3, 'accepted')", (), 1, 3)
+    change(conn, 'INSERT INTO blocks (blocker_id, blocked_id) VALUES (4, 1)', (), 4, 1)
+    graph.sync(conn)
+    assert [graph.relationship(1, other) for other in (2, 3, 4, 5)] == [
+        'request_sent', 'friends', 'blocked_by_them', 'none']
+    assert graph.relationship(2, 1) == 'request_received'
+
+    change(conn, "UPDATE friends SET status = 'accepted' WHERE sender_id = 1 AND receiver_id = 2", (), 1, 2)
+    change(conn, 'DELETE FROM friends WHERE sender_id = 1 AND receiver_id = 3', (), 1, 3)
+    previous = graph.friend_ids(1)
+    graph.sync(conn)
+    # Records are replaced, never changed in place: what a reader held stays as it was
+    assert previous == {3}
+    assert graph.friend_ids(1) == {2}
+
+    fresh = SocialGraph().sync(conn)
+    for a in range(1, 6):
+        for b in range(1, 6):
+            assert graph.relationship(a, b) == fresh.relationship(a, b)
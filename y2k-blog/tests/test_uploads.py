@@ -0,0 +1,72 @@
+import io
+import os
+import sqlite3
+
+import pytest
+
+import metrics
+import uploads
+from werkzeug.datastructures import FileStorage
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def jpeg_with_exif():
+    exif = Image.Exif()
+    exif[0x0112] = 6                      # Orientation: rotated 90°
+    exif[0x010F] = 'SecretCam'            # Make
+    image = Image.new('RGB', (40, 20), 'red')
+    out = io.BytesIO()
+    image.save(out, 'JPEG', exif=exif, comment=b'secret comment')
+    return out.getvalue()
+
+
+def save(data, filename, folder):
+    return uploads.save(FileStorage(io.BytesIO(data), filename=filename), str(folder))
+
+
+def test_stored_copy_is_upright_and_has_no_metadata(tmp_path):
+    path, created = save(jpeg_with_exif(), 'photo.png', tmp_path)
+    assert created and path.endswith('.jpg')
+    stored = tmp_path / path
+    assert b'SecretCam' not in stored.read_bytes() and b'secret comment' not in stored.read_bytes()
+    with Image.open(stored) as image:
+        assert image.size == (20, 40)
+        assert not image.getexif()
+    assert save(jpeg_with_exif(), 'again.jpg', tmp_path) == (path, False)
+
+
+@pytest.mark.parametrize('data', [b'<?php system($_GET["c"]); ?>', jpeg_with_exif()[:100]])
+def test_invalid_images_are_refused(tmp_path, data):
+    assert save(data, 'photo.jpg', tmp_path) is None
+    assert not [name for name in os.listdir(tmp_path / 'uploads') if name.endswith('.part')]
+
+
+def logged_in(app, database):
+    conn = sqlite3.connect(database)
+    conn.execute("INSERT INTO users (username, password) VALUES ('user1', 'pw')")
+    conn.commit()
+    client = app.test_client()
+    client.post('/login', data={'username': 'user1', 'password': 'pw'})
+    return client, conn
+
+
+def test_only_new_files_are_counted(app, database, tmp_path, monkeypatch):
+    app.static_folder = str(tmp_path)
+    client, conn = logged_in(app, database)
+    sizes = []
+    monkeypatch.setattr(metrics, 'uploaded', sizes.append)
+    for _ in range(2):
+        client.post('/post/new', data={'content': '', 'image': (io.BytesIO(jpeg_with_exif()), 'photo.jpg')})
+    assert len(sizes) == 1
+    assert conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0] == 2
+
+
+def test_oversized_requests_are_refused(app, database):
+    assert app.config['MAX_CONTENT_LENGTH'] == uploads.MAX_UPLOAD_SIZE
+    app.config['MAX_CONTENT_LENGTH'] = 1024 * 1024
+    client, conn = logged_in(app, database)
+    response = client.post('/post/new', data={'image': (io.BytesIO(b'x' * 2 * 1024 * 1024), 'big.jpg')},
+                           follow_redirects=True)
+    assert 'Image trop lourde (1 Mo maximum).' in response.get_data(as_text=True)
+    assert conn.execute('SELECT COUNT(*) FROM posts').fetchone()[0] == 0
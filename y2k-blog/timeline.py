@@ -0,0 +1,162 @@
+from feed import FEED_PAGE_SIZE, POST_COLUMNS, encode_cursor, fetch_feed_page, visible_posts
+
+# Materialized home timelines (fan-out on write). Every user with a row in
+# `timeline_state` has the ids of the posts they may see copied into `timeline`,
+# keyed (user_id, created_at, post_id): reading a page of the feed is one range
+# scan. New posts are pushed to the timelines that can see them; a change in the
+# social graph rebuilds the two timelines involved.
+#
+# Users who haven't been around for a while have no timeline: the expiry worker
+# drops it (see expiry.py). Until their next visit they read the feed from
+# `posts` (feed.fetch_feed_page); their first feed page builds it again.
+
+# Posts kept per timeline; older pages are served by the query path
+TIMELINE_CAP = 500
+# How far past the cap a timeline may grow before it is trimmed back
+TRIM_SLACK = 50
+# Timelines of users inactive (or logged out) for longer than this are dropped
+INACTIVE_DAYS = 30
+
+# Materialized timelines that can see a post, by visibility (:author is the post's author)
+AUDIENCE = {
+    'public': 'SELECT user_id FROM timeline_state',
+    'friends': '''
+        SELECT user_id FROM timeline_state
+        WHERE user_id = :author OR user_id IN (
+            SELECT receiver_id FROM friends WHERE sender_id = :author AND status = 'accepted'
+            UNION ALL
+            SELECT sender_id FROM friends WHERE receiver_id = :author AND status = 'accepted'
+        )
+    ''',
+}
+# Any other visibility: only the author sees it
+AUTHOR_ONLY = 'SELECT user_id FROM timeline_state WHERE user_id = :author'
+
+
+def is_materialized(conn, user_id):
+    return conn.execute('SELECT 1 FROM timeline_state WHERE user_id = ?', (user_id,)).fetchone() is not None
+
+
+def rebuild(conn, user_id, cap=TIMELINE_CAP):
+    """(Re)build a user's timeline from `posts`. Returns the number of posts it holds."""
+    where, params = visible_posts(user_id)
+    rows = conn.execute(f'''
+        SELECT posts.id, posts.created_at FROM posts
+        WHERE {where}
+        ORDER BY posts.created_at DESC, posts.id DESC
+        LIMIT ?
+    ''', (*params, cap + 1)).fetchall()
+    capped = len(rows) > cap
+    rows = rows[:cap]
+
+    conn.execute('DELETE FROM timeline WHERE user_id = ?', (user_id,))
+    conn.executemany('INSERT INTO timeline (user_id, created_at, post_id) VALUES (?, ?, ?)',
+                     [(user_id, row['created_at'], row['id']) for row in rows])
+    conn.execute('''
+        INSERT INTO timeline_state (user_id, size, capped, built_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO UPDATE SET size = excluded.size, capped = excluded.capped, built_at = excluded.built_at
+    ''', (user_id, len(rows), int(capped)))
+    return len(rows)
+
+
+def materialize(conn, user_id):
+    """Build a user's timeline unless it already exists. Returns whether it was built."""
+    if is_materialized(conn, user_id):
+        return False
+    rebuild(conn, user_id)
+    return True
+
+
+def graph_changed(conn, *user_ids):
+    """Friendship or block between these users changed: rebuild whichever timelines exist."""
+    for user_id in user_ids:
+        if is_materialized(conn, user_id):
+            rebuild(conn, user_id)
+
+
+def fan_out(conn, post_id):
+    """Push a new post to every materialized timeline allowed to see it. Returns how many."""
+    post = conn.execute('SELECT id, author_id, visibility, created_at FROM posts WHERE id = ?', (post_id,)).fetchone()
+    if not post:
+        return 0
+    audience = AUDIENCE.get(post['visibility'], AUTHOR_ONLY)
+    params = {'author': post['author_id'], 'post_id': post['id'], 'created_at': post['created_at']}
+    delivered = conn.execute(f'''
+        INSERT OR IGNORE INTO timeline (user_id, created_at, post_id)
+        SELECT user_id, :created_at, :post_id FROM ({audience})
+    ''', params).rowcount
+    conn.execute(f'UPDATE timeline_state SET size = size + 1 WHERE user_id IN ({audience})', params)
+
+    # Trimming is amortized: only timelines that grew TRIM_SLACK past the cap
+    overfull = conn.execute('SELECT user_id FROM timeline_state WHERE size > ?', (TIMELINE_CAP + TRIM_SLACK,))
+    for row in overfull.fetchall():
+        trim(conn, row['user_id'])
+    return delivered
+
+
+def trim(conn, user_id, cap=TIMELINE_CAP):
+    """Drop everything older than the newest `cap` posts of a timeline."""
+    deleted = conn.execute('''
+        DELETE FROM timeline
+        WHERE user_id = :user AND (created_at, post_id) <= (
+            SELECT created_at, post_id FROM timeline WHERE user_id = :user
+            ORDER BY created_at DESC, post_id DESC LIMIT 1 OFFSET :cap
+        )
+    ''', {'user': user_id, 'cap': cap}).rowcount
+    conn.execute('''
+        UPDATE timeline_state
+        SET size = (SELECT COUNT(*) FROM timeline WHERE user_id = :user), capped = capped OR :deleted
+        WHERE user_id = :user
+    ''', {'user': user_id, 'deleted': int(deleted > 0)})
+    return deleted
+
+
+def remove_post(conn, post_id):
+    conn.execute('DELETE FROM timeline WHERE post_id = ?', (post_id,))
+
+
+def prune_inactive(conn, days=INACTIVE_DAYS):
+    """Drop the timelines of users who logged out or haven't been seen for `days`. Returns how many."""
+    stale = [row['user_id'] for row in conn.execute('''
+        SELECT s.user_id FROM timeline_state s JOIN users u ON u.id = s.user_id
+        WHERE u.last_active IS NULL OR u.last_active < datetime('now', ?)
+    ''', (f'-{days} days',))]
+    for user_id in stale:
+        conn.execute('DELETE FROM timeline WHERE user_id = ?', (user_id,))
+        conn.execute('DELETE FROM timeline_state WHERE user_id = ?', (user_id,))
+    return len(stale)
+
+
+def fetch_page(conn, viewer_id, cursor=None, limit=FEED_PAGE_SIZE, build=None):
+    """
+    One page of the home feed: a range scan of the viewer's timeline, or the query path without one.
+    `build(viewer_id)`, if given, is called to materialize a missing timeline first.
+    """
+    state = None
+    if viewer_id is not None:
+        state = conn.execute('SELECT capped FROM timeline_state WHERE user_id = ?', (viewer_id,)).fetchone()
+        if state is None and build is not None:
+            build(viewer_id)
+            state = conn.execute('SELECT capped FROM timeline_state WHERE user_id = ?', (viewer_id,)).fetchone()
+    if state is None:
+        return fetch_feed_page(conn, viewer_id, cursor, limit)
+
+    where, params = 'timeline.user_id = ?', [viewer_id]
+    if cursor:
+        where += ' AND (timeline.created_at, timeline.post_id) < (?, ?)'
+        params += list(cursor)
+    rows = conn.execute(f'''
+        SELECT {POST_COLUMNS}
+        FROM timeline
+        JOIN posts ON posts.id = timeline.post_id
+        JOIN users ON posts.author_id = users.id
+        WHERE {where}
+        ORDER BY timeline.created_at DESC, timeline.post_id DESC
+        LIMIT ?
+    ''', params + [limit + 1]).fetchall()
+
+    if len(rows) <= limit and state['capped']:
+        # Ran past the end of a capped timeline: older posts only exist in `posts`
+        return fetch_feed_page(conn, viewer_id, cursor, limit)
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
@@ -0,0 +1,289 @@
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:  # Pillow is optional: without it images are only checked by signature
+    Image = None
+
+# Uploaded images, stored under static/uploads/ by content: the file's sha256 is
+# its name (`uploads/3f/3fa2...c1.jpg`), so the same picture is kept only once and
+# names can't collide. Resized copies (`..._640.webp`) are made in a small worker
+# pool after the request, and the templates offer them through `srcset`.
+#
+# An upload is never stored as sent: Pillow must be able to open and verify it,
+# and what is kept is a re-encoded copy without its metadata (EXIF: GPS position,
+# camera, date...). The stored extension comes from the detected format, not
+# from the file name.
+
+CHUNK_SIZE = 64 * 1024
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp'}
+# Request bodies over this are refused (MAX_CONTENT_LENGTH, see create_app in app.py)
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+# Stored extension by Pillow format
+FORMATS = {'JPEG': '.jpg', 'PNG': '.png', 'GIF': '.gif', 'WEBP': '.webp'}
+# The same by file signature, when Pillow is missing
+SIGNATURES = ((b'\xff\xd8\xff', '.jpg'), (b'\x89PNG\r\n\x1a\n', '.png'), (b'GIF87a', '.gif'), (b'GIF89a', '.gif'))
+# Image.info entries carried over to the re-encoded copy; the rest (exif, xmp, comments...) is dropped
+KEPT_INFO = ('icc_profile', 'transparency', 'duration', 'loop', 'background')
+# Thumbnail widths, in pixels; images narrower than a width don't get that one
+THUMBNAIL_WIDTHS = (320, 640, 1280)
+THUMBNAIL_WORKERS = 2
+
+# Path of a stored upload, relative to static/
+STORED_RE = re.compile(r'^uploads/([0-9a-f]{2})/([0-9a-f]{64})\.(\w+)$')
+
+logger = logging.getLogger(__name__)
+
+
+def thumbnail_format():
+    """WebP when Pillow was built with it, JPEG otherwise."""
+    if Image is not None and features.check('webp'):
+        return 'webp'
+    return 'jpg'
+
+
+def stored_path(digest, extension):
+    return f'uploads/{digest[:2]}/{digest}{extension}'
+
+
+def thumbnail_path(path, width):
+    """`uploads/3f/3fa2...c1.jpg` -> `uploads/3f/3fa2...c1_640.webp`."""
+    return f'{os.path.splitext(path)[0]}_{width}.{thumbnail_format()}'
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def sniff(path):
+    """Stored extension of an image file by its signature, or None."""
+    with open(path, 'rb') as file:
+        head = file.read(12)
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    for signature, extension in SIGNATURES:
+        if head.startswith(signature):
+            return extension
+    return None
+
+
+def clean_copy(source, folder):
+    """
+    Verify an image with Pillow and write it again without its metadata, upright
+    (the EXIF orientation goes with the rest), animations kept. Returns
+    (extension, path of the copy), or None if it isn't a valid supported image.
+    """
+    try:
+        with Image.open(source) as image:
+            image.verify()
+        with Image.open(source) as image:
+            extension = FORMATS.get(image.format)
+            if extension is None:
+                return None
+            fmt = image.format
+            params = {key: image.info[key] for key in KEPT_INFO if key in image.info}
+            animated = getattr(image, 'n_frames', 1) > 1
+            if animated:
+                params['save_all'] = True
+            else:
+                image = ImageOps.exif_transpose(image)
+            if fmt in ('JPEG', 'WEBP'):
+                params['quality'] = 90
+            # Nothing else is read from the original's info when saving
+            image.info = {}
+            fd, path = tempfile.mkstemp(dir=folder, suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as out:
+                    image.save(out, fmt, **params)
+            except BaseException:
+                os.remove(path)
+                raise
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        # Not an image, truncated, or too many pixels to decode safely
+        return None
+    return extension, path
+
+
+def save(file, static_folder):
+    """
+    Stream an uploaded file to disk in chunks, check it (see clean_copy; only its
+    signature without Pillow) and keep it under its content hash. Returns (path
+    relative to `static_folder`, whether a new file was written: an existing file
+    with the same content is reused), or None if it isn't a supported image.
+    """
+    if os.path.splitext(file.filename or '')[1].lower() not in IMAGE_EXTENSIONS:
+        return None
+
+    upload_folder = os.path.join(static_folder, 'uploads')
+    os.makedirs(upload_folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=upload_folder, suffix='.part')
+    clean_path = None
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+                out.write(chunk)
+        if Image is None:
+            extension = sniff(tmp_path)
+            if extension is None:
+                return None
+            source = tmp_path
+        else:
+            checked = clean_copy(tmp_path, upload_folder)
+            if checked is None:
+                return None
+            extension, clean_path = checked
+            source = clean_path
+        path = stored_path(file_digest(source), extension)
+        target = os.path.join(static_folder, path)
+        if os.path.exists(target):
+            return path, False
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(source, target)
+        return path, True
+    finally:
+        for leftover in (tmp_path, clean_path):
+            if leftover and os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def make_thumbnails(static_folder, path):
+    """Write the missing thumbnails of a stored image. Returns the widths written."""
+    if Image is None:
+        return []
+    source = os.path.join(static_folder, path)
+    written = []
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        fmt = thumbnail_format()
+        if fmt == 'jpg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        for width in THUMBNAIL_WIDTHS:
+            target = os.path.join(static_folder, thumbnail_path(path, width))
+            if width >= image.width or os.path.exists(target):
+                continue
+            height = round(image.height * width / image.width)
+            resized = image.resize((width, height), Image.LANCZOS)
+            # Write aside then rename, so a half-written thumbnail is never served
+            fd, tmp_target = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.part')
+            with os.fdopen(fd, 'wb') as out:
+                resized.save(out, 'WEBP' if fmt == 'webp' else 'JPEG', quality=82)
+            os.replace(tmp_target, target)
+            written.append(width)
+    return written
+
+
+class ThumbnailPool:
+    """Makes thumbnails off the request thread. Created on first use, and again after a fork."""
+
+    def __init__(self, workers=THUMBNAIL_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+    def submit(self, static_folder, path):
+        if Image is None:
+            return None
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='thumbnails')
+                self._pid = os.getpid()
+            future = self._executor.submit(make_thumbnails, static_folder, path)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def shutdown(self):
+        """Wait for the queued thumbnails (for command-line use)."""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+
+    @staticmethod
+    def _log_failure(future):
+        if future.exception() is not None:
+            logger.error('Thumbnail generation failed', exc_info=future.exception())
+
+
+thumbnails = ThumbnailPool()
+
+# Complete srcset values, by image URL (stored images never change)
+_srcsets = {}
+
+
+def srcset(static_folder, image_url, static_url_path='/static'):
+    """
+    `srcset` attribute value for a stored image: its thumbnails plus the original.
+    Empty for legacy uploads, external URLs, or until the thumbnails exist.
+    """
+    if image_url in _srcsets:
+        return _srcsets[image_url]
+    prefix = static_url_path.rstrip('/') + '/'
+    path = image_url[len(prefix):] if image_url.startswith(prefix) else None
+    if not path or not STORED_RE.match(path) or Image is None:
+        return ''
+    try:
+        with Image.open(os.path.join(static_folder, path)) as image:
+            original_width = image.width
+    except (OSError, ValueError):
+        return ''
+    widths = [w for w in THUMBNAIL_WIDTHS if w < original_width]
+    if not all(os.path.exists(os.path.join(static_folder, thumbnail_path(path, w))) for w in widths):
+        # Still being made: offer the original only, and look again next time
+        return ''
+    candidates = [f'{prefix}{thumbnail_path(path, w)} {w}w' for w in widths]
+    candidates.append(f'{image_url} {original_width}w')
+    _srcsets[image_url] = ', '.join(candidates)
+    return _srcsets[image_url]
+
+
+def thumbnails_pending(static_folder, image_url, static_url_path='/static'):
+    """True while a stored image's thumbnails are still expected (its srcset will change)."""
+    if not image_url or Image is None or image_url in _srcsets:
+        return False
+    prefix = static_url_path.rstrip('/') + '/'
+    return (image_url.startswith(prefix) and bool(STORED_RE.match(image_url[len(prefix):]))
+            and not srcset(static_folder, image_url, static_url_path))
+
+
+def import_legacy(conn, static_folder, static_url_path='/static'):
+    """
+    Move the images of posts saved before content-addressed storage into it, drop
+    the duplicates, and queue their thumbnails. Returns the number of posts updated.
+    """
+    prefix = static_url_path.rstrip('/') + '/uploads/'
+    rows = conn.execute("SELECT id, image_url FROM posts WHERE image_url LIKE ? || '%'", (prefix,)).fetchall()
+    updated = 0
+    for row in rows:
+        old_path = row['image_url'][len(static_url_path.rstrip('/')) + 1:]
+        if STORED_RE.match(old_path):
+            continue
+        source = os.path.join(static_folder, old_path)
+        if not os.path.exists(source):
+            continue
+        extension = os.path.splitext(old_path)[1].lower().replace('.jpeg', '.jpg')
+        path = stored_path(file_digest(source), extension)
+        target = os.path.join(static_folder, path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # A profile picture may point at the old file too: then it stays
+        in_use = conn.execute('SELECT 1 FROM users WHERE profile_picture = ?', (row['image_url'],)).fetchone()
+        if not os.path.exists(target):
+            (shutil.copyfile if in_use else os.replace)(source, target)
+        elif not in_use:
+            os.remove(source)
+        conn.execute('UPDATE posts SET image_url = ? WHERE image_url = ?',
+                     (f'{static_url_path.rstrip("/")}/{path}', row['image_url']))
+        thumbnails.submit(static_folder, path)
+        updated += 1
+    return updated
@@ -0,0 +1,65 @@
+import gc
+import time
+
+from flask import url_for
+
+import content
+
+# Warm startup for preforking servers (see wsgi.py and gunicorn.conf.py).
+#
+# preload() runs once in the master process before it forks the workers. It
+# compiles every Jinja template, builds the Markdown and bleach pipelines (which
+# import more modules on first use), compiles the URL map and loads the social
+# graph. The workers inherit all of it copy-on-write instead of each paying for
+# it on its first requests. SQLite connections must not cross a fork, so the
+# pool is emptied at the end, and gc.freeze() keeps the collector of each
+# worker from touching (and so copying) the inherited objects.
+#
+# after_fork() runs in each worker and opens its own pool connections. The
+# background threads (presence flusher, group commit writer, expiry worker)
+# start on their own in each worker: they check the pid.
+
+# Pool connections each worker opens as soon as it's forked
+WARM_CONNECTIONS = 2
+
+
+def compile_templates(app):
+    """Compile every template into the Jinja cache. Returns how many there are."""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def preload(app):
+    """Warm `app` in the process that will fork the workers. Returns what was done, with timings."""
+    start = time.perf_counter()
+    done = {'templates': compile_templates(app)}
+    # Markdown and bleach build their parsers, and import what they need, on first use
+    content.render_html('**Bienvenue** sur _Tessia\'s Diary_ !', set(), lambda username: '')
+    with app.test_request_context():
+        # The first URL build compiles the URL map's matcher
+        url_for('index')
+    pool = app.extensions['sqlite_pool']
+    conn = pool.acquire()
+    try:
+        done['graph_version'] = app.extensions['social_graph'].sync(conn).version
+    finally:
+        pool.release(conn)
+        pool.close_all()
+    gc.collect()
+    gc.freeze()
+    done['seconds'] = round(time.perf_counter() - start, 3)
+    app.logger.info('Preloaded %d templates in %.3f s', done['templates'], done['seconds'])
+    return done
+
+
+def after_fork(app):
+    """Open a just-forked worker's first pool connections (WARM_CONNECTIONS)."""
+    pool = app.extensions['sqlite_pool']
+    count = min(app.config.setdefault('WARM_CONNECTIONS', WARM_CONNECTIONS), pool.max_size)
+    conns = [pool.acquire() for _ in range(count)]
+    for conn in conns:
+        # Reads the schema, which each connection does once
+        conn.execute('SELECT 1 FROM users LIMIT 1').fetchall()
+        pool.release(conn)
@@ -0,0 +1,24 @@
+import warmup
+from app import create_app
+
+# Production entry point: `gunicorn -c gunicorn.conf.py`, or any WSGI server
+# pointed at `wsgi:application`, e.g. uWSGI:
+#
+#     uwsgi --http :8000 --module wsgi:application --master --processes 4 --threads 8
+#
+# Settings come from the environment (see create_app in app.py): at least
+# FLASK_SECRET_KEY, and FLASK_DATABASE when the database isn't ./database.db.
+#
+# Importing this module sets the app up and warms it (see warmup.py). Servers
+# that load the app before forking (gunicorn's preload_app, uWSGI without
+# lazy-apps) do it once in the master, and every worker starts warm.
+
+application = create_app()
+warmup.preload(application)
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:  # Not under uWSGI: gunicorn.conf.py calls after_fork itself
+    pass
+else:
+    postfork(lambda: warmup.after_fork(application))